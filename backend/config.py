@@ -24,6 +24,20 @@ class Settings:
     heartbeat_seconds: int = 30
     max_attempts: int = 5
     presign_expires_in: int = 3600
+    # Số process sinh mã đề song song trong một job (0/1 = tuần tự)
+    variant_workers: int = 0
+    # Upload ZIP kết quả lên S3 ngay trong lúc sinh đề (multipart), không ghi file tạm
+    stream_upload: bool = False
+    # Cache kết quả parse DOCX (khóa = SHA-256 file + PARSER_VERSION)
+    parse_cache_mb: int = 64            # Tầng RAM, 0 = tắt
+    parse_cache_dir: str = ""           # Tầng thư mục, rỗng = tắt
+    parse_cache_s3: bool = True         # Tầng S3 (bucket_output/parse-cache/), dùng chung server + worker; PARSE_CACHE_S3=0 để tắt
+    # Cách parse DOCX: "docx" (python-docx) hoặc "stream" (iterparse document.xml, ít RAM với file nhiều ảnh)
+    parse_backend: str = "docx"
+    # Ngân sách parse một file (0 = không giới hạn): vượt -> lỗi PARSE_BUDGET_EXCEEDED, không retry
+    parse_max_seconds: float = 60.0
+    parse_max_blocks: int = 200_000
+    parse_max_runs: int = 2_000_000
 
 
 def _require_env(name: str) -> str:
@@ -39,6 +53,10 @@ def load_settings() -> Settings:
         raw = os.getenv(name)
         return int(raw) if raw else default
 
+    def _env_float(name: str, default: float) -> float:
+        raw = os.getenv(name)
+        return float(raw) if raw else default
+
     return Settings(
         aws_access_key_id=_require_env('AWS_ACCESS_KEY_ID'),
         aws_secret_access_key=_require_env('AWS_SECRET_ACCESS_KEY'),
@@ -51,6 +69,15 @@ def load_settings() -> Settings:
         heartbeat_seconds=_env_int('HEARTBEAT_SECONDS', 30),
         max_attempts=_env_int('MAX_ATTEMPTS', 5),
         presign_expires_in=_env_int('PRESIGN_EXPIRES_IN', 3600),
+        variant_workers=_env_int('VARIANT_WORKERS', 0),
+        stream_upload=os.getenv('STREAM_UPLOAD', '').lower() in ('1', 'true', 'yes'),
+        parse_cache_mb=_env_int('PARSE_CACHE_MB', 64),
+        parse_cache_dir=os.getenv('PARSE_CACHE_DIR', ''),
+        parse_cache_s3=os.getenv('PARSE_CACHE_S3', 'true').lower() in ('1', 'true', 'yes'),
+        parse_backend=os.getenv('PARSE_BACKEND', 'docx').lower(),
+        parse_max_seconds=_env_float('PARSE_MAX_SECONDS', 60.0),
+        parse_max_blocks=_env_int('PARSE_MAX_BLOCKS', 200_000),
+        parse_max_runs=_env_int('PARSE_MAX_RUNS', 2_000_000),
     )
 
 
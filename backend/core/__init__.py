@@ -1,2 +1,3 @@
 from .parsers import parse_exam_template
-from .generators import generate_variant_from_structure
+from .template import CompiledTemplate, compile_template
+from .generators import generate_variant_from_structure, generate_variant_from_template
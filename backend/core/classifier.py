@@ -0,0 +1,83 @@
+import re
+from typing import Dict, Optional, Sequence, Tuple
+
+from .constants import BLOCK_RULES, INLINE_OPTION_PATTERN, ROLE_OPTION, ROLE_TEXT
+from .models import BlockRule
+
+_NAMED_GROUP = re.compile(r"\(\?P<(\w+)>")
+
+# Các ký tự có thể khớp không phân biệt hoa thường với một chữ Latin (vd: "ı", "İ" khớp "i" theo re.IGNORECASE)
+_LATIN_CHARS = [chr(x) for x in range(0x250)] + [chr(x) for x in range(0x1E00, 0x1F00)] + [chr(x) for x in range(0x2100, 0x2150)]
+
+# Kết quả cho dòng không khớp luật nào (đa số các dòng nội dung)
+_PLAIN = (ROLE_TEXT, "", False, 0, False)
+
+
+def _rule_alternative(rule: BlockRule) -> str:
+    # Nhóm có tên được đặt tiền tố theo vai trò ("option_letter") để nhiều luật cùng dùng "letter"/"star"
+    body = _NAMED_GROUP.sub(lambda m: f"(?P<{rule.role}_{m.group(1)}>", rule.pattern)
+    if rule.ignore_case:
+        body = f"(?i:{body})"
+    return f"(?P<{rule.role}>{body})"
+
+
+def _case_variants(c: str) -> set:
+    pattern = re.compile(re.escape(c), re.IGNORECASE)
+    return {x for x in _LATIN_CHARS if pattern.fullmatch(x)} | {c}
+
+
+def _combine(rules: Sequence[BlockRule]) -> re.Pattern:
+    return re.compile(r"^\s*(?:" + "|".join(_rule_alternative(r) for r in rules) + ")")
+
+
+class BlockClassifier:
+    """
+    Gán vai trò cho một block trong MỘT lần match:
+    ký tự đầu dòng (sau khoảng trắng) chọn ra nhóm luật có thể khớp, rồi chạy pattern gộp của nhóm đó.
+    Dòng bắt đầu bằng ký tự không luật nào dùng được trả về ROLE_TEXT mà không chạy regex nào.
+    """
+
+    def __init__(self, rules: Sequence[BlockRule] = BLOCK_RULES):
+        buckets: Dict[str, list] = {}
+        for rule in rules:
+            chars = set(rule.first_chars)
+            if rule.ignore_case:
+                chars = set().union(*(_case_variants(c) for c in chars))
+            for c in chars:
+                buckets.setdefault(c, []).append(rule)
+        # Tên nhóm chứa nhãn / dấu * của từng vai trò
+        self._fields: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        for rule in rules:
+            names = set(_NAMED_GROUP.findall(rule.pattern))
+            label = "number" if "number" in names else "letter" if "letter" in names else None
+            self._fields[rule.role] = (
+                f"{rule.role}_{label}" if label else None,
+                f"{rule.role}_star" if "star" in names else None,
+            )
+        # Các ký tự có cùng nhóm luật dùng chung một pattern đã biên dịch
+        compiled: Dict[Tuple[str, ...], re.Pattern] = {}
+        self._patterns: Dict[str, re.Pattern] = {}
+        for c, bucket in buckets.items():
+            key = tuple(r.role for r in bucket)
+            if key not in compiled:
+                compiled[key] = _combine(bucket)
+            self._patterns[c] = compiled[key]
+
+    def classify(self, text: str, stripped: str) -> Tuple[str, str, bool, int, bool]:
+        """(vai trò, nhãn, có dấu *, vị trí kết thúc nhãn trong text, dòng có nhiều phương án)."""
+        pattern = self._patterns.get(stripped[:1])
+        if pattern is None:
+            return _PLAIN
+        m = pattern.match(text)
+        if m is None:
+            return _PLAIN
+        role = m.lastgroup
+        label_group, star_group = self._fields[role]
+        label = m.group(label_group) if label_group else ""
+        starred = bool(star_group) and m.group(star_group) == "*"
+        inline = False
+        if role == ROLE_OPTION:
+            # Dòng "A. ... B. ..." -> để _fallback_inline_options xử lý
+            lead = len(text) - len(text.lstrip())
+            inline = bool(INLINE_OPTION_PATTERN.search(stripped[m.end() - lead:]))
+        return role, label, starred, m.end(), inline
@@ -1,20 +1,70 @@
-
 import re
 
+from .models import BlockRule
+
+# --- BLOCK GRAMMAR ---
+# Vai trò của một block (đoạn văn) trong đề thi. Mỗi block có đúng MỘT vai trò.
+ROLE_TEXT = "text"
+ROLE_SECTION = "section"
+ROLE_QUESTION = "question"
+ROLE_OPTION = "option"
+ROLE_SUB_OPTION = "sub_option"
+ROLE_ANSWER_HEADER = "answer_header"
+ROLE_ANSWER_LINE = "answer_line"
+ROLE_END_NOTE = "end_note"
+
+# Bảng luật phân loại: NƠI DUY NHẤT cần sửa khi mở rộng ngữ pháp đề thi (BlockClassifier gộp các luật
+# có cùng ký tự đầu thành một pattern). Các luật phải loại trừ nhau: một dòng khớp tối đa một luật.
+BLOCK_RULES = (
+    # "PHẦN I", "PHẦN 1", "I.", "PHẦN TRẮC NGHIỆM"
+    BlockRule(ROLE_SECTION, "PIVX",
+              r"(?:PH[ẦA]N\s+(?:[IVX]+|\d+|TRẮC\s+NGHIỆM|TỰ\s+LUẬN)|[IVX]+\.)[\s\.:]*(.*)$", ignore_case=True),
+    # "Câu 1", "Bài 2", cho phép tiền tố [ID:xxx]
+    BlockRule(ROLE_QUESTION, "[CB", r"(?:\[ID:[^\]]*\]\s*)?(?:Câu|Bai|Bài)\s+(?P<number>\d+)", ignore_case=True),
+    # "A.", "*B)" - không có khoảng trắng giữa * và chữ cái
+    BlockRule(ROLE_OPTION, "*ABCDEFGH", r"(?P<star>\*?)(?P<letter>[A-H])\s*[\.\)]\s*"),
+    # Ý đúng/sai: chỉ a-d và chỉ dấu ')'
+    BlockRule(ROLE_SUB_OPTION, "*abcd", r"(?P<star>\*?)(?P<letter>[a-d])\s*\)\s*"),
+    # Tiêu đề phần đáp án để cắt bỏ (tránh match 'Đáp án: ...' của câu hỏi)
+    BlockRule(ROLE_ANSWER_HEADER, "BĐ",
+              r"(?:BẢNG\s*)?ĐÁP\s*ÁN\s*(?:CHI TIẾT|TRẮC NGHIỆM|THAM KHẢO|PHẦN\s+.*)?\s*$", ignore_case=True),
+    # "Đáp án: ..." ở đầu dòng (dòng đáp án của một câu, vd nằm sau "HẾT")
+    BlockRule(ROLE_ANSWER_LINE, "ĐD", r"(?:Đáp án|ĐÁP ÁN|Dap an)[:\.]", ignore_case=True),
+    BlockRule(ROLE_END_NOTE, "-HG", r"[-]*\s*(HẾT|GIÁM THỊ|GHI CHÚ)\s*[-]*", ignore_case=True),
+)
+
+
+def _rule_pattern(role: str) -> re.Pattern:
+    """Pattern riêng của một luật (dùng ngoài bộ phân loại, vd: khi đánh lại nhãn)."""
+    rule = next(r for r in BLOCK_RULES if r.role == role)
+    return re.compile(r"^\s*" + rule.pattern, re.IGNORECASE if rule.ignore_case else 0)
+
+
 # --- CONFIG & REGEX PATTERNS ---
-# Cập nhật Regex để bắt được cả "PHẦN I", "PHẦN 1", "I.", "PHẦN TRẮC NGHIỆM"
-SECTION_PATTERN = re.compile(r"^\s*(?:PH[ẦA]N\s+(?:[IVX]+|\d+|TRẮC\s+NGHIỆM|TỰ\s+LUẬN)|[IVX]+\.)[\s\.:]*(.*)$", re.IGNORECASE)
-# Fixed: Allow optional [ID:xxx] prefix before Câu
-QUESTION_PATTERN = re.compile(r"^\s*(?:\[ID:[^\]]*\]\s*)?(?:Câu|Bai|Bài)\s+(\d+)", re.IGNORECASE)
-# Capturing group 1: Asterisk (*), Group 2: Letter
-# Fixed: Remove \s* between asterisk and letter to match *A. format directly
-OPTION_START_PATTERN = re.compile(r"^\s*(\*?)([A-H])\s*[\.\)]\s*")
+SECTION_PATTERN = _rule_pattern(ROLE_SECTION)
+QUESTION_PATTERN = _rule_pattern(ROLE_QUESTION)
+# Nhãn câu hỏi cần thay khi đánh lại số thứ tự ("Câu 3: ", "Bài 2.")
+QUESTION_LABEL_PATTERN = re.compile(r"^\s*(?:Cau|Câu|Bai|Bài)\s+\d+[:.]?\s*", re.IGNORECASE)
+# Group 1: Asterisk (*), Group 2: Letter
+OPTION_START_PATTERN = _rule_pattern(ROLE_OPTION)
 # Improved: Capture asterisk before OR after the letter (for *A. and A.* formats)
 # Group 1: Asterisk before, Group 2: Letter, Group 3: Asterisk after
 # FIX: Only exclude digits before space (e.g., "2,5 A."), allow dots/commas (e.g., "đặc. B.")
 INLINE_OPTION_PATTERN = re.compile(r"(?:^|(?<![0-9])\s)(\*?)([A-H])[\.\)](\*?)")
-# Fix: Limit sub-options to a-d (standard) and ONLY ')' as requested.
-SUB_OPTION_PATTERN = re.compile(r"^\s*(\*?)([a-d])\s*\)\s*")
-END_NOTE_PATTERN = re.compile(r"^\s*[-]*\s*(HẾT|GIÁM THỊ|GHI CHÚ)\s*[-]*", re.IGNORECASE)
-# Regex nhận diện tiêu đề phần đáp án để cắt bỏ (tránh match 'Đáp án: ...' của câu hỏi)
-ANSWER_HEADER_PATTERN = re.compile(r"^\s*(?:BẢNG\s*)?ĐÁP\s*ÁN\s*(?:CHI TIẾT|TRẮC NGHIỆM|THAM KHẢO|PHẦN\s+.*)?\s*$", re.IGNORECASE)
+SUB_OPTION_PATTERN = _rule_pattern(ROLE_SUB_OPTION)
+END_NOTE_PATTERN = _rule_pattern(ROLE_END_NOTE)
+ANSWER_HEADER_PATTERN = _rule_pattern(ROLE_ANSWER_HEADER)
+ANSWER_LINE_PATTERN = _rule_pattern(ROLE_ANSWER_LINE)
+# "Đáp án: A" / "Lời giải: ..." / "HD: ..." ở bất kỳ đâu trong đoạn -> group 1 là nội dung đáp án
+ANSWER_TEXT_PATTERN = re.compile(
+    r"(?:Đáp án|ĐÁP ÁN|Dap an|Lời giải|Lơi giải|Loi giai|Hướng dẫn|Huong dan|HD)[:\.]?\s*(.*)", re.IGNORECASE
+)
+# Thẻ định dạng của preview ([!b:...], [!m:...]) cần bỏ trước khi dò đáp án
+PREVIEW_TAG_PATTERN = re.compile(r"\[![a-z]:|\]")
+
+# --- BẢNG ĐÁP ÁN ---
+# Ô số câu ("1", "Câu 1:") và ô đáp án ("A") của bảng đáp án
+ANSWER_TABLE_QUESTION_PATTERN = re.compile(r"^\s*(?:Câu)?\s*(\d+)[\.:]?\s*$")
+ANSWER_TABLE_LETTER_PATTERN = re.compile(r"^\s*([A-D])\s*$")
+# Đáp án dạng text: "1. A", "1: A", "1 A", "Câu 1: A" -> Group 1: số câu, Group 2: chữ cái
+ANSWER_TEXT_PAIR_PATTERN = re.compile(r"(?:Câu|Bài)?\s*(\d+)[\.:\s-]*([A-D])\b", re.IGNORECASE)
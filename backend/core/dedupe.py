@@ -0,0 +1,117 @@
+import re
+import zlib
+from typing import Dict, List, Set
+
+import numpy as np
+
+from .constants import OPTION_START_PATTERN, QUESTION_LABEL_PATTERN, SUB_OPTION_PATTERN
+from .models import DuplicateCluster, ExamStructure, QuestionBlock
+from .utils import _get_text
+
+
+# --- NEAR-DUPLICATE INDEX ---
+# Gộp ngân hàng từ nhiều nguồn dễ sinh câu trùng / gần trùng. Mỗi câu được tóm thành chữ ký MinHash
+# trên tập 3-gram từ của stem + từng phương án (không phụ thuộc thứ tự phương án, bỏ nhãn "Câu N" / "A.").
+# LSH chia chữ ký thành BANDS dải: chỉ các câu rơi chung bucket ở ít nhất một dải mới được so sánh,
+# và mỗi câu chỉ so với câu đầu tiên của bucket -> O(số câu x BANDS), không so từng cặp.
+# BANDS=16 x 4 hàng: cặp có Jaccard 0.8 thành ứng viên với xác suất ~0.9999, Jaccard 0.3 chỉ ~0.12.
+
+NUM_PERM = 64
+BANDS = 16
+_ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+DEFAULT_THRESHOLD = 0.8
+
+_PRIME = (1 << 31) - 1
+# Tham số băm cố định -> server (preview) và worker (lọc trùng) luôn ra cùng các cụm
+_rng = np.random.default_rng(0x5EED)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)
+
+_WORD = re.compile(r"\w+")
+
+
+def _part_shingles(text: str, out: Set[int]) -> None:
+    words = _WORD.findall(text.lower())
+    if not words:
+        return
+    if len(words) < SHINGLE_SIZE:
+        out.add(zlib.crc32(" ".join(words).encode("utf-8")))
+        return
+    for i in range(len(words) - SHINGLE_SIZE + 1):
+        out.add(zlib.crc32(" ".join(words[i:i + SHINGLE_SIZE]).encode("utf-8")))
+
+
+def _question_shingles(q: QuestionBlock) -> Set[int]:
+    shingles: Set[int] = set()
+    stem = " ".join(_get_text(el) for el in q.stem_elements)
+    _part_shingles(QUESTION_LABEL_PATTERN.sub("", stem, count=1), shingles)
+    label_pattern = SUB_OPTION_PATTERN if q.mode == 'true_false' else OPTION_START_PATTERN
+    for opt in q.options:
+        text = " ".join(_get_text(el) for el in opt.elements)
+        _part_shingles(label_pattern.sub("", text, count=1), shingles)
+    return shingles
+
+
+def _minhash(shingles: Set[int]) -> np.ndarray:
+    x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)) % _PRIME
+    return ((_A[:, None] * x[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def find_near_duplicates(structure: ExamStructure, threshold: float = DEFAULT_THRESHOLD) -> List[DuplicateCluster]:
+    """
+    Các cụm câu có Jaccard ước lượng >= threshold (tính bắc cầu: A~B, B~C -> một cụm), theo thứ tự tài liệu.
+    Câu không có text (chỉ có hình / công thức) không được xét.
+    """
+    refs = []
+    signatures = []
+    for sec_i, sec in enumerate(structure.sections):
+        for q_i, q in enumerate(sec.questions):
+            shingles = _question_shingles(q)
+            if shingles:
+                refs.append((sec_i, q_i))
+                signatures.append(_minhash(shingles))
+    n = len(refs)
+    if n < 2:
+        return []
+    sig = np.vstack(signatures)
+
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(BANDS):
+        keys = np.ascontiguousarray(sig[:, band * _ROWS:(band + 1) * _ROWS])
+        buckets: Dict[bytes, int] = {}
+        for i in range(n):
+            first = buckets.setdefault(keys[i].tobytes(), i)
+            if first == i:
+                continue
+            a, b = find(first), find(i)
+            if a != b and np.count_nonzero(sig[first] == sig[i]) >= threshold * NUM_PERM:
+                # Gốc là câu xuất hiện trước -> câu đầu của cụm luôn là câu sớm nhất
+                parent[max(a, b)] = min(a, b)
+
+    groups: Dict[int, List[int]] = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        head = sig[members[0]]
+        similarity = min(int(np.count_nonzero(head == sig[m])) for m in members[1:]) / NUM_PERM
+        clusters.append(DuplicateCluster(tuple(refs[m] for m in members), round(similarity, 3)))
+    return clusters
+
+
+def drop_near_duplicates(structure: ExamStructure, clusters: List[DuplicateCluster]) -> int:
+    """Giữ câu đầu tiên của mỗi cụm, bỏ các câu còn lại khỏi structure. Trả về số câu đã bỏ."""
+    dropped = {ref for cluster in clusters for ref in cluster.members[1:]}
+    for sec_i, sec in enumerate(structure.sections):
+        sec.questions = [q for q_i, q in enumerate(sec.questions) if (sec_i, q_i) not in dropped]
+    return len(dropped)
@@ -1,18 +1,27 @@
 from copy import deepcopy
 import random
 import re
-import io
-from typing import Tuple, List, Optional
-from docx import Document
+from xml.sax.saxutils import escape as _xml_escape
+from typing import Tuple, List, Optional, Sequence
+from lxml import etree
 from docx.oxml import OxmlElement, ns
 from docx.oxml.text.paragraph import CT_P
 from docx.text.paragraph import Paragraph
 
-from .constants import OPTION_START_PATTERN
-from .models import OptionBlock, ExamStructure
+from exceptions import InvalidDrawCountsError
+from .constants import OPTION_START_PATTERN, QUESTION_LABEL_PATTERN
+from .models import (
+    OptionBlock, ExamStructure, LazyQuestionBlock, QuestionView, VariantPlan, LabelSlot,
+    ResolvedAnswer, ResolvedAnswerKey, AnswerKeyStats
+)
+from .template import (
+    CompiledTemplate, compile_template,
+    TemplateFragments, SectionFragments, QuestionFragments, OptionFragments
+)
 from .utils import (
-    _recursive_replace_code, _append_element, _clear_body_keep_sectpr,
-    _smart_replace_start, _create_simple_para_element, _normalize_format_and_clean
+    _recursive_replace_code, _append_element,
+    _smart_replace_start, _create_simple_para_element, _normalize_format_and_clean,
+    _apply_label_cuts
 )
 import logging
 logger = logging.getLogger("worker")
@@ -29,6 +38,24 @@ def _build_exam_footer(body, sect_pr, footer_elements):
     for el in footer_elements:
         _append_element(body, sect_pr, deepcopy(el))
 
+def _insert_bold_label_run(p_element, new_lbl: str):
+    """Chèn run nhãn in đậm "X. " vào đầu đoạn (option dạng rich text chưa có nhãn)."""
+    # 1. Tạo phần tử Run (<w:r>)
+    r = OxmlElement('w:r')
+    # 2. Tạo Properties cho Run (để set in đậm)
+    rPr = OxmlElement('w:rPr')
+    b = OxmlElement('w:b')
+    rPr.append(b)
+    r.append(rPr)
+    # 3. Tạo phần tử Text (<w:t>)
+    t = OxmlElement('w:t')
+    t.set(ns.qn('xml:space'), 'preserve')  # Giữ khoảng trắng
+    t.text = f"{new_lbl}. "
+    r.append(t)
+    # 4. Chèn Run mới tạo vào vị trí đầu tiên của Paragraph (<w:p>)
+    p_element.insert(0, r)
+
+
 def _process_mcq_option_format(opt: OptionBlock, new_lbl: str):
     """Normalize format for MCQ options (Bold label A. B. C. D.)"""
     first_el = opt.elements[0]
@@ -36,38 +63,161 @@ def _process_mcq_option_format(opt: OptionBlock, new_lbl: str):
         p = Paragraph(first_el, None)
         _normalize_format_and_clean(p)  # Clean format cũ
 
-        if OPTION_START_PATTERN.match(p.text):
+        slot = opt.label_slot
+        if slot is not None:
+            # Vị trí nhãn đã được parser tính sẵn -> ghi thẳng, không regex
+            if slot.element_idx is not None:
+                _apply_label_cuts(first_el, slot.cuts, f"{new_lbl}. ")
+                if p.runs: p.runs[0].font.bold = True
+            else:
+                _insert_bold_label_run(first_el, new_lbl)
+        elif OPTION_START_PATTERN.match(p.text):
             # Trường hợp text thuần túy đã có nhãn cũ (C. ...) -> Thay thế
             _smart_replace_start(p, OPTION_START_PATTERN, f"{new_lbl}. ")
             if p.runs: p.runs[0].font.bold = True
         else:
             # Trường hợp Rich Text (công thức) chưa có nhãn
-            # 1. Tạo phần tử Run (<w:r>)
-            r = OxmlElement('w:r')
-            # 2. Tạo Properties cho Run (để set in đậm)
-            rPr = OxmlElement('w:rPr')
-            b = OxmlElement('w:b')
-            rPr.append(b)
-            r.append(rPr)
-            # 3. Tạo phần tử Text (<w:t>)
-            t = OxmlElement('w:t')
-            t.set(ns.qn('xml:space'), 'preserve')  # Giữ khoảng trắng
-            t.text = f"{new_lbl}. "
-            r.append(t)
-            # 4. Chèn Run mới tạo vào vị trí đầu tiên của Paragraph (<w:p>)
-            p._element.insert(0, r)
+            _insert_bold_label_run(first_el, new_lbl)
 
     # Xử lý các đoạn văn còn lại của option (nếu có)
     for el in opt.elements[1:]:
         if isinstance(el, CT_P): _normalize_format_and_clean(Paragraph(el, None))
 
+MCQ_LABELS = ["A", "B", "C", "D", "E", "F"]
+TF_LABELS = ["a", "b", "c", "d", "e"]
+
+RENDER_TREE = "tree"            # Dựng cây lxml cho từng mã đề rồi target.save
+RENDER_FRAGMENTS = "fragments"  # Ghép các fragment bytes đã serialize sẵn
+
+# Ký tự Private Use Area làm chỗ giữ slot khi serialize fragment (hợp lệ trong XML, không xuất hiện trong đề)
+_SLOT = "\ue000"
+_SLOT_BYTES = _SLOT.encode("utf-8")
+
+
+def _answer_for_order(q, opt_order: List[int]) -> str:
+    """Tính đáp án của câu hỏi sau khi đảo phương án theo opt_order (logic khớp với server.py export_excel_key)."""
+    current_ans = ""
+    if q.mode == 'mcq':
+        # Match Excel gốc: chỉ lấy đáp án đầu tiên cho MCQ
+        for i, opt_i in enumerate(opt_order[:len(MCQ_LABELS)]):
+            if q.options[opt_i].is_correct:
+                current_ans = MCQ_LABELS[i]
+                break
+    elif q.mode == 'true_false':
+        # Format: Đ = Đúng, S = Sai (e.g., ĐSĐĐ means a=True, b=False, c=True, d=True)
+        current_ans = "".join(
+            "Đ" if q.options[opt_i].is_correct else "S" for opt_i in opt_order[:len(TF_LABELS)]
+        )
+
+    # Short Answer / Fallback (khớp với server.py)
+    if not current_ans and q.correct_answer_text:
+        current_ans = q.correct_answer_text
+    return current_ans
+
+
+def _option_labels(q, count: int) -> Tuple[Optional[str], ...]:
+    """Nhãn mới theo vị trí sau khi đảo: MCQ in lại nhãn A-F, TF đánh lại a-e."""
+    if q.mode == 'mcq':
+        labels = MCQ_LABELS
+    elif q.mode == 'true_false':
+        labels = TF_LABELS
+    else:
+        labels = []
+    return tuple(labels[i] if i < len(labels) else None for i in range(count))
+
+
+def _draw_count(draw_counts: Optional[Sequence[Optional[int]]], sec_i: int, n: int) -> int:
+    """Số câu bốc từ phần sec_i (None / 0 / vượt quá số câu = lấy cả phần)."""
+    if not draw_counts or sec_i >= len(draw_counts) or not draw_counts[sec_i]:
+        return n
+    return min(int(draw_counts[sec_i]), n)
+
+
+def check_draw_counts(structure: ExamStructure, draw_counts: Optional[Sequence[Optional[int]]]) -> None:
+    """draw_counts phải có đúng một số nguyên 0..số câu cho mỗi phần (0 = lấy cả phần)."""
+    if not draw_counts:
+        return
+    if len(draw_counts) != len(structure.sections):
+        raise InvalidDrawCountsError(
+            f"Cần {len(structure.sections)} số câu bốc (mỗi phần một số), nhận được {len(draw_counts)}."
+        )
+    for sec_i, (count, sec) in enumerate(zip(draw_counts, structure.sections), start=1):
+        n = len(sec.questions)
+        if isinstance(count, bool) or not isinstance(count, int) or not 0 <= count <= n:
+            raise InvalidDrawCountsError(f"Số câu bốc của phần {sec_i} phải là số nguyên từ 0 đến {n}.")
+
+
+def plan_variant(structure, seed, shuffle_questions=True, shuffle_options=True, draw_counts=None) -> VariantPlan:
+    """
+    Bốc thăm thứ tự câu hỏi / phương án cho một mã đề, KHÔNG đụng tới XML.
+    Template chỉ được đọc: mỗi câu hỏi trong mã đề là một QuestionView (hoán vị + nhãn).
+    draw_counts: số câu bốc ngẫu nhiên từ mỗi phần (ngân hàng câu hỏi); chỉ câu được bốc mới được render.
+    """
+    check_draw_counts(structure, draw_counts)
+    rng = random.Random(seed)
+    sections = []
+    number = 1
+
+    for sec_i, sec in enumerate(structure.sections):
+        q_order = list(range(len(sec.questions)))
+        k = _draw_count(draw_counts, sec_i, len(q_order))
+        if k < len(q_order):
+            q_order = rng.sample(q_order, k)
+            if not shuffle_questions: q_order.sort()
+        elif shuffle_questions: rng.shuffle(q_order)
+
+        views = []
+        for q_i in q_order:
+            q = sec.questions[q_i]
+            opt_order = list(range(len(q.options)))
+            # Shuffle Options (MCQ and True/False)
+            if shuffle_options and q.options and q.mode in ('mcq', 'true_false'):
+                rng.shuffle(opt_order)
+            # LUÔN có answer (kể cả rỗng) để giữ đúng index (như Excel gốc server.py:467)
+            views.append(QuestionView(
+                section_idx=sec_i,
+                question_idx=q_i,
+                number=number,
+                option_order=tuple(opt_order),
+                option_labels=_option_labels(q, len(opt_order)),
+                answer=_answer_for_order(q, opt_order),
+            ))
+            number += 1
+        sections.append(tuple(views))
+
+    return VariantPlan(sections=tuple(sections))
+
+
+def _relabel_question_stem(stem_elements: list, new_prefix: str, slot: Optional[LabelSlot] = None) -> list:
+    """Thay nhãn "Câu N" của đoạn đầu tiên có nhãn, hoặc chèn đoạn nhãn mới nếu không có."""
+    if slot is not None:
+        # Vị trí nhãn đã được parser tính sẵn -> ghi thẳng vào run, không regex / quét text
+        if slot.element_idx is None:
+            return [_create_simple_para_element(new_prefix)] + list(stem_elements)
+        _apply_label_cuts(stem_elements[slot.element_idx], slot.cuts, new_prefix)
+        return stem_elements
+
+    for el in stem_elements:
+        if isinstance(el, CT_P):
+            p = Paragraph(el, None)
+            if QUESTION_LABEL_PATTERN.match(p.text):
+                _smart_replace_start(p, QUESTION_LABEL_PATTERN, new_prefix)
+                return stem_elements
+    return [_create_simple_para_element(new_prefix)] + list(stem_elements)
+
+
 def _build_exam_body(body, sect_pr, target_doc, structure, seed, shuffle_questions=True, shuffle_options=True) -> Tuple[int, List[str]]:
     """Build the main content of the exam (Sections -> Questions)."""
-    rng = random.Random(seed)
-    final_answers = []
+    plan = plan_variant(structure, seed, shuffle_questions, shuffle_options)
+    global_q_idx = _render_plan_tree(body, sect_pr, target_doc, structure, plan)
+    return global_q_idx, plan.answers
+
+
+def _render_plan_tree(body, sect_pr, target_doc, structure, plan: VariantPlan) -> int:
+    """Ghi các câu hỏi theo plan vào body; element của template chỉ được clone khi ghi ra."""
     global_q_idx = 1
-    
-    for sec in structure.sections:
+
+    for sec, views in zip(structure.sections, plan.sections):
         # 1. Section Title
         if sec.title:
             p = target_doc.add_paragraph()
@@ -80,177 +230,330 @@ def _build_exam_body(body, sect_pr, target_doc, structure, seed, shuffle_questio
             _append_element(body, sect_pr, deepcopy(el))
 
         # 3. Questions
-        qs = list(sec.questions)
-        if shuffle_questions: rng.shuffle(qs)
-
-        for q in qs:
-            new_q = deepcopy(q)
-            # Re-label question stem
-            new_prefix = f"Câu {global_q_idx}: "
-            replaced_label = False
-            for el in new_q.stem_elements:
-                if isinstance(el, CT_P):
-                    p = Paragraph(el, None)
-                    # Use standard pattern for replacement
-                    pat = re.compile(r"^\s*(?:Cau|Câu|Bai|Bài)\s+\d+[:.]?\s*", re.IGNORECASE)
-                    if pat.match(p.text):
-                        _smart_replace_start(p, pat, new_prefix)
-                        replaced_label = True
-                        break
-            if not replaced_label:
-                p_new = _create_simple_para_element(new_prefix)
-                new_q.stem_elements.insert(0, p_new)
+        for view in views:
+            q = sec.questions[view.question_idx]
 
-            # Shuffle Options (MCQ and True/False)
-            if shuffle_options and new_q.options and new_q.mode in ('mcq', 'true_false'):
-                rng.shuffle(new_q.options)
-
-            # Process Options & Record Answers (logic khớp với server.py export_excel_key)
-            current_ans = ""
-
-            if new_q.mode == 'mcq':
-                labels = ["A", "B", "C", "D", "E", "F"]
-                mcq_corrects = []
-                for i, opt in enumerate(new_q.options):
-                    if i >= len(labels): break
-                    new_lbl = labels[i]
-                    if opt.is_correct: mcq_corrects.append(new_lbl)
-
-                    _process_mcq_option_format(opt, new_lbl)
-                
-                # Match Excel gốc: chỉ lấy đáp án đầu tiên cho MCQ
-                current_ans = mcq_corrects[0] if mcq_corrects else ""
-            
-            elif new_q.mode == 'true_false':
-                # Logic for True/False: Re-label after shuffle and track correct
-                # Format: Đ = Đúng, S = Sai (e.g., ĐSĐĐ means a=True, b=False, c=True, d=True)
-                labels_tf = ["a", "b", "c", "d", "e"]
-                tf_result = []
-                for i, opt in enumerate(new_q.options):
-                    if i >= len(labels_tf): break
-                    new_lbl = labels_tf[i]
-                    # Đ = correct, S = incorrect
-                    tf_result.append("Đ" if opt.is_correct else "S")
-                    # Update option label to new position (for rendering)
-                    opt.label = new_lbl
-                current_ans = "".join(tf_result)
-            
-            # Short Answer / Fallback (khớp với server.py)
-            if not current_ans and new_q.correct_answer_text:
-                current_ans = new_q.correct_answer_text
-            
-            # LUÔN append để giữ đúng index (như Excel gốc server.py:467)
-            final_answers.append(current_ans)
-
-            # Render Stem & Options
-            for el in new_q.stem_elements: _append_element(body, sect_pr, el)
-            for opt in new_q.options:
-                for el in opt.elements: _append_element(body, sect_pr, el)
-            
-            global_q_idx += 1
-            
-    return global_q_idx, final_answers
+            # Re-label question stem (trên bản clone)
+            stems = _relabel_question_stem(
+                [deepcopy(el) for el in q.stem_elements], f"Câu {view.number}: ", q.label_slot
+            )
+            for el in stems: _append_element(body, sect_pr, el)
 
+            for opt_i, new_lbl in zip(view.option_order, view.option_labels):
+                opt = q.options[opt_i]
+                clone = OptionBlock(
+                    new_lbl or opt.label, [deepcopy(el) for el in opt.elements], opt.is_correct, opt.label_slot
+                )
+                if q.mode == 'mcq' and new_lbl:
+                    _process_mcq_option_format(clone, new_lbl)
+                for el in clone.elements: _append_element(body, sect_pr, el)
 
-def _apply_external_key(structure: ExamStructure, external_map: dict):
-    """Override is_correct flags based on external Answer Key (from Editor)."""
-    if not external_map: return
-    
-    logger.info(f"Applying External Key Map: {len(external_map)} entries.")
-    matched_count = 0
-    
+            global_q_idx = view.number + 1
+
+    return global_q_idx
+
+
+# --- FRAGMENT MODE ---
+
+def _serialize_fragment(root, elements) -> bytes:
+    """
+    Serialize các element (đã clone) thành bytes để chèn thẳng vào <w:body>.
+    Bọc trong một phần tử cùng nsmap với <w:document> để không lặp lại khai báo xmlns ở từng fragment.
+    """
+    if not elements:
+        return b""
+    wrapper = root.makeelement(root.tag, nsmap=root.nsmap)
+    for el in elements:
+        wrapper.append(el)
+    data = etree.tostring(wrapper, encoding="UTF-8", xml_declaration=False)
+    return data[data.index(b">") + 1:data.rindex(b"</")]
+
+
+def _split_slots(data: bytes) -> List[bytes]:
+    return data.split(_SLOT_BYTES)
+
+
+def _has_slot_char(elements) -> bool:
+    return any(_SLOT_BYTES in etree.tostring(el, encoding="UTF-8") for el in elements)
+
+
+def _question_elements(q):
+    yield from q.stem_elements
+    for opt in q.options:
+        yield from opt.elements
+
+
+def _contains_slot_char(template: CompiledTemplate) -> bool:
+    """
+    Khung template (header, tiêu đề / hướng dẫn phần, footer) có sẵn ký tự slot (U+E000) thì không cắt
+    fragment theo slot được. Câu hỏi được kiểm tra riêng khi biên dịch (_question_fragments).
+    """
+    structure = template.structure
+    if any(_SLOT in (sec.title or "") for sec in structure.sections):
+        return True
+    if _SLOT_BYTES in etree.tostring(template.document.element, encoding="UTF-8"):
+        return True
+    return _has_slot_char(structure.header_elements) or _has_slot_char(structure.footer_elements) or any(
+        _has_slot_char(sec.info_elements) for sec in structure.sections
+    )
+
+
+def prepare_fragments(template: CompiledTemplate, plans: Sequence[VariantPlan] = ()) -> Optional[TemplateFragments]:
+    """
+    Biên dịch khung fragment một lần cho template (nếu chưa có) và fragment của các câu trong plans.
+    Câu hỏi khác được biên dịch khi mã đề đầu tiên dùng tới -> câu không được bốc (ngân hàng) không bị parse.
+    Trả về None khi template không dùng được chế độ fragment (chứa sẵn ký tự slot) -> render bằng cây lxml.
+    """
+    if template.fragments is None and template.fragments_supported:
+        if _contains_slot_char(template):
+            logger.warning("Template chứa ký tự U+E000, không dùng được chế độ fragments, chuyển sang tree.")
+            template.fragments_supported = False
+        else:
+            template.fragments = compile_fragments(template)
+    if template.fragments is not None:
+        for plan in plans:
+            for views in plan.sections:
+                for view in views:
+                    _question_fragments(template, view.section_idx, view.question_idx)
+    return template.fragments
+
+
+def compile_fragments(template: CompiledTemplate) -> TemplateFragments:
+    """
+    Serialize sẵn header/tiêu đề phần/footer MỘT lần, chừa slot cho phần thay đổi theo mã đề.
+    Câu hỏi được serialize riêng theo nhu cầu (_question_fragments).
+    Khung template không được chứa sẵn ký tự slot (xem prepare_fragments).
+    """
+    structure = template.structure
+    root = template.document.element
+    template.reset_body()
+
+    # Khung document.xml: cắt tại vị trí nội dung body (trước sectPr)
+    marker = etree.Comment(_SLOT)
+    _append_element(template.body, template.sect_pr, marker)
+    xml = etree.tostring(root, encoding="UTF-8", standalone=True)
+    template.body.remove(marker)
+    prefix, suffix = xml.split(b"<!--" + _SLOT_BYTES + b"-->")
+
+    # Header: slot tại vị trí mã đề
+    header_clones = []
+    for el in structure.header_elements:
+        clone = deepcopy(el)
+        _recursive_replace_code(clone, _SLOT)
+        header_clones.append(clone)
+    header = _split_slots(_serialize_fragment(root, header_clones))
+
+    sections = []
     for sec in structure.sections:
-        for q in sec.questions:
-            # Fix: Convert original_idx to string because JSON keys are always strings
-            q_idx_str = str(q.original_idx)
-            
-            # Determine Key to use
-            key_to_use = None
-            if q.content_hash and q.content_hash in external_map:
-                key_to_use = q.content_hash
-                logger.debug(f"Matched Q{q.original_idx} by HASH: {q.content_hash}")
-            elif q_idx_str in external_map:
-                key_to_use = q_idx_str
-                logger.debug(f"Matched Q{q.original_idx} by INDEX: {q_idx_str}")
-            
-            if key_to_use:
-                matched_count += 1
-                # Found an entry for this question
-                answer_value = str(external_map[key_to_use]).strip()
-                
-                # Determine if this is MCQ/TF (single letters like "A", "B,C") or Short Answer (numeric/text)
-                # Check if answer_value looks like option labels
-                is_option_answer = bool(re.match(r'^[A-Za-z](,[A-Za-z])*$', answer_value.replace(' ', '')))
-                
-                if is_option_answer and q.options:
-                    # MCQ or True/False: Set is_correct on matching options
-                    correct_lbl = answer_value.upper()
-                    targets = [x.strip() for x in correct_lbl.split(',')]
-                    
-                    # Reset all to False first
-                    for opt in q.options:
-                        opt.is_correct = False
-                        
-                    # Set True for targets
-                    for opt in q.options:
-                        clean_lbl = ""
-                        for char in opt.label:
-                            if char.isalpha():
-                                clean_lbl = char.upper()
-                                break
-                        
-                        if clean_lbl in targets:
-                             opt.is_correct = True
+        head_elements = []
+        if sec.title:
+            p = Paragraph(OxmlElement('w:p'), None)
+            p.add_run(sec.title).bold = True
+            head_elements.append(p._element)
+        head_elements.extend(deepcopy(el) for el in sec.info_elements)
+        sections.append(SectionFragments(head=_serialize_fragment(root, head_elements)))
+
+    footer = _serialize_fragment(root, [deepcopy(el) for el in structure.footer_elements])
+    return TemplateFragments(prefix=prefix, header=header, sections=sections, footer=footer, suffix=suffix)
+
+
+def _question_fragments(template: CompiledTemplate, sec_i: int, q_i: int) -> Optional[QuestionFragments]:
+    """Fragment của một câu hỏi (biên dịch lần đầu rồi giữ lại); None nếu câu chứa sẵn ký tự slot."""
+    cache = template.fragments.sections[sec_i].questions
+    if q_i in cache:
+        return cache[q_i]
+    q = template.structure.sections[sec_i].questions[q_i]
+    if _has_slot_char(_question_elements(q)):
+        logger.warning(f"Câu {q.original_idx} chứa ký tự U+E000, các mã đề có câu này render bằng tree.")
+        cache[q_i] = None
+        return None
+
+    root = template.document.element
+    stems = _relabel_question_stem([deepcopy(el) for el in q.stem_elements], f"Câu {_SLOT}: ", q.label_slot)
+    q_frag = QuestionFragments(mode=q.mode, stem=_split_slots(_serialize_fragment(root, stems)))
+    for opt in q.options:
+        opt_frag = OptionFragments(plain=_serialize_fragment(root, [deepcopy(el) for el in opt.elements]))
+        if q.mode == 'mcq':
+            labeled = OptionBlock(opt.label, [deepcopy(el) for el in opt.elements], opt.is_correct, opt.label_slot)
+            _process_mcq_option_format(labeled, _SLOT)
+            opt_frag.labeled = _split_slots(_serialize_fragment(root, labeled.elements))
+        q_frag.options.append(opt_frag)
+    cache[q_i] = q_frag
+    return q_frag
+
+
+def _assemble_document_xml(template: CompiledTemplate, plan: VariantPlan, exam_code: str) -> Optional[bytes]:
+    """
+    Ghép document.xml của một mã đề từ các fragment đã serialize sẵn.
+    None khi một câu của mã đề không có fragment (chứa ký tự slot) -> mã đề này render bằng tree.
+    """
+    fragments = template.fragments
+    # Giá trị chèn vào slot nằm trong text node -> phải escape (&, <, >)
+    out = [fragments.prefix, _xml_escape(exam_code).encode("utf-8").join(fragments.header)]
+    for sec_i, (sec_frag, views) in enumerate(zip(fragments.sections, plan.sections)):
+        out.append(sec_frag.head)
+        for view in views:
+            q_frag = _question_fragments(template, sec_i, view.question_idx)
+            if q_frag is None:
+                return None
+            out.append(str(view.number).encode("ascii").join(q_frag.stem))
+            for opt_i, new_lbl in zip(view.option_order, view.option_labels):
+                opt_frag = q_frag.options[opt_i]
+                if opt_frag.labeled is not None and new_lbl:
+                    out.append(_xml_escape(new_lbl).encode("utf-8").join(opt_frag.labeled))
                 else:
-                    # Short Answer: Set correct_answer_text directly
-                    q.correct_answer_text = answer_value
-                    logger.debug(f"Q{q.original_idx}: Set Short Answer = {answer_value}")
-            else:
+                    out.append(opt_frag.plain)
+    out.append(fragments.footer)
+    out.append(fragments.suffix)
+    return b"".join(out)
+
+
+_OPTION_ANSWER_PATTERN = re.compile(r'^[A-Za-z](,[A-Za-z])*$')
+
+
+def _resolve_answer_value(value) -> ResolvedAnswer:
+    answer_value = str(value).strip()
+    # Determine if this is MCQ/TF (single letters like "A", "B,C") or Short Answer (numeric/text)
+    if _OPTION_ANSWER_PATTERN.match(answer_value.replace(' ', '')):
+        targets = frozenset(x.strip() for x in answer_value.upper().split(','))
+        return ResolvedAnswer(answer_value, targets)
+    return ResolvedAnswer(answer_value)
+
+
+def resolve_answer_key(external_map: Optional[dict]) -> ResolvedAnswerKey:
+    """Phân tích answer map từ Editor MỘT lần thành bảng tra cứu theo key (hash hoặc số câu)."""
+    key = ResolvedAnswerKey()
+    for map_key, value in (external_map or {}).items():
+        key.entries[str(map_key)] = _resolve_answer_value(value)
+    return key
+
+
+def _option_letter(opt: OptionBlock) -> str:
+    for char in opt.label:
+        if char.isalpha():
+            return char.upper()
+    return ""
+
+
+def _apply_answer(q, answer: ResolvedAnswer) -> None:
+    if answer.option_labels is not None and q.options:
+        # MCQ or True/False: Set is_correct on matching options
+        for opt in q.options:
+            opt.is_correct = _option_letter(opt) in answer.option_labels
+    else:
+        # Short Answer: Set correct_answer_text directly
+        q.correct_answer_text = answer.text
+
+
+def apply_answer_key(structure: ExamStructure, answer_key: ResolvedAnswerKey) -> AnswerKeyStats:
+    """Override is_correct flags based on external Answer Key (from Editor). Trả về thống kê khớp key."""
+    stats = AnswerKeyStats(total_keys=len(answer_key.entries))
+    if not answer_key.entries: return stats
+
+    logger.info(f"Applying External Key Map: {len(answer_key.entries)} entries.")
+    used_keys = set()
+
+    for sec in structure.sections:
+        for q in sec.questions:
+            key_used, answer = answer_key.lookup(q)
+            if answer is None:
                 logger.debug(f"Q{q.original_idx}: No external key found.")
+                continue
 
-    logger.info(f"External Key Application Complete. Matched {matched_count} questions.")
+            used_keys.add(key_used)
+            if key_used == q.content_hash:
+                stats.matched_by_hash += 1
+            else:
+                stats.matched_by_index += 1
 
+            if isinstance(q, LazyQuestionBlock) and not q.resolved:
+                # Chưa parse (vd: câu ngân hàng chưa được bốc) -> áp khi câu được resolve
+                q.when_resolved(lambda q, answer=answer: _apply_answer(q, answer))
+            else:
+                _apply_answer(q, answer)
 
-def generate_variant_from_structure(
-        source_bytes: bytes, structure: ExamStructure, seed: int, exam_code: str,
+    stats.unmatched_keys = [k for k in answer_key.entries if k not in used_keys]
+    logger.info(
+        f"External Key Application Complete. Matched {stats.matched_questions} questions "
+        f"({stats.matched_by_hash} by hash, {stats.matched_by_index} by index), "
+        f"{len(stats.unmatched_keys)} unmatched keys."
+    )
+    return stats
+
+
+def _apply_external_key(structure: ExamStructure, external_map: dict):
+    """Override is_correct flags based on external Answer Key (from Editor)."""
+    if not external_map: return
+    return apply_answer_key(structure, resolve_answer_key(external_map))
+
+
+def generate_variant_from_template(
+        template: CompiledTemplate, seed: Optional[int], exam_code: str,
         shuffle_questions: bool = True, shuffle_options: bool = True,
-        external_answer_map: Optional[dict] = None
+        external_answer_map: Optional[dict] = None,
+        render_mode: str = RENDER_TREE,
+        plan: Optional[VariantPlan] = None,
+        draw_counts: Optional[Sequence[Optional[int]]] = None
 ) -> Tuple[bytes, List[str]]:
-    
-    # Clone structure to avoid side effects on other variants if modified?
-    # Actually structure is parsed once. If we modify it based on external map, 
-    # we should modify it ONCE before loop, or work on a copy.
-    # The external map is the TRUTH for ALL variants. So we can modify it once.
-    # BUT generators might be called in parallel or sequentially.
-    # Ideally, apply it outside this function? Or inside?
-    # If we apply it inside, we should deepcopy. 
-    # But wait, 'structure' passed here IS the template.
-    # If we modify it permanently, it's fine because the map applies to the whole job.
-    # However, safe practice: modify matching copy.
-    
-    # Optimization: If we trust the structure is fresh or reused correctly.
-    # Let's apply it if provided.
+    """
+    Dựng một mã đề từ template đã biên dịch (không parse lại file gốc).
+    plan: hoán vị đã bốc sẵn (vd: core.permutations.plan_batch); khi có thì bỏ qua seed.
+    """
+    structure = template.structure
+
+    # External map là đáp án chuẩn cho CẢ job nên áp trực tiếp lên structure.
+    # Khi sinh nhiều mã đề nên áp MỘT lần trước (apply_answer_key) và không truyền map vào đây.
     if external_answer_map:
         _apply_external_key(structure, external_answer_map)
 
-    target = Document(io.BytesIO(source_bytes))
-    sect_pr = _clear_body_keep_sectpr(target)
-    body = target.element.body
+    if plan is None:
+        plan = plan_variant(structure, seed, shuffle_questions, shuffle_options, draw_counts)
 
-    # 1. Header
-    _build_exam_header(body, sect_pr, structure.header_elements, exam_code)
+    if render_mode == RENDER_FRAGMENTS and prepare_fragments(template) is not None:
+        document_xml = _assemble_document_xml(template, plan, exam_code)
+        if document_xml is not None:
+            return template.package.write(document_xml), plan.answers
 
-    # 2. Body
-    global_q_idx, final_answers = _build_exam_body(
-        body, sect_pr, target, structure, seed, shuffle_questions, shuffle_options
-    )
+    target = template.document
+    body = template.body
+    sect_pr = template.sect_pr
+    template.reset_body()
+
+    try:
+        # 1. Header
+        _build_exam_header(body, sect_pr, structure.header_elements, exam_code)
+
+        # 2. Body
+        _render_plan_tree(body, sect_pr, target, structure, plan)
+
+        # 3. Footer
+        _build_exam_footer(body, sect_pr, structure.footer_elements)
+
+        # Save: chỉ document part thay đổi, các part khác copy thô từ file gốc
+        document_xml = etree.tostring(target.element, encoding="UTF-8", standalone=True)
+    finally:
+        # Giải phóng nội dung mã đề vừa dựng, template sẵn sàng cho mã đề tiếp theo
+        template.reset_body()
 
-    # 3. Footer
-    _build_exam_footer(body, sect_pr, structure.footer_elements)
+    return template.package.write(document_xml), plan.answers
 
-    # Save
-    buf = io.BytesIO()
-    target.save(buf)
-    buf.seek(0)
-    
-    return buf.getvalue(), final_answers
+
+def generate_variant_from_structure(
+        source_bytes: bytes, structure: ExamStructure, seed: int, exam_code: str,
+        shuffle_questions: bool = True, shuffle_options: bool = True,
+        external_answer_map: Optional[dict] = None,
+        draw_counts: Optional[Sequence[Optional[int]]] = None
+) -> Tuple[bytes, List[str]]:
+    """
+    Dựng một mã đề đơn lẻ từ file gốc.
+    Khi sinh nhiều mã đề, dùng compile_template() một lần + generate_variant_from_template().
+    draw_counts: số câu bốc từ mỗi phần, vd [40, 0] = bốc 40 câu phần I, giữ nguyên phần II.
+    """
+    template = compile_template(source_bytes, structure)
+    return generate_variant_from_template(
+        template, seed, exam_code,
+        shuffle_questions=shuffle_questions,
+        shuffle_options=shuffle_options,
+        external_answer_map=external_answer_map,
+        draw_counts=draw_counts
+    )
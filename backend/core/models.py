@@ -1,13 +1,25 @@
+from bisect import bisect_right
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
 from docx.oxml import OxmlElement
 
 # --- DATA STRUCTURES ---
+@dataclass(frozen=True)
+class LabelSlot:
+    """
+    Vị trí nhãn ("Câu 3: ", "B. ") trong đoạn văn, tính MỘT lần lúc parse.
+    Khi sinh đề chỉ cần ghi nhãn mới vào đúng run, không regex / quét lại text.
+    """
+    element_idx: Optional[int]  # Đoạn chứa nhãn; None = không có nhãn trong text, phải chèn mới
+    cuts: Tuple[Tuple[int, int], ...] = ()  # (chỉ số run trong w:p, số ký tự nhãn cắt bỏ ở đầu run)
+
+
 @dataclass
 class OptionBlock:
     label: str  # A, B, C, D
     elements: List[OxmlElement] = field(default_factory=list)
     is_correct: bool = False
+    label_slot: Optional[LabelSlot] = None
 
 
 @dataclass
@@ -19,6 +31,71 @@ class QuestionBlock:
     mode: str = "mcq"
     correct_answer_text: Optional[str] = None
     content_hash: Optional[str] = None
+    label_slot: Optional[LabelSlot] = None
+
+
+class _Deferred:
+    """Trường của LazyQuestionBlock: lần truy cập đầu tiên sẽ resolve cả câu hỏi."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        if self.name not in obj.__dict__:
+            obj._resolve_now()
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
+class LazyQuestionBlock(QuestionBlock):
+    """
+    QuestionBlock của lần quét đầu: chỉ biết số câu, nhãn và vân tay nội dung (tính từ text của block index).
+    Stem / phương án / đáp án được parse (resolve) khi một trường trong số đó được truy cập lần đầu.
+    """
+    stem_elements = _Deferred()
+    options = _Deferred()
+    mode = _Deferred()
+    correct_answer_text = _Deferred()
+    label_slot = _Deferred()
+
+    def __init__(self, original_idx: int, raw_label: str, content_hash: str,
+                 resolve: Callable[["QuestionBlock"], None]):
+        self.original_idx = original_idx
+        self.raw_label = raw_label
+        self.content_hash = content_hash
+        self._resolve = resolve
+
+    @property
+    def resolved(self) -> bool:
+        return "_resolve" not in self.__dict__
+
+    def resolve(self) -> None:
+        """Parse ngay (nếu chưa), không chờ tới lần truy cập đầu tiên."""
+        if not self.resolved:
+            self._resolve_now()
+
+    def when_resolved(self, callback: Callable[["QuestionBlock"], None]) -> None:
+        """Gọi callback(self) ngay sau khi câu hỏi được resolve (gọi luôn nếu đã resolve)."""
+        if self.resolved:
+            callback(self)
+        else:
+            self.__dict__.setdefault("_listeners", []).append(callback)
+
+    def _resolve_now(self) -> None:
+        resolve = self.__dict__.pop("_resolve", None)
+        if resolve is None:
+            raise AttributeError("LazyQuestionBlock field accessed before it was set")
+        try:
+            resolve(self)
+        except Exception:
+            self._resolve = resolve
+            raise
+        for callback in self.__dict__.pop("_listeners", ()):
+            callback(self)
 
 
 @dataclass
@@ -33,3 +110,148 @@ class ExamStructure:
     header_elements: List[OxmlElement] = field(default_factory=list)
     sections: List[Section] = field(default_factory=list)
     footer_elements: List[OxmlElement] = field(default_factory=list)
+
+
+# --- PER-VARIANT VIEWS ---
+# Template (ExamStructure) chỉ được ĐỌC khi sinh đề; mỗi mã đề chỉ ghi lại hoán vị + nhãn mới.
+# Element chỉ được clone tại thời điểm ghi ra output.
+
+@dataclass(frozen=True)
+class QuestionView:
+    section_idx: int
+    question_idx: int                     # Vị trí câu hỏi trong Section.questions của template
+    number: int                           # Số thứ tự "Câu N" trong mã đề
+    option_order: Tuple[int, ...]         # option_order[vị trí mới] = chỉ số phương án trong template
+    option_labels: Tuple[Optional[str], ...]  # Nhãn mới theo vị trí (None = giữ nguyên phương án)
+    answer: str
+
+
+@dataclass(frozen=True)
+class VariantPlan:
+    sections: Tuple[Tuple[QuestionView, ...], ...]
+
+    @property
+    def answers(self) -> List[str]:
+        return [view.answer for sec in self.sections for view in sec]
+
+
+# --- EXTERNAL ANSWER KEY ---
+
+@dataclass(frozen=True)
+class ResolvedAnswer:
+    """Một đáp án từ Editor đã được phân tích sẵn (chỉ một lần cho cả job)."""
+    text: str                                   # Giá trị gốc đã strip (dùng cho Short Answer)
+    option_labels: Optional[FrozenSet[str]] = None  # {"A"} / {"B", "C"} nếu là đáp án dạng nhãn phương án
+
+
+@dataclass
+class AnswerKeyStats:
+    total_keys: int = 0
+    matched_by_hash: int = 0
+    matched_by_index: int = 0
+    unmatched_keys: List[str] = field(default_factory=list)
+
+    @property
+    def matched_questions(self) -> int:
+        return self.matched_by_hash + self.matched_by_index
+
+
+@dataclass
+class ResolvedAnswerKey:
+    """Bảng đáp án ngoài, tra O(1) theo content_hash hoặc original_idx (dạng chuỗi như JSON key)."""
+    entries: Dict[str, ResolvedAnswer] = field(default_factory=dict)
+
+    def lookup(self, q: "QuestionBlock") -> Tuple[Optional[str], Optional[ResolvedAnswer]]:
+        if q.content_hash and q.content_hash in self.entries:
+            return q.content_hash, self.entries[q.content_hash]
+        # JSON keys are always strings
+        q_idx_str = str(q.original_idx)
+        if q_idx_str in self.entries:
+            return q_idx_str, self.entries[q_idx_str]
+        return None, None
+
+
+# --- NEAR-DUPLICATES ---
+
+@dataclass(frozen=True)
+class DuplicateCluster:
+    """
+    Cụm câu hỏi gần trùng nhau (core/dedupe.py).
+    members: (chỉ số phần, chỉ số câu trong Section.questions) theo thứ tự tài liệu; câu đầu là câu được giữ khi lọc trùng.
+    """
+    members: Tuple[Tuple[int, int], ...]
+    similarity: float  # Jaccard ước lượng nhỏ nhất giữa câu đầu và các câu còn lại
+
+
+# --- BLOCK GRAMMAR ---
+
+@dataclass(frozen=True)
+class BlockRule:
+    """
+    Một luật phân loại block. pattern được match ngay sau khoảng trắng đầu dòng;
+    first_chars: các ký tự có thể đứng đầu (sau khoảng trắng) - dùng để lọc nhanh luật cần thử.
+    Nhóm có tên trong pattern: "number" (số câu), "letter" (nhãn phương án), "star" (dấu *).
+    """
+    role: str
+    first_chars: str
+    pattern: str
+    ignore_case: bool = False
+
+
+# --- PARSE BUDGET ---
+
+@dataclass(frozen=True)
+class ParseLimits:
+    """Giới hạn công sức parse MỘT file (0 = không giới hạn), xem core/parse_budget.py."""
+    max_seconds: float = 0       # Thời gian parse (lần quét đầu + resolve các câu hỏi)
+    max_blocks: int = 0          # Số block (đoạn văn, kể cả trong bảng)
+    max_runs: int = 0            # Tổng số phần tử con (run, hyperlink...) của các đoạn văn
+
+
+# --- PARSE INDEX ---
+# Mỗi block của file gốc được lấy text + phân loại regex MỘT lần; các bước parse sau chỉ đọc mảng này.
+
+@dataclass(frozen=True)
+class MarkSpans:
+    """
+    Các vùng ký tự được đánh dấu của một đoạn văn, tính một lần từ w:rPr.
+    text: nối text các run trực tiếp (không gồm hyperlink) - hệ tọa độ của bounds.
+    bounds: (đầu0, cuối0, đầu1, cuối1, ...) tăng dần, các vùng liền nhau đã được gộp.
+    """
+    text: str = ""
+    bounds: Tuple[int, ...] = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.bounds)
+
+    def covers(self, idx: int) -> bool:
+        """Ký tự thứ idx có nằm trong vùng đánh dấu không."""
+        return bisect_right(self.bounds, idx) % 2 == 1
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """Có ký tự đánh dấu nào trong [start, end) không."""
+        j = bisect_right(self.bounds, start)
+        if j % 2 == 1:
+            return True
+        return j < len(self.bounds) and self.bounds[j] < end
+
+
+NO_MARKS = MarkSpans()
+
+
+@dataclass
+class IndexedBlock:
+    kind: str                                   # "p" / "tbl"
+    block: object                               # Paragraph / Table của python-docx
+    text: str = ""                              # block.text
+    stripped: str = ""                          # text.strip()
+    role: str = "text"                          # Vai trò do BlockClassifier gán (ROLE_* trong constants)
+    label: str = ""                             # Số câu (question) / chữ cái phương án (option, sub_option)
+    starred: bool = False                       # Phương án đánh dấu "*"
+    label_end: int = 0                          # Vị trí kết thúc nhãn trong text
+    has_inline_options: bool = False            # Dòng bắt đầu bằng phương án và còn phương án khác phía sau
+    marks: MarkSpans = NO_MARKS                 # Vùng chữ gạch chân / tô đỏ / highlight (chỉ với "p")
+
+    @property
+    def element(self) -> OxmlElement:
+        return self.block._element
@@ -0,0 +1,169 @@
+import copy
+import io
+import struct
+import sys
+import zipfile
+import zlib
+from typing import List, Optional, Tuple
+
+from lxml import etree
+
+_LOCAL_HEADER_SIG = b"PK\x03\x04"
+_LOCAL_HEADER_SIZE = 30
+_FLAG_ENCRYPTED = 0x01
+_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP64_EXTRA_ID = 0x0001
+_RAW_COMPRESS_TYPES = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+
+# Ghi thô dựa vào thuộc tính nội bộ của zipfile.ZipFile -> chỉ bật trên các bản Python đã kiểm tra
+_RAW_WRITE_PYTHON = ((3, 8), (3, 13))
+_RAW_WRITE_ATTRS = ("fp", "filelist", "NameToInfo", "start_dir", "_seekable", "_didModify", "_writing")
+
+
+def _read_raw_entry(source_bytes: bytes, info: zipfile.ZipInfo) -> Optional[bytes]:
+    """Lấy nguyên bytes ĐÃ NÉN của một entry từ archive gốc (None nếu không copy thô được)."""
+    if info.flag_bits & _FLAG_ENCRYPTED or info.compress_type not in _RAW_COMPRESS_TYPES:
+        return None
+    if info.compress_size >= zipfile.ZIP64_LIMIT or info.file_size >= zipfile.ZIP64_LIMIT:
+        return None
+    offset = info.header_offset
+    header = source_bytes[offset:offset + _LOCAL_HEADER_SIZE]
+    if len(header) < _LOCAL_HEADER_SIZE or header[:4] != _LOCAL_HEADER_SIG:
+        return None
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    start = offset + _LOCAL_HEADER_SIZE + name_len + extra_len
+    raw = source_bytes[start:start + info.compress_size]
+    if len(raw) != info.compress_size:
+        return None
+    return raw
+
+
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    """Bỏ trường zip64 trong extra (ZipInfo.FileHeader tự thêm lại nếu cần)."""
+    out = b""
+    i = 0
+    while i + 4 <= len(extra):
+        tag, size = struct.unpack("<HH", extra[i:i + 4])
+        if tag != _ZIP64_EXTRA_ID:
+            out += extra[i:i + 4 + size]
+        i += 4 + size
+    return out
+
+
+def _supports_raw_write(out: zipfile.ZipFile) -> bool:
+    """Kiểm tra phiên bản Python + các thuộc tính nội bộ mà _write_raw_fast cần."""
+    if not _RAW_WRITE_PYTHON[0] <= sys.version_info[:2] <= _RAW_WRITE_PYTHON[1]:
+        return False
+    if not all(hasattr(out, attr) for attr in _RAW_WRITE_ATTRS):
+        return False
+    return out.mode in ("w", "x", "a") and isinstance(out.start_dir, int) and not out._writing
+
+
+def _write_raw_fast(out: zipfile.ZipFile, info: zipfile.ZipInfo, raw: bytes) -> None:
+    """Ghi local header + data đã nén trực tiếp, rồi đăng ký ZipInfo để central directory được ghi khi đóng file."""
+    zinfo = copy.copy(info)
+    # CRC và kích thước đã biết trước nên ghi thẳng vào local header, không cần data descriptor
+    zinfo.flag_bits &= ~_FLAG_DATA_DESCRIPTOR
+    zinfo.extra = _strip_zip64_extra(info.extra)
+    if out._seekable:
+        out.fp.seek(out.start_dir)
+    zinfo.header_offset = out.fp.tell()
+    out.fp.write(zinfo.FileHeader())
+    out.fp.write(raw)
+    out.filelist.append(zinfo)
+    out.NameToInfo[zinfo.filename] = zinfo
+    out.start_dir = out.fp.tell()
+    out._didModify = True
+
+
+def _write_raw_fallback(out: zipfile.ZipFile, info: zipfile.ZipInfo, raw: bytes) -> None:
+    """Giải nén data thô, đối chiếu CRC với entry gốc rồi ghi qua API public ZipFile.open(..., "w")."""
+    data = raw if info.compress_type == zipfile.ZIP_STORED else zlib.decompress(raw, -zlib.MAX_WBITS)
+    if zlib.crc32(data) != info.CRC or len(data) != info.file_size:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+    zinfo = copy.copy(info)
+    zinfo.flag_bits &= ~_FLAG_DATA_DESCRIPTOR
+    zinfo.extra = _strip_zip64_extra(info.extra)
+    with out.open(zinfo, "w") as dst:
+        dst.write(data)
+
+
+def write_raw_entry(out: zipfile.ZipFile, info: zipfile.ZipInfo, raw: bytes) -> None:
+    """
+    Ghi một entry đã nén sẵn (raw lấy từ _read_raw_entry) vào archive đích.
+    zipfile không có API public để ghi data đã nén nên đường nhanh dùng thuộc tính nội bộ của ZipFile,
+    chỉ khi phiên bản Python đã được kiểm tra và các thuộc tính đó còn tồn tại;
+    ngược lại giải nén + nén lại qua ZipFile.open (chậm hơn nhưng không phụ thuộc nội bộ zipfile).
+    """
+    if _supports_raw_write(out):
+        _write_raw_fast(out, info, raw)
+    else:
+        _write_raw_fallback(out, info, raw)
+
+
+def copy_entries(out: zipfile.ZipFile, source_bytes: bytes, skip: Tuple[str, ...] = ()) -> List[str]:
+    """Copy các entry của một archive có sẵn sang archive đích (không nén lại). Trả về tên các entry đã copy."""
+    copied = []
+    with zipfile.ZipFile(io.BytesIO(source_bytes)) as zf:
+        for info in zf.infolist():
+            if info.filename in skip:
+                continue
+            raw = _read_raw_entry(source_bytes, info)
+            if raw is not None:
+                write_raw_entry(out, info, raw)
+            else:
+                out.writestr(info, zf.read(info))
+            copied.append(info.filename)
+    return copied
+
+
+_RELS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_OFFICE_DOCUMENT_REL = "/officeDocument"
+
+
+def main_document_name(zf: zipfile.ZipFile) -> str:
+    """Tên entry của document part chính (theo _rels/.rels), mặc định word/document.xml."""
+    try:
+        root = etree.fromstring(zf.read("_rels/.rels"))
+    except KeyError:
+        return "word/document.xml"
+    for rel in root.iter(f"{_RELS_NS}Relationship"):
+        if rel.get("Type", "").endswith(_OFFICE_DOCUMENT_REL) and rel.get("TargetMode") != "External":
+            return rel.get("Target", "").lstrip("/")
+    return "word/document.xml"
+
+
+class DocxPackage:
+    """
+    Các part của file DOCX gốc, đọc MỘT lần cho cả job.
+    Giữa các mã đề chỉ có word/document.xml thay đổi, nên mỗi mã đề chỉ nén document part mới;
+    các part còn lại (media, styles, fonts...) được copy nguyên bytes đã nén từ archive gốc.
+    """
+
+    def __init__(self, source_bytes: bytes, document_name: str = "word/document.xml"):
+        self.document_name = document_name
+        # (info, raw đã nén hoặc None, data giải nén khi không copy thô được)
+        self.entries: List[Tuple[zipfile.ZipInfo, Optional[bytes], Optional[bytes]]] = []
+        with zipfile.ZipFile(io.BytesIO(source_bytes)) as zf:
+            for info in zf.infolist():
+                if info.filename == document_name:
+                    self.entries.append((info, None, None))
+                    continue
+                raw = _read_raw_entry(source_bytes, info)
+                self.entries.append((info, raw, zf.read(info) if raw is None else None))
+
+    def write(self, document_xml: bytes) -> bytes:
+        """Đóng gói DOCX mới: copy thô mọi part, chỉ nén document part mới."""
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as out:
+            for info, raw, data in self.entries:
+                if raw is not None:
+                    write_raw_entry(out, info, raw)
+                    continue
+                # Giữ nguyên metadata (tên, thời gian) của entry gốc -> output ổn định giữa các lần chạy
+                zinfo = copy.copy(info)
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                zinfo.flag_bits &= ~_FLAG_DATA_DESCRIPTOR
+                zinfo.extra = _strip_zip64_extra(info.extra)
+                out.writestr(zinfo, document_xml if info.filename == self.document_name else data)
+        return buf.getvalue()
@@ -0,0 +1,58 @@
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from .models import ParseLimits
+from exceptions import ParseBudgetExceededError
+
+NO_LIMITS = ParseLimits()
+
+
+class ParseBudget:
+    """
+    Ngân sách parse của một file: parser tự gọi charge() / check() trong các vòng lặp (cooperative),
+    vượt giới hạn -> ParseBudgetExceededError (không retry). File dị dạng (hàng nghìn run mỗi đoạn,
+    phương án inline trên mọi dòng) bị dừng sớm thay vì giữ worker tới hết visibility timeout.
+    Câu hỏi lazy giữ tham chiếu tới ngân sách của file, lúc resolve tiếp tục tính vào cùng ngân sách đó.
+    """
+
+    def __init__(self, limits: Optional[ParseLimits] = None):
+        self.limits = limits or NO_LIMITS
+        self.elapsed = 0.0
+        self.blocks = 0
+        self.runs = 0
+        self._resumed: Optional[float] = None
+
+    @contextmanager
+    def running(self):
+        """Đo thời gian parse của khối lệnh; lồng nhau thì chỉ khối ngoài cùng đo."""
+        if self._resumed is not None:
+            yield self
+            return
+        self._resumed = time.monotonic()
+        try:
+            self.check()
+            yield self
+        finally:
+            self.elapsed += time.monotonic() - self._resumed
+            self._resumed = None
+
+    def charge(self, blocks: int = 0, runs: int = 0) -> None:
+        self.blocks += blocks
+        self.runs += runs
+        limits = self.limits
+        if limits.max_blocks and self.blocks > limits.max_blocks:
+            raise ParseBudgetExceededError(f"File đề thi có quá nhiều đoạn văn (giới hạn {limits.max_blocks}).")
+        if limits.max_runs and self.runs > limits.max_runs:
+            raise ParseBudgetExceededError(f"File đề thi có định dạng quá phức tạp (giới hạn {limits.max_runs} run).")
+        self.check()
+
+    def check(self) -> None:
+        max_seconds = self.limits.max_seconds
+        if not max_seconds:
+            return
+        spent = self.elapsed
+        if self._resumed is not None:
+            spent += time.monotonic() - self._resumed
+        if spent > max_seconds:
+            raise ParseBudgetExceededError(f"Xử lý file đề thi vượt quá {max_seconds:g} giây.")
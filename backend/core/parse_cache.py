@@ -0,0 +1,221 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Dict, Optional
+
+from .models import ExamStructure, LazyQuestionBlock, OptionBlock, ParseLimits, QuestionBlock, Section
+from .parsers import PARSE_BACKEND_DOCX, PARSER_VERSION, parse_exam_template
+from .structure_format import STRUCTURE_FORMAT_VERSION, decode_structure, encode_structure
+
+logger = logging.getLogger("worker")
+
+
+# --- PARSE CACHE ---
+# Cùng một file DOCX được parse ở /api/preview rồi lại ở worker (và mỗi lần giáo viên preview lại).
+# Khóa = SHA-256 nội dung file + PARSER_VERSION + STRUCTURE_FORMAT_VERSION. Ba tầng: RAM (LRU theo dung lượng) -> thư mục -> S3.
+# Mọi tầng đều lưu bản đã serialize (core/structure_format.py): lấy ra luôn là bản sao mới, người gọi
+# sửa thoải mái (apply_answer_key đổi is_correct...) mà không ảnh hưởng cache. Phần tử XML chỉ được
+# dựng lại khi thực sự dùng tới (câu không được bốc, answers_only... không tốn công).
+# Khi cache miss, entry chỉ được ghi sau khi MỌI câu hỏi đã được resolve (thường là lúc bốc hoán vị / sinh đề),
+# để việc ghi cache không buộc parse hết các câu hỏi lazy ngay trong get_or_parse (xem _PendingEntry).
+
+def cache_key(source_bytes: bytes) -> str:
+    return f"{hashlib.sha256(source_bytes).hexdigest()}-p{PARSER_VERSION}f{STRUCTURE_FORMAT_VERSION}"
+
+
+class ParseCache:
+    """
+    max_bytes: dung lượng tối đa tầng RAM (tính theo bản serialize), 0 = tắt tầng RAM.
+    disk_dir: thư mục lưu cache (dùng chung giữa các process trên cùng máy), None = tắt.
+    s3_client + s3_bucket: tầng S3 dùng chung giữa server và worker, None = tắt.
+    parse_backend: cách parse khi cache miss (hai backend cho cùng kết quả nên dùng chung khóa).
+    parse_limits: ngân sách parse khi cache miss (ParseBudgetExceededError được ném thẳng cho người gọi).
+    Lỗi ở tầng disk/S3 chỉ được log, không bao giờ làm hỏng việc parse.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 s3_client=None, s3_bucket: Optional[str] = None, s3_prefix: str = "parse-cache/",
+                 parse_backend: str = PARSE_BACKEND_DOCX, parse_limits: Optional[ParseLimits] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.parse_backend = parse_backend
+        self.parse_limits = parse_limits
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "s3_hits": 0, "misses": 0, "evictions": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    # --- Public API ---
+
+    def get_or_parse(self, source_bytes: bytes,
+                     parse: Optional[Callable[[bytes], ExamStructure]] = None) -> ExamStructure:
+        key = cache_key(source_bytes)
+        data = self._lookup(key)
+        if data is not None:
+            try:
+                return decode_structure(data)
+            except Exception as e:
+                logger.warning(f"Parse cache entry {key} unreadable, re-parsing: {e}")
+        structure = parse(source_bytes) if parse else parse_exam_template(source_bytes, self.parse_backend, self.parse_limits)
+        _PendingEntry(self, key, structure)
+        return structure
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"] + self._counters["s3_hits"]
+            return dict(self._counters, hits=hits, entries=len(self._entries),
+                        bytes=self._size, max_bytes=self.max_bytes)
+
+    # --- Tiers ---
+
+    def _lookup(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return data
+
+        for tier, read in (("disk_hits", self._disk_read), ("s3_hits", self._s3_read)):
+            data = read(key)
+            if data is not None:
+                self._remember(key, data)
+                with self._lock:
+                    self._counters[tier] += 1
+                if tier == "s3_hits":
+                    self._disk_write(key, data)
+                return data
+
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def _store(self, key: str, data: bytes) -> None:
+        self._remember(key, data)
+        self._disk_write(key, data)
+        self._s3_write(key, data)
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._counters["evictions"] += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.bin")
+
+    def _disk_read(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Parse cache disk read failed ({key}): {e}")
+            return None
+
+    def _disk_write(self, key: str, data: bytes) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)  # Ghi nguyên tử: process khác không bao giờ đọc phải file dở
+        except OSError as e:
+            logger.warning(f"Parse cache disk write failed ({key}): {e}")
+
+    def _s3_read(self, key: str) -> Optional[bytes]:
+        if not self.s3_client or not self.s3_bucket:
+            return None
+        try:
+            resp = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_prefix + key)
+            return resp["Body"].read()
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            logger.warning(f"Parse cache S3 read failed ({key}): {e}")
+            return None
+
+    def _s3_write(self, key: str, data: bytes) -> None:
+        if not self.s3_client or not self.s3_bucket:
+            return
+        try:
+            self.s3_client.put_object(Bucket=self.s3_bucket, Key=self.s3_prefix + key, Body=data)
+        except Exception as e:
+            logger.warning(f"Parse cache S3 write failed ({key}): {e}")
+
+
+def _snapshot_question(q: QuestionBlock) -> QuestionBlock:
+    """Bản sao nông của câu hỏi vừa resolve: giữ is_correct / đáp án TRƯỚC khi người gọi sửa structure."""
+    return QuestionBlock(
+        original_idx=q.original_idx,
+        raw_label=q.raw_label,
+        stem_elements=q.stem_elements,
+        options=[OptionBlock(opt.label, opt.elements, opt.is_correct, opt.label_slot) for opt in q.options],
+        mode=q.mode,
+        correct_answer_text=q.correct_answer_text,
+        content_hash=q.content_hash,
+        label_slot=q.label_slot,
+    )
+
+
+class _PendingEntry:
+    """
+    Entry cache của một lần miss, được ghi khi câu hỏi cuối cùng của structure được resolve.
+    Mỗi câu được chụp lại ngay lúc resolve (trước mọi chỉnh sửa của người gọi: áp đáp án, lọc trùng...).
+    Câu hỏi không bao giờ được resolve -> entry không được ghi, lần sau parse lại.
+    """
+
+    def __init__(self, cache: ParseCache, key: str, structure: ExamStructure):
+        self.cache = cache
+        self.key = key
+        self.header_elements = structure.header_elements
+        self.footer_elements = structure.footer_elements
+        self.sections = [(sec.title, sec.info_elements, [None] * len(sec.questions)) for sec in structure.sections]
+        self.remaining = sum(len(questions) for _, _, questions in self.sections)
+        if not self.remaining:
+            self._write()
+            return
+        for sec_i, sec in enumerate(structure.sections):
+            for q_i, q in enumerate(list(sec.questions)):
+                if isinstance(q, LazyQuestionBlock):
+                    q.when_resolved(partial(self._capture, sec_i, q_i))
+                else:
+                    self._capture(sec_i, q_i, q)
+
+    def _capture(self, sec_i: int, q_i: int, q: QuestionBlock) -> None:
+        self.sections[sec_i][2][q_i] = _snapshot_question(q)
+        self.remaining -= 1
+        if not self.remaining:
+            self._write()
+
+    def _write(self) -> None:
+        structure = ExamStructure(
+            header_elements=self.header_elements,
+            sections=[Section(title, info, questions) for title, info, questions in self.sections],
+            footer_elements=self.footer_elements,
+        )
+        try:
+            self.cache._store(self.key, encode_structure(structure))
+        except Exception as e:
+            logger.warning(f"Parse cache store failed ({self.key}): {e}")
@@ -1,37 +1,105 @@
 import io
 import re
 import hashlib
+from functools import partial
 from typing import List, Tuple, Dict, Optional
 from docx import Document
 from docx.oxml import OxmlElement
 
 # Import internal modules
+from docx.oxml.text.paragraph import CT_P
+from docx.text.paragraph import Paragraph
 from .constants import (
-    SECTION_PATTERN, QUESTION_PATTERN, OPTION_START_PATTERN,
-    INLINE_OPTION_PATTERN, SUB_OPTION_PATTERN, END_NOTE_PATTERN, ANSWER_HEADER_PATTERN
+    OPTION_START_PATTERN, QUESTION_LABEL_PATTERN, INLINE_OPTION_PATTERN, ANSWER_TEXT_PATTERN, PREVIEW_TAG_PATTERN,
+    ANSWER_TABLE_QUESTION_PATTERN, ANSWER_TABLE_LETTER_PATTERN, ANSWER_TEXT_PAIR_PATTERN,
+    ROLE_SECTION, ROLE_QUESTION, ROLE_OPTION, ROLE_SUB_OPTION, ROLE_ANSWER_HEADER, ROLE_ANSWER_LINE, ROLE_END_NOTE
 )
-from .models import OptionBlock, QuestionBlock, Section, ExamStructure
-from .utils import (
-    _iter_block_items, _get_text, _build_paragraph_mask, _slice_paragraph_runs
-)
-from exceptions import AnswerKeyNotFoundError, EmptyQuestionError
+from .classifier import BlockClassifier
+from .parse_budget import ParseBudget
+from .models import OptionBlock, QuestionBlock, LazyQuestionBlock, ParseLimits, Section, ExamStructure, LabelSlot, IndexedBlock, MarkSpans, NO_MARKS
+from .utils import _iter_block_items, _iter_streamed_block_items, _get_text, _slice_paragraph_runs, _compute_label_cuts, _scan_paragraph
+from exceptions import AnswerKeyNotFoundError, EmptyQuestionError, InvalidExamFormatException
+
+# Phiên bản kết quả parse. TĂNG khi đổi bất kỳ chi tiết nào làm ExamStructure khác đi
+# (nhận diện câu/phương án, đáp án, label slot...) -> cache parse cũ tự động bị bỏ qua.
+PARSER_VERSION = 4
 
-# Note: _split_inline_options_smart logic was partly in utils and partly inline in original file.
-# I will implement _split_inline_options_smart fully here or rely on utils.
-# In utils above, I created _build_paragraph_mask. I need _split_inline_options_smart in utils or here.
-# Let's check utils again... I didn't put _split_inline_options_smart in utils content.
-# Only _build_paragraph_mask. 
-# So I should implement _split_inline_options_smart here using _build_paragraph_mask from utils.
+# Độ dài vân tay câu hỏi (content_hash, thẻ [ID:...] của preview): 8 byte = 16 ký tự hex
+FINGERPRINT_BYTES = 8
 
-def _generate_content_hash(text: str) -> str:
-    """Generate a short hash from question content for matching."""
-    # Normalize: lowercase, collapse whitespace, take first 200 chars
-    clean = re.sub(r'\s+', ' ', text).strip().lower()[:200]
-    return hashlib.md5(clean.encode('utf-8')).hexdigest()[:12]
+# Cách đọc file: cùng kết quả, khác chi phí
+PARSE_BACKEND_DOCX = "docx"        # Load cả package qua python-docx
+PARSE_BACKEND_STREAM = "stream"    # iterparse riêng document part, không đọc media -> ít RAM với file nhiều ảnh
 
+_CLASSIFIER = BlockClassifier()
 
-def _split_inline_options_smart(paragraph) -> Tuple[Optional[OxmlElement], List[dict]]:
-    full_text, mask = _build_paragraph_mask(paragraph)
+
+def _build_block_index(blocks, budget: Optional[ParseBudget] = None) -> List[IndexedBlock]:
+    """
+    Một lượt duy nhất qua tài liệu: text + phân loại regex của từng block được tính một lần.
+    blocks: các cặp (kind, block) theo thứ tự tài liệu (_iter_block_items / _iter_streamed_block_items).
+    """
+    index = []
+    for kind, block in blocks:
+        if budget:
+            budget.charge(blocks=1, runs=len(block._element))
+        if kind == "p":
+            # text + vùng đánh dấu lấy cùng một lượt qua w:p
+            text, marks = _scan_paragraph(block._element)
+        else:
+            text, marks = _get_text(block), NO_MARKS
+        stripped = text.strip()
+        role, label, starred, label_end, inline = _CLASSIFIER.classify(text, stripped)
+        index.append(IndexedBlock(
+            kind=kind,
+            block=block,
+            text=text,
+            stripped=stripped,
+            role=role,
+            label=label,
+            starred=starred,
+            label_end=label_end,
+            has_inline_options=inline,
+            marks=marks,
+        ))
+    return index
+
+
+def _question_fingerprint(chunk: List[IndexedBlock]) -> str:
+    """
+    Vân tay nội dung câu hỏi: BLAKE2b trên TOÀN BỘ text đã chuẩn hóa (stem + phương án) của các block,
+    bỏ nhãn "Câu N" -> đánh số lại không làm đổi vân tay.
+    """
+    h = hashlib.blake2b(digest_size=FINGERPRINT_BYTES)
+    head = chunk[0]
+    texts = [head.text[head.label_end:].lstrip(" :.")] + [ib.text for ib in chunk[1:]]
+    for text in texts:
+        norm = " ".join(text.split()).lower()
+        if norm:
+            h.update(norm.encode("utf-8"))
+            h.update(b"\x1f")
+    return h.hexdigest()
+
+
+def _disambiguate_fingerprints(questions) -> None:
+    """
+    Câu trùng vân tay trong cùng tài liệu (câu lặp lại, khác nhau ở hình/công thức) được băm lại kèm
+    số lần xuất hiện, theo thứ tự tài liệu -> preview và worker luôn ra cùng một ID cho từng câu.
+    """
+    seen = set()
+    for q in questions:
+        fingerprint = q.content_hash
+        n = 0
+        while fingerprint in seen:
+            n += 1
+            fingerprint = hashlib.blake2b(f"{q.content_hash}#{n}".encode("ascii"), digest_size=FINGERPRINT_BYTES).hexdigest()
+        seen.add(fingerprint)
+        q.content_hash = fingerprint
+
+
+def _split_inline_options_smart(paragraph, marks: MarkSpans,
+                                budget: Optional[ParseBudget] = None) -> Tuple[Optional[OxmlElement], List[dict]]:
+    full_text = marks.text
     matches = list(INLINE_OPTION_PATTERN.finditer(full_text))
     
     if not matches: return None, []
@@ -49,6 +117,8 @@ def _split_inline_options_smart(paragraph) -> Tuple[Optional[OxmlElement], List[
     results = []
     
     for i, match in enumerate(matches):
+        if budget:
+            budget.check()
         # Group 1: Asterisk before, Group 2: Letter, Group 3: Asterisk after
         asterisk_before = match.group(1)
         label = match.group(2).upper()
@@ -70,9 +140,7 @@ def _split_inline_options_smart(paragraph) -> Tuple[Optional[OxmlElement], List[
         if asterisk_before == '*' or asterisk_after == '*':
             is_marked = True
         # Check 2: Red/Underline mask
-        elif label_char_idx < len(mask) and mask[label_char_idx]:
-            is_marked = True
-        elif any(mask[start_idx:end_idx]):
+        elif marks.covers(label_char_idx) or marks.overlaps(start_idx, end_idx):
             is_marked = True
             
         results.append({"label": label, "element": rich_element, "is_marked": is_marked})
@@ -83,19 +151,13 @@ def _split_inline_options_smart(paragraph) -> Tuple[Optional[OxmlElement], List[
 from .utils import _slice_paragraph_runs
 
 
-def _extract_answers_from_blocks(blocks: List[Tuple[str, object]]) -> Dict[int, str]:
+def _extract_answers_from_blocks(blocks: List[IndexedBlock]) -> Dict[int, str]:
     """Quét đáp án từ một list các block (dùng cho phần ĐÁP ÁN bị cắt ra)"""
     answers_map = {}
-    q_pat = re.compile(r"^\s*(?:Câu)?\s*(\d+)[\.:]?\s*$")
-    a_pat = re.compile(r"^\s*([A-D])\s*$")
 
-    # Regex for text-based answers: "1. A", "1: A", "1 A", "Câu 1: A"
-    # Capture Group 1: Question Num, Group 2: Answer Letter
-    text_ans_pat = re.compile(r"(?:Câu|Bài)?\s*(\d+)[\.:\s-]*([A-D])\b", re.IGNORECASE)
-
-    for kind, block in blocks:
-        if kind == 'tbl':
-            table = block
+    for ib in blocks:
+        if ib.kind == 'tbl':
+            table = ib.block
             # Chiến thuật 1: Hàng ngang (Matrix)
             rows = table.rows
             for r in range(len(rows) - 1):
@@ -107,8 +169,8 @@ def _extract_answers_from_blocks(blocks: List[Tuple[str, object]]) -> Dict[int,
                 for c in range(min_cells):
                     txt_q = row_q.cells[c].text.strip()
                     txt_a = row_a.cells[c].text.strip()
-                    q_match = q_pat.match(txt_q)
-                    a_match = a_pat.match(txt_a)
+                    q_match = ANSWER_TABLE_QUESTION_PATTERN.match(txt_q)
+                    a_match = ANSWER_TABLE_LETTER_PATTERN.match(txt_a)
                     if q_match and a_match:
                         try:
                             temp_row_map[int(q_match.group(1))] = a_match.group(1).upper()
@@ -124,7 +186,7 @@ def _extract_answers_from_blocks(blocks: List[Tuple[str, object]]) -> Dict[int,
             idx = 0
             while idx < len(cells) - 1:
                 curr, nxt = cells[idx], cells[idx + 1]
-                q_match, a_match = q_pat.match(curr), a_pat.match(nxt)
+                q_match, a_match = ANSWER_TABLE_QUESTION_PATTERN.match(curr), ANSWER_TABLE_LETTER_PATTERN.match(nxt)
                 if q_match and a_match:
                     try:
                         q_num = int(q_match.group(1))
@@ -136,11 +198,11 @@ def _extract_answers_from_blocks(blocks: List[Tuple[str, object]]) -> Dict[int,
                 else:
                     idx += 1
         
-        elif kind == 'p':
+        elif ib.kind == 'p':
             # Chiến thuật 3: Text base (Paragraph)
             # Scan for all matches in the paragraph text
-            text = _get_text(block).strip()
-            matches = text_ans_pat.findall(text)
+            text = ib.stripped
+            matches = ANSWER_TEXT_PAIR_PATTERN.findall(text)
             if matches:
                  # logger.debug(f"Found matches in text: {matches[:5]}...")
                  for q_str, a_str in matches:
@@ -157,46 +219,19 @@ def _extract_answers_from_blocks(blocks: List[Tuple[str, object]]) -> Dict[int,
     return answers_map
 
 
-def _parse_mcq_options(chunk_elements: List[Tuple[str, object]]) -> List[OptionBlock]:
+def _parse_mcq_options(chunk_elements: List[IndexedBlock]) -> List[OptionBlock]:
     """Parse multiple choice options (A. B. C. D.)"""
     options = []
     opt_indices = []
     
     # 1. First pass: Find lines starting with A., B., etc.
-    for idx, (kind, block) in enumerate(chunk_elements):
-         if kind == "p":
-             text = _get_text(block).strip()
-             match = OPTION_START_PATTERN.match(text)
-             # DEBUG LOG
-             # try:
-             #    if "A." in text or "C." in text:
-             #        print(f"[DEBUG] Check Option Line: {repr(text)} -> Match: {bool(match)}")
-             # except: pass
-             
-             if match:
-                 # Group 1: *, Group 2: Letter
-                 asterisk = match.group(1)
-                 letter = match.group(2).upper()
-                 
-                 # --- FIX: INLINE OPTION DETECTION ---
-                 # If this line ALSO contains " B." or " C." etc., it might be an inline option line.
-                 # OPTION_START_PATTERN matches start of string.
-                 # Check if there are other matches of INLINE_OPTION_PATTERN in the REST of the text
-                 # excluding the start match.
-                 
-                 remaining_text = text[match.end():]
-                 if INLINE_OPTION_PATTERN.search(remaining_text):
-                      # Detect multiple options in this line -> Skip Block Parser
-                      # Let _fallback_inline_options handle it.
-                      continue
-                 # ------------------------------------
-                 
-                 try:
-                     # logger.debug(f"Found Vertical Option: {letter}")
-                     pass
-                 except: pass
-
-                 opt_indices.append((idx, letter, asterisk == '*'))
+    for idx, ib in enumerate(chunk_elements):
+         if ib.kind == "p" and ib.role == ROLE_OPTION:
+             # Dòng có nhiều phương án ("A. ... B. ...") -> Skip Block Parser,
+             # để _fallback_inline_options xử lý
+             if ib.has_inline_options:
+                 continue
+             opt_indices.append((idx, ib.label.upper(), ib.starred))
     
     if not opt_indices:
         return []
@@ -205,34 +240,23 @@ def _parse_mcq_options(chunk_elements: List[Tuple[str, object]]) -> List[OptionB
     split_points = [x[0] for x in opt_indices] + [len(chunk_elements)]
     for i, (start_idx, label, has_asterisk) in enumerate(opt_indices):
         end_idx = split_points[i + 1]
-        opt_elems = [blk._element for _, blk in chunk_elements[start_idx:end_idx]]
+        opt_blocks = chunk_elements[start_idx:end_idx]
+        opt_elems = [ib.element for ib in opt_blocks]
         
         # Check marking (red/underline) or asterisk
-        is_marked = has_asterisk
-        if not is_marked:
-            for blk_idx in range(start_idx, end_idx):
-                kind, blk = chunk_elements[blk_idx]
-                if kind == 'p' and any(_build_paragraph_mask(blk)[1]):
-                    is_marked = True
-                    break
+        is_marked = has_asterisk or any(ib.marks for ib in opt_blocks)
         options.append(OptionBlock(label, opt_elems, is_marked))
         
     return options
 
-def _parse_tf_options(chunk_elements: List[Tuple[str, object]]) -> List[OptionBlock]:
+def _parse_tf_options(chunk_elements: List[IndexedBlock]) -> List[OptionBlock]:
     """Parse True/False options (a) b) c) d))"""
     options = []
     opt_indices = []
     
-    for idx, (kind, block) in enumerate(chunk_elements):
-         if kind == "p":
-             text = _get_text(block).strip()
-             match = SUB_OPTION_PATTERN.match(text)
-             if match:
-                 # Group 1: *, Group 2: letter
-                 asterisk = match.group(1)
-                 letter = match.group(2).lower()
-                 opt_indices.append((idx, letter, asterisk == '*'))
+    for idx, ib in enumerate(chunk_elements):
+         if ib.kind == "p" and ib.role == ROLE_SUB_OPTION:
+             opt_indices.append((idx, ib.label.lower(), ib.starred))
                  
     if not opt_indices:
         return []
@@ -240,31 +264,27 @@ def _parse_tf_options(chunk_elements: List[Tuple[str, object]]) -> List[OptionBl
     split_points = [x[0] for x in opt_indices] + [len(chunk_elements)]
     for i, (start_idx, label, has_asterisk) in enumerate(opt_indices):
         end_idx = split_points[i + 1]
-        opt_elems = [blk._element for _, blk in chunk_elements[start_idx:end_idx]]
+        opt_blocks = chunk_elements[start_idx:end_idx]
+        opt_elems = [ib.element for ib in opt_blocks]
         
-        is_marked = has_asterisk
         # Also check for red/underline mask if needed for TF? Usually explicit text is better.
         # But let's keep consistency if user used color.
-        if not is_marked:
-             for blk_idx in range(start_idx, end_idx):
-                kind, blk = chunk_elements[blk_idx]
-                if kind == 'p' and any(_build_paragraph_mask(blk)[1]):
-                    is_marked = True
-                    break
+        is_marked = has_asterisk or any(ib.marks for ib in opt_blocks)
         
         options.append(OptionBlock(label, opt_elems, is_marked))
         
     return options
 
-def _fallback_inline_options(chunk_elements: List[Tuple[str, object]]) -> Tuple[List[OxmlElement], List[OptionBlock]]:
+def _fallback_inline_options(chunk_elements: List[IndexedBlock],
+                             budget: Optional[ParseBudget] = None) -> Tuple[List[OxmlElement], List[OptionBlock]]:
     """Try to find inline options (Câu 1: ... A. ... B. ...)"""
     stems = []
     options = []
     temp_options = []
     
-    for kind, block in chunk_elements:
-        if kind == 'p':
-            pre_elem, inline_ops = _split_inline_options_smart(block)
+    for ib in chunk_elements:
+        if ib.kind == 'p':
+            pre_elem, inline_ops = _split_inline_options_smart(ib.block, ib.marks, budget)
             
             if pre_elem:
                 stems.append(pre_elem)
@@ -278,7 +298,7 @@ def _fallback_inline_options(chunk_elements: List[Tuple[str, object]]) -> Tuple[
                  # If inline_ops is empty, pre_elem is None.
                  # So we append block._element.
                  if not pre_elem:
-                     if not temp_options: stems.append(block._element)
+                     if not temp_options: stems.append(ib.element)
                      # If temp_options has content, and this block has NO options?
                      # Then it's probably part of the last option? Or a new question text?
                      # _fallback_inline_options assumes if options started, subsequent blocks belong to options?
@@ -291,33 +311,31 @@ def _fallback_inline_options(chunk_elements: List[Tuple[str, object]]) -> Tuple[
                      # Actually `OptionBlock` has `elements` list.
                      # So if `temp_options` is not empty, we add to last option!
                      elif temp_options:
-                         temp_options[-1].elements.append(block._element)
+                         temp_options[-1].elements.append(ib.element)
                          
         else:
-            if not temp_options: stems.append(block._element)
-            elif temp_options: temp_options[-1].elements.append(block._element)
+            if not temp_options: stems.append(ib.element)
+            elif temp_options: temp_options[-1].elements.append(ib.element)
             
     if temp_options:
         return stems, temp_options
     return [], []
 
-def _parse_options(chunk_elements: List[Tuple[str, object]]) -> Tuple[str, List[OxmlElement], List[OptionBlock]]:
+def _parse_options(chunk_elements: List[IndexedBlock],
+                   budget: Optional[ParseBudget] = None) -> Tuple[str, List[OxmlElement], List[OptionBlock]]:
     """Master function to determine mode and parse options"""
     # 1. Try MCQ Block-based
     mcq_options = _parse_mcq_options(chunk_elements)
     if mcq_options:
         first_opt_lbl = mcq_options[0].label
         first_opt_idx = -1
-        for idx, (kind, block) in enumerate(chunk_elements):
-             if kind == 'p':
-                 text = _get_text(block).strip()
-                 m = OPTION_START_PATTERN.match(text)
-                 if m and m.group(2).upper() == first_opt_lbl:
-                     first_opt_idx = idx
-                     break
+        for idx, ib in enumerate(chunk_elements):
+             if ib.kind == 'p' and ib.role == ROLE_OPTION and ib.label.upper() == first_opt_lbl:
+                 first_opt_idx = idx
+                 break
         
         if first_opt_idx != -1:
-            stems = [blk._element for _, blk in chunk_elements[:first_opt_idx]]
+            stems = [ib.element for ib in chunk_elements[:first_opt_idx]]
             return "mcq", stems, mcq_options
 
     # 2. Try True/False Block-based
@@ -325,142 +343,197 @@ def _parse_options(chunk_elements: List[Tuple[str, object]]) -> Tuple[str, List[
     if tf_options:
         first_opt_lbl = tf_options[0].label
         first_opt_idx = -1
-        for idx, (kind, block) in enumerate(chunk_elements):
-             if kind == 'p':
-                 text = _get_text(block).strip()
-                 m = SUB_OPTION_PATTERN.match(text)
-                 if m and m.group(2).lower() == first_opt_lbl:
-                     first_opt_idx = idx
-                     break
+        for idx, ib in enumerate(chunk_elements):
+             if ib.kind == 'p' and ib.role == ROLE_SUB_OPTION and ib.label.lower() == first_opt_lbl:
+                 first_opt_idx = idx
+                 break
         if first_opt_idx != -1:
-            stems = [blk._element for _, blk in chunk_elements[:first_opt_idx]]
+            stems = [ib.element for ib in chunk_elements[:first_opt_idx]]
             return "true_false", stems, tf_options
 
     # 3. Try Inline Fallback
-    stems_inline, ops_inline = _fallback_inline_options(chunk_elements)
+    stems_inline, ops_inline = _fallback_inline_options(chunk_elements, budget)
     if ops_inline:
          if len(ops_inline) >= 2:
              return "mcq", stems_inline, ops_inline
 
     # 4. Explicit Short Answer (No options but valid question)
-    return "short", [blk._element for _, blk in chunk_elements], []
+    return "short", [ib.element for ib in chunk_elements], []
+
+
+def _compute_label_slots(q: QuestionBlock, paragraph_texts: Optional[Dict[OxmlElement, str]] = None) -> None:
+    """
+    Ghi lại vị trí nhãn câu hỏi / nhãn phương án MCQ để lúc sinh đề chỉ việc ghi đè (không regex).
+    paragraph_texts: text đã có trong block index (element -> Paragraph.text), tránh đọc lại.
+    """
+    paragraph_texts = paragraph_texts or {}
+    q.label_slot = LabelSlot(None)
+    for idx, el in enumerate(q.stem_elements):
+        if isinstance(el, CT_P):
+            cuts = _compute_label_cuts(Paragraph(el, None), QUESTION_LABEL_PATTERN, paragraph_texts.get(el))
+            if cuts is not None:
+                q.label_slot = LabelSlot(idx, cuts)
+                break
+
+    if q.mode == 'mcq':
+        for opt in q.options:
+            if opt.elements and isinstance(opt.elements[0], CT_P):
+                cuts = _compute_label_cuts(
+                    Paragraph(opt.elements[0], None), OPTION_START_PATTERN, paragraph_texts.get(opt.elements[0])
+                )
+                opt.label_slot = LabelSlot(0, cuts) if cuts is not None else LabelSlot(None)
+
+
+def _resolve_question(q: QuestionBlock, raw_chunk: List[IndexedBlock], table_answer: Optional[str] = None,
+                      budget: Optional[ParseBudget] = None) -> None:
+    """Phase 2: parse stem / phương án / đáp án của MỘT câu hỏi, tính vào ngân sách parse của cả file."""
+    budget = budget or ParseBudget()
+    with budget.running():
+        _parse_question(q, raw_chunk, table_answer, budget)
+
+
+def _parse_question(q: QuestionBlock, raw_chunk: List[IndexedBlock], table_answer: Optional[str],
+                    budget: ParseBudget) -> None:
+    """Parse các block của MỘT câu hỏi, ghi thẳng vào q."""
+    # Text của các element (stem / phương án) đã đọc, dùng lại cho dò "Đáp án" và content hash
+    element_texts: Dict[OxmlElement, str] = {}
+
+    def _element_text(el) -> str:
+        if el not in element_texts:
+            element_texts[el] = _get_text(el)
+        return element_texts[el]
+
+    mode, stems, opts = _parse_options(raw_chunk, budget)
+
+    # --- Extract correct_answer_text for ALL modes (fallback or primary for Short Answer) ---
+    ans_text = None
+    # Check "Đáp án: ..." in stems
+    idx_to_remove = -1
+    for idx, stem in enumerate(stems):
+         txt = _element_text(stem)
+         # Basic clean tags
+         txt_clean = PREVIEW_TAG_PATTERN.sub("", txt).strip()
+         # Expanded regex to capture "Lời giải", "Hướng dẫn", "HD", etc.
+         m_ans = ANSWER_TEXT_PATTERN.search(txt_clean)
+         if m_ans:
+             ans_text = m_ans.group(1).strip()
+             # Mark for removal if it's the only thing in the paragraph (or mostly)
+             # Determining if we should remove the whole paragraph:
+             # If the match covers most of the text?
+             # Simplifying: If it starts with the pattern, remove the whole paragraph for safety?
+             # Or just strip? Removing element is safer for Docx structure than modifying text inplace often.
+             if len(txt.strip()) < len(m_ans.group(0)) + 20: # Heuristic: Short line containing answer
+                 idx_to_remove = idx
+             break
+    
+    if idx_to_remove != -1:
+         stems.pop(idx_to_remove)
+
+    q.stem_elements = stems
+    q.options = opts
+    q.mode = mode  # FIX: Apply the detected mode (mcq, true_false, short)
+    q.correct_answer_text = ans_text
+    
+    # --- IMPROVEMENT: Check last option for "Đáp án: ..." if not found in stem ---
+    # "Đáp án: A" often appears at the very end, which _parse_options assigns to the last option.
+    if not q.correct_answer_text and q.options:
+        last_opt = q.options[-1]
+        idx_to_remove_opt = -1
+        
+        for idx, el in enumerate(last_opt.elements):
+            txt = _element_text(el)
+            m_ans = ANSWER_TEXT_PATTERN.search(txt)
+            if m_ans:
+                q.correct_answer_text = m_ans.group(1).strip()
+                # Remove this element from option
+                idx_to_remove_opt = idx
+                break
+        
+        if idx_to_remove_opt != -1:
+            last_opt.elements.pop(idx_to_remove_opt)
+
+
+    # --- FIX: Map correct_answer_text to options if not already marked ---
+    # This ensures that if the user provided "Đáp án: A", we treat Option A as correct
+    # so that generators.py can shuffle it correctly (instead of falling back to static "A").
+    has_marked = any(opt.is_correct for opt in q.options)
+    
+    if not has_marked and q.correct_answer_text:
+        # Clean text (remove special chars) to find "A", "B", "True", "False"
+        clean_ans = re.sub(r"[^a-zA-Z]", "", q.correct_answer_text).strip().upper()
+        
+        # Map for MCQ/TF
+        target_lbl = clean_ans
+        
+        for opt in q.options:
+            # Compare label (A, B...) or clean label
+            opt_lbl_clean = re.sub(r"[^a-zA-Z]", "", opt.label).strip().upper()
+            if opt_lbl_clean == target_lbl:
+                opt.is_correct = True
+                break
+
+    # Đáp án từ bảng đáp án (nếu có) thay cho mọi đánh dấu trong đề
+    if table_answer is not None:
+        for opt in q.options:
+            opt.is_correct = opt.label.upper().startswith(table_answer)
+
+    _compute_label_slots(q, {ib.element: ib.text for ib in raw_chunk if ib.kind == 'p'})
 
 
-def _parse_questions_in_range(blocks: List[Tuple[str, object]]) -> List[QuestionBlock]:
+def _parse_questions_in_range(blocks: List[IndexedBlock], table_answers: Dict[int, str],
+                              budget: ParseBudget) -> List[QuestionBlock]:
+    """
+    Phase 1: chỉ tìm ranh giới câu hỏi (đã có sẵn vai trò trong block index).
+    Mỗi câu hỏi là LazyQuestionBlock, phương án / đáp án chỉ được parse khi truy cập lần đầu.
+    """
     if not blocks: return []
-    q_indices = []
-    for idx, (kind, block) in enumerate(blocks):
-        if QUESTION_PATTERN.match(_get_text(block)): q_indices.append(idx)
+    q_indices = [idx for idx, ib in enumerate(blocks) if ib.role == ROLE_QUESTION]
     if not q_indices: return []
+
     questions = []
     for i, start in enumerate(q_indices):
         next_q_start = q_indices[i + 1] if i + 1 < len(q_indices) else len(blocks)
         raw_chunk = blocks[start:next_q_start]
-        first_text = _get_text(raw_chunk[0][1])
-        match = QUESTION_PATTERN.match(first_text)
-        q_num = int(match.group(1)) if match else 0
-        raw_label = match.group(0) if match else "Câu ?"
-        mode, stems, opts = _parse_options(raw_chunk)
-        
-        # --- Extract correct_answer_text for ALL modes (fallback or primary for Short Answer) ---
-        ans_text = None
-        # Check "Đáp án: ..." in stems
-        idx_to_remove = -1
-        for idx, stem in enumerate(stems):
-             txt = _get_text(stem)
-             # Basic clean tags
-             txt_clean = re.sub(r"\[![a-z]:|\]", "", txt).strip()
-             # Expanded regex to capture "Lời giải", "Hướng dẫn", "HD", etc.
-             m_ans = re.search(r"(?:Đáp án|ĐÁP ÁN|Dap an|Lời giải|Lơi giải|Loi giai|Hướng dẫn|Huong dan|HD)[:\.]?\s*(.*)", txt_clean, re.IGNORECASE)
-             if m_ans:
-                 ans_text = m_ans.group(1).strip()
-                 # Mark for removal if it's the only thing in the paragraph (or mostly)
-                 # Determining if we should remove the whole paragraph:
-                 # If the match covers most of the text?
-                 # Simplifying: If it starts with the pattern, remove the whole paragraph for safety?
-                 # Or just strip? Removing element is safer for Docx structure than modifying text inplace often.
-                 if len(txt.strip()) < len(m_ans.group(0)) + 20: # Heuristic: Short line containing answer
-                     idx_to_remove = idx
-                 break
-        
-        if idx_to_remove != -1:
-             stems.pop(idx_to_remove)
-
-        questions.append(QuestionBlock(
-            original_idx=q_num,
-            raw_label=raw_label,
-            stem_elements=stems,
-            options=opts,
-            mode=mode,  # FIX: Apply the detected mode (mcq, true_false, short)
-            correct_answer_text=ans_text
+        head = raw_chunk[0]
+        q_num = int(head.label) if head.role == ROLE_QUESTION else 0
+        raw_label = head.text[:head.label_end] if head.role == ROLE_QUESTION else "Câu ?"
+        questions.append(LazyQuestionBlock(
+            q_num, raw_label, _question_fingerprint(raw_chunk), partial(_resolve_question, raw_chunk=raw_chunk, table_answer=table_answers.get(q_num), budget=budget)
         ))
-        
-        # --- Generate Content Hash for reliable matching ---
-        stem_text_parts = []
-        for el in stems:
-            txt = _get_text(el)
-            if txt:
-                stem_text_parts.append(txt)
-        stem_text = " ".join(stem_text_parts) if stem_text_parts else first_text
-        questions[-1].content_hash = _generate_content_hash(stem_text)
-
-        # --- IMPROVEMENT: Check last option for "Đáp án: ..." if not found in stem ---
-        # "Đáp án: A" often appears at the very end, which _parse_options assigns to the last option.
-        if not questions[-1].correct_answer_text and questions[-1].options:
-            last_opt = questions[-1].options[-1]
-            idx_to_remove_opt = -1
-            
-            for idx, el in enumerate(last_opt.elements):
-                txt = _get_text(el) 
-                m_ans = re.search(r"(?:Đáp án|ĐÁP ÁN|Dap an|Lời giải|Lơi giải|Loi giai|Hướng dẫn|Huong dan|HD)[:\.]?\s*(.*)", txt, re.IGNORECASE)
-                if m_ans:
-                    questions[-1].correct_answer_text = m_ans.group(1).strip()
-                    # Remove this element from option
-                    idx_to_remove_opt = idx
-                    break
-            
-            if idx_to_remove_opt != -1:
-                last_opt.elements.pop(idx_to_remove_opt)
-
-
-        # --- FIX: Map correct_answer_text to options if not already marked ---
-        # This ensures that if the user provided "Đáp án: A", we treat Option A as correct
-        # so that generators.py can shuffle it correctly (instead of falling back to static "A").
-        q_obj = questions[-1]
-        has_marked = any(opt.is_correct for opt in q_obj.options)
-        
-        if not has_marked and q_obj.correct_answer_text:
-            # Clean text (remove special chars) to find "A", "B", "True", "False"
-            clean_ans = re.sub(r"[^a-zA-Z]", "", q_obj.correct_answer_text).strip().upper()
-            
-            # Map for MCQ/TF
-            target_lbl = clean_ans
-            
-            for opt in q_obj.options:
-                # Compare label (A, B...) or clean label
-                opt_lbl_clean = re.sub(r"[^a-zA-Z]", "", opt.label).strip().upper()
-                if opt_lbl_clean == target_lbl:
-                    opt.is_correct = True
-                    break
     
     return questions
 
 
-def parse_exam_template(source_bytes: bytes) -> ExamStructure:
-    doc = Document(io.BytesIO(source_bytes))
-    all_blocks = list(_iter_block_items(doc))
+def parse_exam_template(source_bytes: bytes, backend: str = PARSE_BACKEND_DOCX,
+                        limits: Optional[ParseLimits] = None) -> ExamStructure:
+    """
+    limits: giới hạn thời gian / số block / số run (ParseBudgetExceededError khi vượt).
+    Câu hỏi vẫn được parse lazy: ngân sách đi theo từng câu và được tính tiếp mỗi lần resolve,
+    nên lỗi vượt ngân sách có thể nổ lúc sinh đề (chỉ với các câu thực sự được dùng).
+    """
+    budget = ParseBudget(limits)
+    with budget.running():
+        return _parse_exam_template(source_bytes, backend, budget)
+
+
+def _parse_exam_template(source_bytes: bytes, backend: str, budget: ParseBudget) -> ExamStructure:
+    # Đọc text + phân loại mọi block MỘT lần, các bước dưới chỉ duyệt mảng này
+    if backend == PARSE_BACKEND_STREAM:
+        try:
+            all_blocks = _build_block_index(_iter_streamed_block_items(source_bytes), budget)
+        except KeyError:
+            # Thiếu document part
+            raise InvalidExamFormatException()
+    else:
+        all_blocks = _build_block_index(_iter_block_items(Document(io.BytesIO(source_bytes))), budget)
 
     # 1. Tách phần "ĐÁP ÁN" (để lấy dữ liệu và XÓA khỏi đề thi)
     main_blocks = []
     answer_key_blocks = []
 
     found_answer_header = False
-    for idx, (kind, block) in enumerate(all_blocks):
-        text = _get_text(block).strip()
-        # Debug log
-        # if "ĐÁP ÁN" in text.upper(): print(f"[DEBUG] Check Header: '{text}' -> Match: {bool(ANSWER_HEADER_PATTERN.match(text))}")
-        
-        if ANSWER_HEADER_PATTERN.match(text):
+    for idx, ib in enumerate(all_blocks):
+        if ib.role == ROLE_ANSWER_HEADER:
             # logger.debug(f"Found Answer Header at index {idx}")
             main_blocks = all_blocks[:idx]
             answer_key_blocks = all_blocks[idx:]
@@ -481,9 +554,8 @@ def parse_exam_template(source_bytes: bytes) -> ExamStructure:
     footer_start_idx = len(main_blocks)
 
     # Tìm footer marker ("HẾT")
-    # Tìm footer marker ("HẾT")
-    for idx, (kind, block) in enumerate(main_blocks):
-        if END_NOTE_PATTERN.search(_get_text(block)):
+    for idx, ib in enumerate(main_blocks):
+        if ib.role == ROLE_END_NOTE:
             # Found "HẾT". Check if next blocks are "Đáp án: ..." belonging to the previous question
             # If so, we delay the footer start.
             is_real_footer = True
@@ -491,14 +563,13 @@ def parse_exam_template(source_bytes: bytes) -> ExamStructure:
             # Peek ahead
             peek_idx = idx + 1
             while peek_idx < len(main_blocks):
-                peek_block = main_blocks[peek_idx][1]
-                peek_text = _get_text(peek_block).strip()
-                if not peek_text: 
+                peek = main_blocks[peek_idx]
+                if not peek.stripped: 
                     peek_idx += 1
                     continue
                 
                 # Check if it looks like an answer line
-                if re.match(r"^(?:Đáp án|ĐÁP ÁN|Dap an)[:\.]", peek_text, re.IGNORECASE):
+                if peek.role == ROLE_ANSWER_LINE:
                     # It matches! Include this block (and the HẾT block?) in content?
                     # Ideally "HẾT" should be footer, but if we include text AFTER it, "HẾT" must be in content too
                     # or we skip HẾT and add text? NO, order matters.
@@ -533,72 +604,64 @@ def parse_exam_template(source_bytes: bytes) -> ExamStructure:
     if not found_answer_header:
         # Scan footer blocks for tables that look like answer keys
         temp_footer_answ_blocks = []
-        for kind, block in raw_footer_blocks:
-            if kind == 'tbl':
+        for ib in raw_footer_blocks:
+            if ib.kind == 'tbl':
                 # Thử extract từ bảng này
-                mini_map = _extract_answers_from_blocks([(kind, block)])
+                mini_map = _extract_answers_from_blocks([ib])
                 if len(mini_map) >= 5:  # Ngưỡng tin cậy: bảng có >5 đáp án
                     footer_answers.update(mini_map)
                     # KHÔNG thêm vào clean_footer -> XÓA
                     continue
-            clean_footer_elements.append(block._element)
+            clean_footer_elements.append(ib.element)
         table_answers.update(footer_answers)
     else:
-        clean_footer_elements = [blk._element for _, blk in raw_footer_blocks]
+        clean_footer_elements = [ib.element for ib in raw_footer_blocks]
 
     structure.footer_elements = clean_footer_elements
 
-    # 4. Chia Section (Phần I, Phần II...)
-    section_starts = []
-    for idx, (_, block) in enumerate(content_blocks):
-        if SECTION_PATTERN.match(_get_text(block)): section_starts.append(idx)
+    # 4. Chia Section (Phần I, Phần II...): (tiêu đề, phần hướng dẫn, các block câu hỏi)
+    section_starts = [idx for idx, ib in enumerate(content_blocks) if ib.role == ROLE_SECTION]
+    section_ranges = []
 
     if not section_starts:
         first_q_idx = 0
-        for idx, (_, block) in enumerate(content_blocks):
-            if QUESTION_PATTERN.match(_get_text(block)):
+        for idx, ib in enumerate(content_blocks):
+            if ib.role == ROLE_QUESTION:
                 first_q_idx = idx
                 break
-        structure.header_elements = [blk._element for _, blk in content_blocks[:first_q_idx]]
-        qs = _parse_questions_in_range(content_blocks[first_q_idx:])
-        structure.sections.append(Section("", [], qs))
+        structure.header_elements = [ib.element for ib in content_blocks[:first_q_idx]]
+        section_ranges.append(("", [], content_blocks[first_q_idx:]))
     else:
-        structure.header_elements = [blk._element for _, blk in content_blocks[:section_starts[0]]]
+        structure.header_elements = [ib.element for ib in content_blocks[:section_starts[0]]]
         for i, start_idx in enumerate(section_starts):
             end_idx = section_starts[i + 1] if i + 1 < len(section_starts) else len(content_blocks)
             sec_blocks = content_blocks[start_idx:end_idx]
 
             # Lấy title chính xác
-            title_block = sec_blocks[0][1]
-            title_text = _get_text(title_block)
+            title_text = sec_blocks[0].text
 
             q_start = len(sec_blocks)
-            for j, (_, blk) in enumerate(sec_blocks):
+            for j, ib in enumerate(sec_blocks):
                 if j == 0: continue
-                if QUESTION_PATTERN.match(_get_text(blk)):
+                if ib.role == ROLE_QUESTION:
                     q_start = j
                     break
-            info = [blk._element for _, blk in sec_blocks[1:q_start]]
-            qs = _parse_questions_in_range(sec_blocks[q_start:])
-            structure.sections.append(Section(title_text, info, qs))
+            info = [ib.element for ib in sec_blocks[1:q_start]]
+            section_ranges.append((title_text, info, sec_blocks[q_start:]))
+
+    for title_text, info, q_blocks in section_ranges:
+        structure.sections.append(Section(title_text, info, _parse_questions_in_range(q_blocks, table_answers, budget)))
+
+    # Vân tay (content_hash) phải duy nhất trong cả tài liệu: đáp án từ Editor được khớp theo nó
+    _disambiguate_fingerprints(q for sec in structure.sections for q in sec.questions)
 
     # 5. Validate Validation
     total_questions = sum(len(sec.questions) for sec in structure.sections)
     if total_questions == 0:
         raise EmptyQuestionError("Không tìm thấy bất kỳ câu hỏi nào (bắt đầu bằng 'Câu', 'Bài').")
 
-    # 6. Merge đáp án từ bảng vào câu hỏi
-    if table_answers:
-        for sec in structure.sections:
-            for q in sec.questions:
-                if q.original_idx in table_answers:
-                    correct_char = table_answers[q.original_idx]
-                    for opt in q.options:
-                        if opt.label.upper().startswith(correct_char):
-                            opt.is_correct = True
-                        else:
-                            opt.is_correct = False
-    
+    # 6. Đáp án từ bảng được gộp vào từng câu hỏi lúc resolve (_resolve_question).
+    # Kiểm tra đáp án inline dừng ở câu đầu tiên có đáp án -> chỉ resolve vài câu đầu.
     if not table_answers and not footer_answers:
          # Check if any question has answers marked inline (underline/red)
          has_inline_answers = False
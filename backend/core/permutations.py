@@ -0,0 +1,472 @@
+import hashlib
+import math
+from dataclasses import dataclass
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from exceptions import VariantCapacityError
+from .generators import MCQ_LABELS, TF_LABELS, _draw_count, _option_labels, check_draw_counts
+from .models import ExamStructure, QuestionView, VariantPlan
+
+# Phiên bản thuật toán bốc thăm. TĂNG khi đổi bất kỳ chi tiết nào ảnh hưởng tới hoán vị sinh ra
+# (cách dẫn xuất seed, thứ tự rút số, cách sắp xếp) -> job cũ vẫn tái tạo được theo version đã ghi.
+PERMUTATION_VERSION = 4
+
+_STREAM_QUESTIONS = 0
+_STREAM_OPTIONS = 1
+_STREAM_BALANCE = 2
+_STREAM_DIVERSE = 3
+_STREAM_DRAW = 4
+_STREAM_UNIQUE = 5
+
+# diverse: số thứ tự ngẫu nhiên thử cho mỗi mã đề (lấy thứ tự ít trùng nhất với các mã đề trước)
+_DIVERSE_CANDIDATES = 16
+# Trần số lần bốc lại khi hai mã đề trùng nhau
+_MAX_REDRAWS = 100_000
+
+# Mã đáp án dùng cho bảng tra: MCQ = vị trí phương án đúng đầu tiên (len(MCQ_LABELS) = không có),
+# TF = bitmask Đ/S theo vị trí mới. Bảng đủ rộng cho cả hai loại.
+_ANSWER_CODES = max(len(MCQ_LABELS) + 1, 1 << len(TF_LABELS))
+
+
+def job_entropy(job_id: str, version: int = PERMUTATION_VERSION) -> int:
+    """Entropy của job: SHA-256 (ổn định giữa các process / máy, khác với hash() của Python)."""
+    digest = hashlib.sha256(f"exam-permutation-v{version}:{job_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _stream(entropy: int, sec_i: int, kind: int, sub: Optional[int] = None) -> np.random.Generator:
+    """
+    Luồng PRNG riêng cho từng (phần, loại hoán vị) -> thêm/bớt phần khác không làm lệch phần này.
+    sub: luồng riêng của một câu trong phần (vd: hoán vị phương án) -> không phụ thuộc các câu khác.
+    """
+    spawn_key = (sec_i, kind) if sub is None else (sec_i, kind, sub)
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(entropy, spawn_key=spawn_key)))
+
+
+def _variant_stream(entropy: int, sec_i: int, kind: int, v: int) -> np.random.Generator:
+    """Luồng PRNG riêng của một mã đề -> dùng cho các thuật toán tuần tự theo mã đề."""
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(entropy, spawn_key=(sec_i, kind, v))))
+
+
+def _draw_bank(entropy: int, sec_i: int, n: int, k: int, stop: int) -> np.ndarray:
+    """
+    Bốc k trong n câu của ngân hàng cho các mã đề [0, stop): (stop, k), các câu theo thứ tự gốc.
+    Mỗi mã đề dùng luồng PRNG riêng (theo chỉ số mã đề) làm khóa tie-break và lấy k câu đã được
+    dùng ít lần nhất -> số lần dùng của các câu chênh nhau tối đa 1, bộ câu của các mã đề không lặp theo chu kỳ.
+    Mã đề v phụ thuộc số lần dùng của các mã đề trước nên luôn bốc lại từ mã đề 0 (rẻ: O(stop * n log n)).
+    """
+    usage = np.zeros(n, dtype=np.int64)
+    selected = np.empty((stop, k), dtype=np.int64)
+    for v in range(stop):
+        rng = _variant_stream(entropy, sec_i, _STREAM_DRAW, v)
+        picked = np.lexsort((rng.random(n), usage))[:k]
+        usage[picked] += 1
+        selected[v] = np.sort(picked)
+    return selected
+
+
+def _draw(entropy: int, sec_i: int, kind: int, start: int, shape: tuple, sub: Optional[int] = None) -> np.ndarray:
+    """
+    Rút shape = (số mã đề, ...) số ngẫu nhiên cho các mã đề [start, start + số mã đề).
+    Mỗi mã đề tiêu thụ đúng prod(shape[1:]) số theo thứ tự -> mã đề thứ v luôn nhận cùng một dãy,
+    không phụ thuộc tổng số mã đề hay cách chia shard.
+    """
+    rng = _stream(entropy, sec_i, kind, sub)
+    per_variant = int(np.prod(shape[1:], dtype=np.int64))
+    if start and per_variant:
+        rng.bit_generator.advance(start * per_variant)
+    return rng.random(shape)
+
+
+@dataclass
+class SectionPermutations:
+    question_order: np.ndarray   # (V, k): question_order[v, vị trí mới] = chỉ số câu trong Section.questions (k <= n khi bốc đề)
+    option_order: np.ndarray     # (V, n, m): option_order[v, câu gốc, vị trí mới] = chỉ số phương án gốc
+    option_counts: np.ndarray    # (n,): số phương án thật của từng câu (phần sau là padding; 0 = câu không có trong batch)
+
+
+@dataclass
+class PermutationBatch:
+    """Hoán vị của MỌI mã đề trong một job, dạng ma trận."""
+    version: int
+    start: int
+    sections: List[SectionPermutations]
+    answers: np.ndarray          # (V, tổng số câu) đáp án theo thứ tự câu trong mã đề (object/str)
+    question_map: np.ndarray     # (V, tổng số câu) chỉ số câu GỐC (đánh liên tục qua các phần)
+    answer_counts: np.ndarray    # (V, len(MCQ_LABELS)) số câu MCQ có đáp án A, B, C... trong từng mã đề
+
+    @property
+    def num_variants(self) -> int:
+        return self.answers.shape[0]
+
+    def answer_rows(self) -> List[List[str]]:
+        return self.answers.tolist()
+
+    def answer_distribution(self) -> List[Dict[str, int]]:
+        """Phân bố đáp án MCQ theo từng mã đề: [{'A': 10, 'B': 10, ...}, ...]."""
+        return [dict(zip(MCQ_LABELS, row)) for row in self.answer_counts.tolist()]
+
+    def plan(self, v: int, structure: ExamStructure) -> VariantPlan:
+        """VariantPlan của mã đề thứ v (trong batch) để render."""
+        sections = []
+        col = 0
+        for sec_i, (sec, perms) in enumerate(zip(structure.sections, self.sections)):
+            views = []
+            for q_i in perms.question_order[v].tolist():
+                count = int(perms.option_counts[q_i])
+                opt_order = tuple(perms.option_order[v, q_i, :count].tolist())
+                views.append(QuestionView(
+                    section_idx=sec_i,
+                    question_idx=q_i,
+                    number=col + 1,
+                    option_order=opt_order,
+                    option_labels=_option_labels(sec.questions[q_i], count),
+                    answer=self.answers[v, col],
+                ))
+                col += 1
+            sections.append(tuple(views))
+        return VariantPlan(sections=tuple(sections))
+
+
+def _answer_table(questions: Sequence, used: np.ndarray) -> np.ndarray:
+    """Bảng tra (n, _ANSWER_CODES): đáp án dạng chuỗi theo mã đáp án của từng câu (chỉ điền các câu used)."""
+    table = np.full((len(questions), _ANSWER_CODES), "", dtype=object)
+    for q_i in used.tolist():
+        q = questions[q_i]
+        fallback = q.correct_answer_text or ""
+        if q.mode == 'mcq':
+            row = list(MCQ_LABELS) + [fallback] * (_ANSWER_CODES - len(MCQ_LABELS))
+        elif q.mode == 'true_false':
+            # Không có phương án -> chuỗi rỗng -> fallback như _answer_for_order
+            width = min(len(q.options), len(TF_LABELS))
+            row = [
+                "".join("Đ" if code >> k & 1 else "S" for k in range(width)) or fallback
+                for code in range(_ANSWER_CODES)
+            ]
+        else:
+            row = [fallback] * _ANSWER_CODES
+        table[q_i] = row
+    return table
+
+
+def _is_mcq(questions: Sequence, used: np.ndarray) -> np.ndarray:
+    is_mcq = np.zeros(len(questions), dtype=bool)
+    is_mcq[used] = [questions[q_i].mode == 'mcq' for q_i in used.tolist()]
+    return is_mcq
+
+
+def _section_answer_codes(questions: Sequence, used: np.ndarray, option_order: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Mã đáp án (V, n) theo câu GỐC, tính bằng indexing trên ma trận hoán vị (chỉ đọc các câu used)."""
+    n, m = option_order.shape[1], option_order.shape[2]
+    correct = np.zeros((n, m), dtype=bool)
+    for q_i in used.tolist():
+        options = questions[q_i].options
+        correct[q_i, :len(options)] = [opt.is_correct for opt in options]
+    # permuted[v, q, k] = phương án ở vị trí mới k của câu q có đúng không (padding luôn False)
+    permuted = correct[np.arange(n)[None, :, None], option_order]
+    permuted &= np.arange(m)[None, None, :] < counts[None, :, None]
+
+    is_mcq = _is_mcq(questions, used)
+    n_mcq = min(m, len(MCQ_LABELS))
+    mcq_hits = permuted[:, :, :n_mcq]
+    mcq_codes = np.where(mcq_hits.any(axis=2), mcq_hits.argmax(axis=2), len(MCQ_LABELS))
+
+    n_tf = min(m, len(TF_LABELS))
+    weights = (1 << np.arange(n_tf)).astype(np.int64)
+    tf_codes = (permuted[:, :, :n_tf] * weights).sum(axis=2)
+
+    return np.where(is_mcq[None, :], mcq_codes, tf_codes)
+
+
+def _balance_answers(
+        structure: ExamStructure, sections: List[SectionPermutations], entropy: int, start: int, V: int
+) -> Set[Tuple[int, int]]:
+    """
+    Dàn đều vị trí đáp án đúng trong TỪNG mã đề (sửa trực tiếp option_order), trả về các câu (phần, câu gốc) đã dàn.
+    Các câu MCQ có đúng một phương án đúng được gom theo số nhãn k; mỗi nhóm g câu nhận
+    một dãy vị trí đích cân bằng (mỗi nhãn g // k hoặc g // k + 1 lần), chia ngẫu nhiên cho các câu.
+    Sau đó đổi chỗ phương án đúng với phương án đang đứng ở vị trí đích -> O(V * số câu), không thử lại.
+    Khi bốc đề từ ngân hàng, chỉ các câu được bốc vào mã đề mới được đọc và tính hạng trong nhóm; khóa hạng
+    của mỗi câu lấy từ luồng riêng của câu đó -> mã đề không phụ thuộc những câu nào khác có trong batch.
+    """
+    chosen = []
+    for perms in sections:
+        mask = np.zeros((V, perms.option_order.shape[1]), dtype=bool)
+        mask[np.arange(V)[:, None], perms.question_order] = True
+        chosen.append(mask)
+
+    groups: Dict[int, list] = defaultdict(list)
+    for sec_i, sec in enumerate(structure.sections):
+        for q_i in np.flatnonzero(chosen[sec_i].any(axis=0)).tolist():
+            q = sec.questions[q_i]
+            correct = [i for i, opt in enumerate(q.options) if opt.is_correct]
+            k = min(len(q.options), len(MCQ_LABELS))
+            if q.mode == 'mcq' and len(correct) == 1 and k >= 2:
+                groups[k].append((sec_i, q_i, correct[0]))
+
+    rows = np.arange(V)
+    for k, members in sorted(groups.items()):
+        # Nhãn nhận thêm phần dư xoay vòng theo mã đề (không phải lúc nào cũng là A, B)
+        offset = (_draw(entropy, k, _STREAM_BALANCE, start, (V,)) * k).astype(np.int64)
+        # Hạng ngẫu nhiên của từng câu trong nhóm, đánh liên tục 0..s-1 trên các câu có mặt trong mã đề
+        keys = np.stack([
+            _draw(entropy, sec_i, _STREAM_BALANCE, start, (V,), sub=q_i) for sec_i, q_i, _ in members
+        ], axis=1)
+        present = np.stack([chosen[sec_i][:, q_i] for sec_i, q_i, _ in members], axis=1)
+        ranks = np.argsort(np.argsort(np.where(present, keys, np.inf), axis=1, kind="stable"), axis=1, kind="stable")
+        targets = (ranks + offset[:, None]) % k
+
+        for j, (sec_i, q_i, correct_idx) in enumerate(members):
+            order = sections[sec_i].option_order[:, q_i, :]
+            current = np.argmax(order == correct_idx, axis=1)
+            target = targets[:, j]
+            moved = order[rows, target]
+            order[rows, target] = correct_idx
+            order[rows, current] = moved
+
+    return {(sec_i, q_i) for members in groups.values() for sec_i, q_i, _ in members}
+
+
+def _diverse_orders(selected: np.ndarray, n: int, entropy: int, sec_i: int) -> np.ndarray:
+    """
+    Thứ tự câu (V, k) của các mã đề [0, V), ít trùng nhau nhất có thể.
+    Mỗi mã đề thử _DIVERSE_CANDIDATES hoán vị ngẫu nhiên các câu của mình và giữ hoán vị có số cặp câu
+    liền kề trùng với mã đề trước GIỐNG NHẤT là nhỏ nhất (hòa thì xét tổng số cặp trùng) -> không bao giờ
+    kém hơn trộn ngẫu nhiên (ứng viên đầu tiên chính là một lần trộn), không lặp theo chu kỳ khi số mã đề lớn.
+    Mã đề v phụ thuộc các mã đề trước nên luôn tính từ mã đề 0.
+    """
+    V, k = selected.shape
+    owners: Dict[int, List[int]] = defaultdict(list)   # cặp liền kề (không phân biệt chiều) -> các mã đề chứa nó
+    orders = np.empty_like(selected)
+    for v in range(V):
+        rng = _variant_stream(entropy, sec_i, _STREAM_DIVERSE, v)
+        candidates = selected[v][np.argsort(rng.random((_DIVERSE_CANDIDATES, k)), axis=1)]
+        pairs = np.minimum(candidates[:, :-1], candidates[:, 1:]) * n + np.maximum(candidates[:, :-1], candidates[:, 1:])
+        best, best_score = 0, None
+        for c, row in enumerate(pairs.tolist()):
+            hits = [u for pair in row for u in owners.get(pair, ())]
+            shared = np.bincount(hits, minlength=1) if hits else np.zeros(1, dtype=np.int64)
+            score = (int(shared.max()), len(hits))
+            if best_score is None or score < best_score:
+                best, best_score = c, score
+        for pair in pairs[best].tolist():
+            owners[pair].append(v)
+        orders[v] = candidates[best]
+    return orders
+
+
+def _shuffled_options(structure: ExamStructure, sections: List[SectionPermutations], v: int):
+    """Các câu (phần, câu gốc, số phương án) có mặt trong mã đề v và được đảo phương án."""
+    for sec_i, (sec, perms) in enumerate(zip(structure.sections, sections)):
+        for q_i in sorted(perms.question_order[v].tolist()):
+            count = int(perms.option_counts[q_i])
+            if sec.questions[q_i].mode in ('mcq', 'true_false') and count >= 2:
+                yield sec_i, q_i, count
+
+
+def _redraw_capacity(
+        structure: ExamStructure, sections: List[SectionPermutations], v: int,
+        shuffle_questions: bool, shuffle_options: bool, balanced: Set[Tuple[int, int]]
+) -> int:
+    """Số mã đề khác nhau có thể có với đúng bộ câu của mã đề v (khi bốc lại thứ tự câu / phương án)."""
+    capacity = 1
+    if shuffle_questions:
+        for perms in sections:
+            capacity *= math.factorial(perms.question_order.shape[1])
+    if shuffle_options:
+        for sec_i, q_i, count in _shuffled_options(structure, sections, v):
+            # Câu đã dàn đều đáp án giữ nguyên vị trí phương án đúng
+            capacity *= math.factorial(count - 1 if (sec_i, q_i) in balanced else count)
+    return capacity
+
+
+def _redraw_variant(
+        structure: ExamStructure, sections: List[SectionPermutations], entropy: int, v: int, attempt: int,
+        shuffle_questions: bool, shuffle_options: bool, balanced: Set[Tuple[int, int]]
+) -> None:
+    """Bốc lại thứ tự câu / phương án của mã đề v (lần thử attempt), giữ nguyên bộ câu và vị trí đáp án đã dàn đều."""
+    rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(entropy, spawn_key=(_STREAM_UNIQUE, v, attempt))))
+    if shuffle_questions:
+        for perms in sections:
+            perms.question_order[v] = rng.permutation(perms.question_order[v])
+    if shuffle_options:
+        for sec_i, q_i, count in _shuffled_options(structure, sections, v):
+            row = sections[sec_i].option_order[v, q_i]
+            slots = np.arange(count)
+            if (sec_i, q_i) in balanced:
+                correct_idx = next(i for i, opt in enumerate(structure.sections[sec_i].questions[q_i].options) if opt.is_correct)
+                slots = slots[row[:count] != correct_idx]
+            row[slots] = rng.permutation(row[slots])
+
+
+def _ensure_unique(
+        structure: ExamStructure, sections: List[SectionPermutations], entropy: int, V: int,
+        shuffle_questions: bool, shuffle_options: bool, balanced: Set[Tuple[int, int]]
+) -> None:
+    """
+    Đảm bảo không có hai mã đề nào giống hệt nhau (thứ tự câu + thứ tự phương án), xét từ mã đề 0.
+    Mã đề trùng với một mã đề trước được bốc lại thứ tự phương án (và thứ tự câu) theo luồng PRNG
+    riêng của (mã đề, lần thử) -> tất định. Chỉ báo VariantCapacityError khi các mã đề trước đã dùng hết
+    mọi tổ hợp của bộ câu này.
+    """
+    for perms in sections:
+        perms.question_order = np.array(perms.question_order)  # Có thể là view broadcast (chỉ đọc)
+
+    def variant_key(v: int) -> bytes:
+        return b"".join(perms.question_order[v].tobytes() + perms.option_order[v].tobytes() for perms in sections)
+
+    correct = {
+        (sec_i, q_i): next(i for i, opt in enumerate(structure.sections[sec_i].questions[q_i].options) if opt.is_correct)
+        for sec_i, q_i in balanced
+    }
+
+    def variant_class(v: int) -> bytes:
+        """Bộ câu + vị trí đáp án đã dàn đều: những gì _redraw_variant giữ nguyên."""
+        targets = [
+            int(np.argmax(sections[sec_i].option_order[v, q_i] == correct[sec_i, q_i]))
+            for sec_i, q_i, _ in _shuffled_options(structure, sections, v) if (sec_i, q_i) in correct
+        ]
+        return b"".join(np.sort(perms.question_order[v]).tobytes() for perms in sections) + bytes(targets)
+
+    seen = set()
+    used = Counter()
+    for v in range(V):
+        question_set = variant_class(v)
+        key = variant_key(v)
+        if key in seen:
+            capacity = _redraw_capacity(structure, sections, v, shuffle_questions, shuffle_options, balanced)
+            if used[question_set] >= capacity:
+                raise VariantCapacityError()
+            for attempt in range(1, min(20 * capacity, _MAX_REDRAWS) + 1):
+                _redraw_variant(structure, sections, entropy, v, attempt, shuffle_questions, shuffle_options, balanced)
+                key = variant_key(v)
+                if key not in seen:
+                    break
+            else:
+                raise VariantCapacityError()
+        seen.add(key)
+        used[question_set] += 1
+
+
+def _tail(batch: PermutationBatch, start: int) -> PermutationBatch:
+    """Cắt batch tính từ mã đề 0 thành các mã đề [start, ...)."""
+    return PermutationBatch(
+        version=batch.version, start=start,
+        sections=[
+            SectionPermutations(perms.question_order[start:], perms.option_order[start:], perms.option_counts)
+            for perms in batch.sections
+        ],
+        answers=batch.answers[start:], question_map=batch.question_map[start:],
+        answer_counts=batch.answer_counts[start:],
+    )
+
+
+def plan_batch(
+        structure: ExamStructure, job_id: str, num_variants: int, start: int = 0,
+        shuffle_questions: bool = True, shuffle_options: bool = True,
+        balance_answers: bool = False,
+        diverse: bool = False,
+        draw_counts: Optional[Sequence[Optional[int]]] = None,
+        version: int = PERMUTATION_VERSION
+) -> PermutationBatch:
+    """
+    Bốc thăm hoán vị cho các mã đề [start, start + num_variants) của job cùng lúc.
+    Kết quả chỉ phụ thuộc (job_id, version, chỉ số mã đề) -> chia shard / chạy lại cho đúng cùng kết quả.
+    balance_answers: dàn đều đáp án đúng MCQ qua các nhãn A, B, C... trong mỗi mã đề.
+    diverse: chọn thứ tự câu hỏi bằng _diverse_orders và ĐẢM BẢO không có hai mã đề trùng nhau
+             (_ensure_unique; VariantCapacityError nếu đề không đủ câu để sinh ngần ấy mã đề khác nhau).
+             Mã đề v phụ thuộc các mã đề trước nên luôn tính từ mã đề 0 rồi cắt ra [start, ...).
+    draw_counts: số câu bốc từ mỗi phần (ngân hàng câu hỏi, check_draw_counts). Mỗi mã đề bốc ngẫu nhiên trong các câu
+                 được dùng ít nhất (_draw_bank) -> mọi câu được dùng đều nhau (chênh lệch tối đa 1 lần) qua các mã đề.
+    """
+    if version != PERMUTATION_VERSION:
+        raise ValueError(f"Unsupported permutation version: {version}")
+    check_draw_counts(structure, draw_counts)
+    if diverse and start:
+        full = plan_batch(
+            structure, job_id, start + num_variants, 0, shuffle_questions, shuffle_options,
+            balance_answers, diverse, draw_counts, version,
+        )
+        return _tail(full, start)
+    entropy = job_entropy(job_id, version)
+    V = num_variants
+
+    sections = []
+    used_questions = []
+    for sec_i, sec in enumerate(structure.sections):
+        questions = sec.questions
+        n = len(questions)
+        k = _draw_count(draw_counts, sec_i, n)
+        if k < n:
+            selected = _draw_bank(entropy, sec_i, n, k, start + V)[start:]
+        else:
+            selected = np.broadcast_to(np.arange(n), (V, n))
+
+        if diverse and shuffle_questions and k:
+            question_order = _diverse_orders(selected, n, entropy, sec_i)
+        elif shuffle_questions and k:
+            # Thứ tự vị trí (0..k-1) được áp lên các câu đã bốc
+            positions = np.argsort(_draw(entropy, sec_i, _STREAM_QUESTIONS, start, (V, k)), axis=1, kind="stable")
+            question_order = np.take_along_axis(selected, positions, axis=1)
+        else:
+            question_order = selected
+
+        # Chỉ đọc (resolve) các câu có mặt trong batch: câu ngân hàng không được bốc vẫn chưa parse
+        used = np.arange(n) if k == n else np.unique(question_order)
+        used_questions.append(used)
+        counts = np.zeros(n, dtype=np.int64)
+        counts[used] = [len(questions[q_i].options) for q_i in used.tolist()]
+        m = max(1, int(counts.max())) if n else 1
+
+        # Chỉ đảo phương án MCQ / TF; padding (vị trí >= số phương án) được đẩy về cuối.
+        # Mỗi câu một luồng PRNG riêng -> hoán vị phương án không phụ thuộc các câu khác có trong batch hay không.
+        keys = np.broadcast_to(np.arange(m, dtype=np.float64), (V, n, m)).copy()
+        if shuffle_options:
+            for q_i in used.tolist():
+                count = int(counts[q_i])
+                if count and questions[q_i].mode in ('mcq', 'true_false'):
+                    keys[:, q_i, :count] = _draw(entropy, sec_i, _STREAM_OPTIONS, start, (V, count), sub=q_i)
+        keys[:, np.arange(m)[None, :] >= counts[:, None]] = np.inf
+
+        sections.append(SectionPermutations(
+            question_order=np.ascontiguousarray(question_order),
+            option_order=np.argsort(keys, axis=2, kind="stable"),
+            option_counts=counts,
+        ))
+
+    balanced = set()
+    if balance_answers and shuffle_options:
+        balanced = _balance_answers(structure, sections, entropy, start, V)
+
+    if diverse:
+        _ensure_unique(structure, sections, entropy, V, shuffle_questions, shuffle_options, balanced)
+
+    answer_cols = []
+    map_cols = []
+    answer_counts = np.zeros((V, len(MCQ_LABELS)), dtype=np.int64)
+    offset = 0
+    for sec, perms, used in zip(structure.sections, sections, used_questions):
+        questions = sec.questions
+        n = len(questions)
+        codes = _section_answer_codes(questions, used, perms.option_order, perms.option_counts)
+        table = _answer_table(questions, used)
+        # Đáp án theo câu gốc -> sắp lại theo thứ tự câu trong mã đề
+        answers_by_original = table[np.arange(n)[None, :], codes]
+        answer_cols.append(np.take_along_axis(answers_by_original, perms.question_order, axis=1))
+        map_cols.append(perms.question_order + offset)
+
+        is_mcq = _is_mcq(questions, used)
+        mcq_codes = np.where(is_mcq[None, :], codes, len(MCQ_LABELS))
+        mcq_codes = np.take_along_axis(mcq_codes, perms.question_order, axis=1)
+        answer_counts += (mcq_codes[:, :, None] == np.arange(len(MCQ_LABELS))).sum(axis=1)
+        offset += n
+
+    answers = np.concatenate(answer_cols, axis=1) if answer_cols else np.empty((V, 0), dtype=object)
+    question_map = np.concatenate(map_cols, axis=1) if map_cols else np.empty((V, 0), dtype=np.int64)
+    return PermutationBatch(
+        version=version, start=start, sections=sections, answers=answers, question_map=question_map,
+        answer_counts=answer_counts,
+    )
@@ -0,0 +1,213 @@
+import re
+import json
+import zlib
+import struct
+from collections import Counter
+from collections.abc import Sequence
+from typing import List, Optional
+
+from docx.oxml import parse_xml
+from lxml import etree
+
+from .models import ExamStructure, LabelSlot, OptionBlock, QuestionBlock, Section
+
+
+# --- ĐỊNH DẠNG ExamStructure ĐÃ SERIALIZE ---
+# Dùng cho cache parse (RAM / disk / S3): không pickle, không cần file DOCX gốc để dựng lại.
+#
+#   MAGIC (4) | version u16 | flags u16 | độ dài meta u32 | độ dài blob u32 | meta (JSON) | blob
+#
+# blob: các phần tử XML (w:p, w:tbl...) nối liền theo thứ tự duyệt, nén zlib. Khai báo namespace
+# chung của tài liệu (~1KB/phần tử) được bỏ khỏi từng phần tử và chỉ lưu MỘT lần trong meta.
+# Mỗi danh sách phần tử (header, stem, phương án...) chiếm một đoạn liên tục [đầu, cuối) của blob,
+# nên chỉ cần lưu (đầu, cuối, số phần tử) và dựng lại bằng một lần parse khi được dùng tới.
+# Phần tử tự tạo lúc parse (vd: phương án tách từ dòng "A. .. B. ..") có khai báo namespace riêng ->
+# giữ nguyên văn và parse riêng, để dựng lại y hệt bản gốc.
+#
+# meta: {"ns": khai báo namespace, "header": đoạn, "footer": đoạn, "sections": [
+#     [title, info, [[original_idx, raw_label, stem, mode, correct_answer_text, content_hash, slot,
+#                     [[label, elements, is_correct, slot], ...]], ...]], ...]}
+#   đoạn = [đầu, cuối, số phần tử, [[vị trí, đầu, cuối] của phần tử parse riêng, ...]]; slot = null | [element_idx, [[run, cắt], ...]]
+
+STRUCTURE_FORMAT_VERSION = 1
+_MAGIC = b"EXST"
+_HEADER = struct.Struct("<4sHHII")
+
+_NS_DECLS = re.compile(rb'^<[^\s>/]+((?:\s+xmlns(?::[\w.-]+)?="[^"]*")*)')
+
+
+class _FragmentSource:
+    """blob đã giải nén + khai báo namespace chung, dùng chung cho mọi LazyElements của một structure."""
+
+    def __init__(self, blob: bytes, ns_decls: bytes):
+        self.blob = blob
+        self.ns_decls = ns_decls
+
+    def materialize(self, start: int, end: int, standalone: list) -> list:
+        # Bọc trong phần tử giả mang khai báo namespace chung -> một lần parse cho cả danh sách
+        shared = []
+        pos = start
+        for _, a, b in standalone:
+            shared.append(self.blob[pos:a])
+            pos = b
+        shared.append(self.blob[pos:end])
+        items = list(parse_xml(b"<_" + self.ns_decls + b">" + b"".join(shared) + b"</_>"))
+        for idx, a, b in standalone:
+            items.insert(idx, parse_xml(self.blob[a:b]))
+        return items
+
+
+class LazyElements(Sequence):
+    """
+    Danh sách phần tử XML chỉ được parse khi truy cập lần đầu (thay cho List[OxmlElement]).
+    Câu hỏi không được bốc / không được render thì không bao giờ tốn công dựng lại.
+    """
+    __slots__ = ("_source", "_start", "_end", "_count", "_standalone", "_items")
+
+    def __init__(self, source: _FragmentSource, start: int, end: int, count: int, standalone: list):
+        self._source = source
+        self._start = start
+        self._end = end
+        self._count = count
+        self._standalone = standalone
+        self._items: Optional[list] = None
+
+    @property
+    def materialized(self) -> bool:
+        return self._items is not None
+
+    def _load(self) -> list:
+        if self._items is None:
+            self._items = self._source.materialize(self._start, self._end, self._standalone) if self._count else []
+        return self._items
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, idx):
+        return self._load()[idx]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __repr__(self) -> str:
+        return f"LazyElements({self._count}, materialized={self.materialized})"
+
+
+# --- ENCODE ---
+
+class _Encoder:
+    """Gom mọi phần tử trước, chọn khai báo namespace phổ biến nhất làm khai báo chung, rồi mới ghi blob."""
+
+    def __init__(self):
+        self.records = []   # (xml, khoảng khai báo namespace, khai báo)
+        self.spans = []     # (span sẽ được điền, chỉ số record đầu, chỉ số record cuối)
+        self.ns_decls = b""
+
+    def elements(self, elements) -> list:
+        first = len(self.records)
+        for el in elements:
+            xml = etree.tostring(el)
+            m = _NS_DECLS.match(xml)
+            self.records.append((xml, m.span(1), m.group(1)) if m else (xml, None, None))
+        span = []
+        self.spans.append((span, first, len(self.records)))
+        return span
+
+    def finish(self) -> bytes:
+        counts = Counter(decls for _, _, decls in self.records if decls)
+        self.ns_decls = counts.most_common(1)[0][0] if counts else b""
+        parts = []
+        offsets = [0]
+        shared = []
+        for xml, decl_span, decls in self.records:
+            is_shared = decls is not None and decls == self.ns_decls
+            if is_shared:
+                xml = xml[:decl_span[0]] + xml[decl_span[1]:]
+            shared.append(is_shared)
+            parts.append(xml)
+            offsets.append(offsets[-1] + len(xml))
+        for span, first, last in self.spans:
+            standalone = [[i - first, offsets[i], offsets[i + 1]] for i in range(first, last) if not shared[i]]
+            span.extend([offsets[first], offsets[last], last - first, standalone])
+        return b"".join(parts)
+
+
+def _slot_to_meta(slot: Optional[LabelSlot]):
+    return None if slot is None else [slot.element_idx, [list(c) for c in slot.cuts]]
+
+
+def _slot_from_meta(raw) -> Optional[LabelSlot]:
+    return None if raw is None else LabelSlot(raw[0], tuple(tuple(c) for c in raw[1]))
+
+
+def encode_structure(structure: ExamStructure) -> bytes:
+    enc = _Encoder()
+    header = enc.elements(structure.header_elements)
+    sections = []
+    for sec in structure.sections:
+        questions = []
+        info = enc.elements(sec.info_elements)
+        for q in sec.questions:
+            stem = enc.elements(q.stem_elements)
+            options = [
+                [opt.label, enc.elements(opt.elements), opt.is_correct, _slot_to_meta(opt.label_slot)]
+                for opt in q.options
+            ]
+            questions.append([
+                q.original_idx, q.raw_label, stem, q.mode, q.correct_answer_text, q.content_hash,
+                _slot_to_meta(q.label_slot), options,
+            ])
+        sections.append([sec.title, info, questions])
+    footer = enc.elements(structure.footer_elements)
+    blob = zlib.compress(enc.finish(), 6)
+
+    meta = json.dumps({
+        "ns": enc.ns_decls.decode("utf-8"),
+        "header": header,
+        "footer": footer,
+        "sections": sections,
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return _HEADER.pack(_MAGIC, STRUCTURE_FORMAT_VERSION, 0, len(meta), len(blob)) + meta + blob
+
+
+# --- DECODE ---
+
+def decode_structure(data: bytes, lazy: bool = True) -> ExamStructure:
+    """
+    Dựng lại ExamStructure. lazy=True: phần tử XML chỉ được parse khi truy cập;
+    lazy=False: parse hết ngay (mọi danh sách là list thường).
+    """
+    magic, version, _flags, meta_len, blob_len = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC:
+        raise ValueError("Not a serialized ExamStructure")
+    if version != STRUCTURE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported ExamStructure format version {version}")
+    offset = _HEADER.size
+    meta = json.loads(data[offset:offset + meta_len])
+    offset += meta_len
+    source = _FragmentSource(zlib.decompress(data[offset:offset + blob_len]), meta["ns"].encode("utf-8"))
+
+    def elements(span):
+        items = LazyElements(source, *span)
+        return items if lazy else list(items)
+
+    structure = ExamStructure(header_elements=elements(meta["header"]), footer_elements=elements(meta["footer"]))
+    for title, info, questions in meta["sections"]:
+        sec = Section(title=title, info_elements=elements(info))
+        for idx, raw_label, stem, mode, answer_text, content_hash, slot, options in questions:
+            sec.questions.append(QuestionBlock(
+                original_idx=idx,
+                raw_label=raw_label,
+                stem_elements=elements(stem),
+                options=[
+                    OptionBlock(label, elements(span), is_correct, _slot_from_meta(opt_slot))
+                    for label, span, is_correct, opt_slot in options
+                ],
+                mode=mode,
+                correct_answer_text=answer_text,
+                content_hash=content_hash,
+                label_slot=_slot_from_meta(slot),
+            ))
+        structure.sections.append(sec)
+    return structure
@@ -0,0 +1,78 @@
+import io
+from dataclasses import dataclass, field
+from typing import Dict, Optional, List
+from docx import Document
+from docx.document import Document as _Document
+from docx.oxml import OxmlElement
+
+from .models import ExamStructure
+from .package import DocxPackage
+from .utils import _clear_body_keep_sectpr
+
+
+# --- PRE-RENDERED FRAGMENTS ---
+# Mỗi fragment là list các đoạn bytes đã serialize sẵn, bị cắt tại vị trí "slot"
+# (số thứ tự câu, nhãn phương án, mã đề). Ghép một mã đề = slot.join(parts).
+
+@dataclass
+class OptionFragments:
+    plain: bytes                         # Phương án giữ nguyên (TF, hoặc vượt quá số nhãn MCQ)
+    labeled: Optional[List[bytes]] = None  # MCQ: cắt tại vị trí chữ cái nhãn (A/B/C...)
+
+
+@dataclass
+class QuestionFragments:
+    mode: str
+    stem: List[bytes]                    # Cắt tại vị trí số thứ tự câu ("Câu <slot>: ")
+    options: List[OptionFragments] = field(default_factory=list)
+
+
+@dataclass
+class SectionFragments:
+    head: bytes                          # Tiêu đề phần + phần hướng dẫn
+    # Chỉ số câu -> fragment, biên dịch khi cần (None = câu chứa ký tự slot, render bằng tree)
+    questions: Dict[int, Optional[QuestionFragments]] = field(default_factory=dict)
+
+
+@dataclass
+class TemplateFragments:
+    prefix: bytes                        # XML declaration ... <w:body>
+    header: List[bytes]                  # Cắt tại vị trí mã đề
+    sections: List[SectionFragments]
+    footer: bytes
+    suffix: bytes                        # <w:sectPr> ... </w:document>
+
+
+@dataclass
+class CompiledTemplate:
+    """
+    Template đã "biên dịch" một lần cho cả job.
+    Giữ package đã load (styles, media, numbering...), body rỗng và sectPr,
+    để mỗi mã đề chỉ cần dựng lại nội dung body thay vì unzip + parse lại file gốc.
+    """
+    document: _Document
+    body: OxmlElement
+    sect_pr: Optional[OxmlElement]
+    structure: ExamStructure
+    package: DocxPackage
+    fragments: Optional[TemplateFragments] = None  # Dựng lần đầu khi render ở chế độ "fragments"
+    fragments_supported: bool = True               # False: khung file gốc chứa ký tự slot, luôn render bằng cây lxml
+
+    def reset_body(self) -> None:
+        """Xóa nội dung của mã đề trước, chỉ giữ lại sectPr."""
+        for child in list(self.body.iterchildren()):
+            if child is not self.sect_pr:
+                self.body.remove(child)
+
+
+def compile_template(source_bytes: bytes, structure: ExamStructure) -> CompiledTemplate:
+    """Load package một lần và làm rỗng body để dùng chung cho mọi mã đề."""
+    document = Document(io.BytesIO(source_bytes))
+    sect_pr = _clear_body_keep_sectpr(document)
+    return CompiledTemplate(
+        document=document,
+        body=document.element.body,
+        sect_pr=sect_pr,
+        structure=structure,
+        package=DocxPackage(source_bytes, document.part.partname.membername),
+    )
@@ -1,14 +1,23 @@
 from copy import deepcopy
 from typing import Union, Optional, Tuple, List
+import io
 import re
+import zipfile
+from lxml import etree
 from docx.document import Document as _Document
 from docx.oxml import OxmlElement, ns
 from docx.oxml.text.paragraph import CT_P
 from docx.oxml.table import CT_Tbl
+from docx.oxml.parser import element_class_lookup
 from docx.text.paragraph import Paragraph
 from docx.text.run import Run
 from docx.table import Table
-from docx.shared import RGBColor
+from .models import MarkSpans
+from .package import main_document_name
+
+_W_BODY = ns.qn('w:body')
+_W_P = ns.qn('w:p')
+_W_TBL = ns.qn('w:tbl')
 
 # --- RICH TEXT UTILS ---
 
@@ -57,28 +66,73 @@ def _create_simple_para_element(text: str) -> OxmlElement:
 # --- DOCX HELPERS ---
 
 
+def _iter_table_rows(tbl: CT_Tbl):
+    """
+    Lưới ô của bảng trong MỘT lượt qua w:tr / w:tc, cùng kết quả với Table.rows / row.cells
+    (python-docx tính lại lưới + ô gộp ở mỗi lần truy cập, với ô gộp dọc còn dò lại hàng trên).
+    Mỗi hàng: danh sách (w:tc chứa nội dung, số cột lưới chiếm). Ô gộp dọc ("continue") trả về ô gốc phía trên.
+    """
+    above = {}  # vị trí bắt đầu trên lưới -> ô gốc của hàng trên
+    for tr in tbl.tr_lst:
+        offset = tr.grid_before
+        starts = {}
+        row = []
+        for tc in tr.tc_lst:
+            span = tc.grid_span
+            owner = above.get(offset, tc) if tc.vMerge == "continue" else tc
+            starts[offset] = owner
+            row.append((owner, owner.grid_span))
+            offset += span
+        above = starts
+        yield row
+
+
+def _iter_table_paragraphs(tbl: CT_Tbl, parent=None):
+    """Làm phẳng bảng (kể cả bảng lồng) thành các đoạn văn theo thứ tự lưới."""
+    for row in _iter_table_rows(tbl):
+        for tc, span in row:
+            # Ô gộp ngang lặp lại theo số cột lưới
+            for _ in range(span):
+                for child in tc.iterchildren():
+                    if isinstance(child, CT_P):
+                        yield "p", Paragraph(child, parent)
+                    elif isinstance(child, CT_Tbl):
+                        yield from _iter_table_paragraphs(child, parent)
+
+
 def _iter_block_items(doc: _Document):
     """
     Iterate over block items, but FLATTEN tables into their constituent paragraphs.
     This ensures that content inside tables is parsed linearly just like the frontend editor text.
     """
-    def _recurse_element(element):
-        if isinstance(element, CT_P):
-            yield "p", Paragraph(element, doc)
-        elif isinstance(element, CT_Tbl):
-            table = Table(element, doc)
-            for row in table.rows:
-                for cell in row.cells:
-                    # Recursively process cell content
-                    # Note: Cell content is usually paragraphs or (nested) tables
-                    for child in cell._element.iterchildren():
-                        if isinstance(child, CT_P):
-                            yield "p", Paragraph(child, doc)
-                        elif isinstance(child, CT_Tbl):
-                             yield from _recurse_element(child)
-
     for child in doc.element.body.iterchildren():
-        yield from _recurse_element(child)
+        if isinstance(child, CT_P):
+            yield "p", Paragraph(child, doc)
+        elif isinstance(child, CT_Tbl):
+            yield from _iter_table_paragraphs(child, doc)
+
+
+def _iter_streamed_block_items(source_bytes: bytes):
+    """
+    Cùng kết quả với _iter_block_items nhưng không load package qua python-docx:
+    chỉ giải nén + iterparse document part, mỗi block con của w:body được trả về ngay khi đọc xong.
+    Các part khác (media, fonts...) không bao giờ được đọc.
+    """
+    with zipfile.ZipFile(io.BytesIO(source_bytes)) as zf:
+        with zf.open(main_document_name(zf)) as stream:
+            # Cùng cấu hình với parser của python-docx -> phần tử là CT_P / CT_Tbl...
+            context = etree.iterparse(
+                stream, events=("end",), tag=(_W_P, _W_TBL), remove_blank_text=True, resolve_entities=False
+            )
+            context.set_element_class_lookup(element_class_lookup)
+            for _, element in context:
+                parent = element.getparent()
+                if parent is None or parent.tag != _W_BODY:
+                    continue
+                if isinstance(element, CT_P):
+                    yield "p", Paragraph(element, None)
+                else:
+                    yield from _iter_table_paragraphs(element)
 
 
 def _get_text(block: Union[Paragraph, Table, OxmlElement]) -> str:
@@ -140,6 +194,37 @@ def _smart_replace_start(paragraph: Paragraph, regex_pattern: re.Pattern, new_pr
             break
 
 
+def _compute_label_cuts(paragraph: Paragraph, regex_pattern: re.Pattern,
+                        text: Optional[str] = None) -> Optional[Tuple[Tuple[int, int], ...]]:
+    """
+    Tính trước các vị trí cắt mà _smart_replace_start sẽ thực hiện: [(chỉ số run, số ký tự bỏ), ...].
+    None nếu đoạn văn không bắt đầu bằng nhãn. text: paragraph.text nếu đã có sẵn.
+    """
+    match = regex_pattern.match(paragraph.text if text is None else text)
+    if not match:
+        return None
+    len_to_remove = len(match.group(0))
+    current_idx = 0
+    cuts = []
+    for run_idx, run in enumerate(paragraph.runs):
+        run_text = run.text
+        if not run_text: continue
+        if current_idx >= len_to_remove: break
+        run_len = len(run_text)
+        cuts.append((run_idx, min(run_len, len_to_remove - current_idx)))
+        current_idx += run_len
+    return tuple(cuts)
+
+
+def _apply_label_cuts(p_element: CT_P, cuts: Tuple[Tuple[int, int], ...], new_prefix: str) -> None:
+    """Ghi nhãn mới theo các vị trí cắt đã tính sẵn (tương đương _smart_replace_start, không regex)."""
+    r_lst = p_element.r_lst
+    for i, (run_idx, cut) in enumerate(cuts):
+        run = Run(r_lst[run_idx], None)
+        remainder = run.text[cut:]
+        run.text = new_prefix + remainder if i == 0 else remainder
+
+
 def _normalize_format_and_clean(paragraph: Paragraph):
     """Xóa marker và UN-BOLD nội dung để đồng nhất format"""
     for run in paragraph.runs:
@@ -169,24 +254,63 @@ def _recursive_replace_code(element, new_code: str):
 
 # --- SMART DETECTION UTILS ---
 
+_W_R = ns.qn('w:r')
+_W_RPR = ns.qn('w:rPr')
+_W_HYPERLINK = ns.qn('w:hyperlink')
+_W_VAL = ns.qn('w:val')
+_U, _HIGHLIGHT, _COLOR = ns.qn('w:u'), ns.qn('w:highlight'), ns.qn('w:color')
+# Giống CT_R.text: các phần tử con của w:r được quy ra text
+_RUN_TEXT_TAGS = frozenset(ns.qn(t) for t in ('w:br', 'w:cr', 'w:noBreakHyphen', 'w:ptab', 'w:t', 'w:tab'))
+
+
+def _rpr_marked(rPr) -> bool:
+    """Đọc thẳng w:rPr: gạch chân (khác "none"), highlight (khác "none"/"default") hoặc chữ màu FF0000."""
+    if rPr is None:
+        return False
+    u = rPr.find(_U)
+    if u is not None and u.get(_W_VAL) not in (None, 'none'):
+        return True
+    highlight = rPr.find(_HIGHLIGHT)
+    if highlight is not None and highlight.get(_W_VAL) not in (None, 'none', 'default'):
+        return True
+    color = rPr.find(_COLOR)
+    return color is not None and (color.get(_W_VAL) or '').upper() == 'FF0000'
+
+
 def _is_run_marked(run: Run) -> bool:
-    try:
-        if run.underline not in [None, False, 0]: return True
-        if run.font.highlight_color: return True
-        if run.font.color and run.font.color.rgb:
-            if run.font.color.rgb == RGBColor(255, 0, 0): return True
-            if str(run.font.color.rgb).upper() == "FF0000": return True
-    except:
-        pass
-    return False
-
-
-def _build_paragraph_mask(paragraph: Paragraph) -> Tuple[str, List[bool]]:
-    full_text = ""
-    mask = []
-    for run in paragraph.runs:
-        text = run.text
-        is_marked = _is_run_marked(run)
-        full_text += text
-        mask.extend([is_marked] * len(text))
-    return full_text, mask
+    return _rpr_marked(run._r.rPr)
+
+
+def _run_text(r) -> str:
+    return "".join(str(e) for e in r.iterchildren() if e.tag in _RUN_TEXT_TAGS)
+
+
+def _scan_paragraph(p_element: CT_P) -> Tuple[str, MarkSpans]:
+    """
+    Một lượt qua w:p: trả về (paragraph.text, MarkSpans trên text các run trực tiếp).
+    Thay cho việc gọi paragraph.text rồi dựng mặt nạ từng ký tự qua thuộc tính font của python-docx.
+    """
+    parts = []
+    run_parts = []
+    bounds = []
+    pos = 0
+    for child in p_element.iterchildren():
+        tag = child.tag
+        if tag == _W_R:
+            text = _run_text(child)
+            if not text:
+                continue
+            parts.append(text)
+            run_parts.append(text)
+            end = pos + len(text)
+            if _rpr_marked(child.find(_W_RPR)):
+                if bounds and bounds[-1] == pos:
+                    bounds[-1] = end
+                else:
+                    bounds += (pos, end)
+            pos = end
+        elif tag == _W_HYPERLINK:
+            parts.append("".join(_run_text(r) for r in child.iterchildren(_W_R)))
+    full_text = "".join(parts)
+    run_text = full_text if len(run_parts) == len(parts) else "".join(run_parts)
+    return full_text, MarkSpans(run_text, tuple(bounds))
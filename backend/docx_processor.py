@@ -5,68 +5,294 @@ import openpyxl
 import logging
 import io
 import time
-from typing import Callable, Optional
-from core import parse_exam_template, generate_variant_from_structure
+import queue
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from core import parse_exam_template, compile_template, generate_variant_from_template, CompiledTemplate
+from core.generators import MCQ_LABELS, RENDER_FRAGMENTS, prepare_fragments, resolve_answer_key, apply_answer_key
+from core.models import AnswerKeyStats, VariantPlan
+from core.package import copy_entries
+from core.dedupe import drop_near_duplicates, find_near_duplicates
+from core.parse_cache import ParseCache
+from core.permutations import PERMUTATION_VERSION, plan_batch
 
 logger = logging.getLogger("worker")
 
+# Template + tham số sinh đề dùng chung cho các process con của pool.
+# Được gán TRƯỚC khi fork nên process con kế thừa qua copy-on-write, không pickle theo từng task.
+_POOL_TEMPLATE: Optional[CompiledTemplate] = None
+_POOL_OPTIONS: dict = {}
+
+
+def _generate_in_pool(task: Tuple[str, VariantPlan]) -> Tuple[str, bytes, List[str]]:
+    exam_code, plan = task
+    docx_bytes, answers_list = generate_variant_from_template(
+        template=_POOL_TEMPLATE, seed=None, exam_code=exam_code, plan=plan, **_POOL_OPTIONS
+    )
+    return exam_code, docx_bytes, answers_list
+
+
+@contextmanager
+def _variant_source(
+        template: CompiledTemplate,
+        tasks: List[Tuple[str, VariantPlan]],
+        options: dict,
+        workers: int,
+        job_id: str
+) -> Iterator[Iterator[Tuple[str, bytes, List[str]]]]:
+    """
+    Nguồn các mã đề theo đúng thứ tự tasks, tuần tự hoặc qua process pool (fork).
+    Pool được fork NGAY khi vào context: phải tạo pool trước khi khởi động các thread khác
+    (vd: _ZipWriterStage) - fork khi một thread khác đang giữ lock có thể làm process con bị treo.
+    """
+    global _POOL_TEMPLATE, _POOL_OPTIONS
+
+    if workers > 1 and len(tasks) > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning(f"[{job_id}] Hệ điều hành không hỗ trợ fork, sinh đề tuần tự.")
+        workers = 1
+
+    if workers <= 1 or len(tasks) <= 1:
+        yield (
+            (exam_code, *generate_variant_from_template(
+                template=template, seed=None, exam_code=exam_code, plan=plan, **options
+            ))
+            for exam_code, plan in tasks
+        )
+        return
+
+    # Biên dịch fragment (các câu được bốc) ở process cha để các process con dùng chung, không tự dựng lại
+    if options.get("render_mode") == RENDER_FRAGMENTS:
+        prepare_fragments(template, [plan for _, plan in tasks])
+
+    workers = min(workers, len(tasks))
+    logger.info(f"[{job_id}] Generating variants across {workers} processes...")
+    _POOL_TEMPLATE, _POOL_OPTIONS = template, options
+    try:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            # imap giữ đúng thứ tự tasks -> ZIP luôn theo thứ tự mã đề, output ổn định
+            yield pool.imap(_generate_in_pool, tasks)
+    finally:
+        _POOL_TEMPLATE, _POOL_OPTIONS = None, {}
+
+
+@dataclass
+class BatchResult:
+    """Thông tin trả về cho worker / API sau khi sinh xong một job."""
+    answer_key: Optional[AnswerKeyStats] = None
+    permutation_version: int = PERMUTATION_VERSION
+    answer_distribution: Optional[Dict[str, int]] = None  # Tổng số đáp án MCQ theo nhãn trên cả job
+    removed_duplicates: Optional[int] = None  # Số câu gần trùng đã bỏ (dedupe_questions)
+
+    def to_report(self) -> dict:
+        report = {'PermutationVersion': self.permutation_version}
+        if self.answer_key is not None:
+            report['AnswerKey'] = {
+                'TotalKeys': self.answer_key.total_keys,
+                'MatchedByHash': self.answer_key.matched_by_hash,
+                'MatchedByIndex': self.answer_key.matched_by_index,
+                'UnmatchedKeys': self.answer_key.unmatched_keys[:100],
+            }
+        if self.answer_distribution is not None:
+            report['AnswerDistribution'] = self.answer_distribution
+        if self.removed_duplicates is not None:
+            report['RemovedDuplicates'] = self.removed_duplicates
+        return report
+
+
+class _ZipWriterStage(threading.Thread):
+    """
+    Stage ghi ZIP chạy song song với stage sinh đề.
+    Nhận (tên file, bytes, kiểu nén) qua hàng đợi có giới hạn -> bộ nhớ bị chặn bởi độ sâu hàng đợi.
+    """
+
+    def __init__(self, zf: zipfile.ZipFile, depth: int):
+        super().__init__(name="zip-writer", daemon=True)
+        self.zf = zf
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max(1, depth))
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # Đã lỗi: chỉ rút hàng đợi để stage sinh đề không bị kẹt
+            name, data, compress_type = item
+            try:
+                self.zf.writestr(name, data, compress_type=compress_type)
+            except BaseException as e:
+                self.error = e
+
+    def submit(self, name: str, data: bytes, compress_type: int) -> None:
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put((name, data, compress_type), timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self) -> None:
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
 
 def process_exam_batch(
         source_bytes: bytes,
         job_id: str,
         num_variants: int,
-        output_zip_path: str,
+        output_zip_path: Union[str, BinaryIO],
 
         progress_callback: Optional[Callable[[], None]] = None,
-        external_answer_map: Optional[dict] = None
-) -> None:
+        external_answer_map: Optional[dict] = None,
+        render_mode: str = RENDER_FRAGMENTS,
+        workers: int = 0,
+        queue_depth: int = 4,
+        answers_only: bool = False,
+        balance_answers: bool = False,
+        diverse_variants: bool = False,
+        draw_counts: Optional[Sequence[Optional[int]]] = None,
+        dedupe_questions: bool = False,
+        existing_variants: int = 0,
+        previous_zip: Optional[bytes] = None,
+        parse_cache: Optional[ParseCache] = None
+) -> BatchResult:
+    """
+    Sinh num_variants mã đề + bảng đáp án vào file ZIP.
+    output_zip_path: đường dẫn file hoặc stream ghi được (vd: S3MultipartUploadStream để upload trực tiếp).
+    workers > 1: bật chế độ song song, chia các mã đề cho một pool process (fork).
+    queue_depth: số mã đề tối đa chờ ghi ZIP (stage sinh đề và stage ghi ZIP chạy song song).
+    answers_only: chỉ tính hoán vị + đáp án từ structure và ghi Bang_Dap_An, không render DOCX.
+    balance_answers: dàn đều đáp án đúng MCQ qua A, B, C, D trong từng mã đề.
+    diverse_variants: chọn thứ tự câu hỏi khác nhau tối đa giữa các mã đề, đảm bảo không trùng mã đề.
+    draw_counts: số câu bốc từ mỗi phần (ngân hàng câu hỏi), vd [40, 0] = bốc 40 câu phần I, giữ nguyên phần II.
+    dedupe_questions: bỏ câu gần trùng (core/dedupe.py), mỗi cụm giữ câu xuất hiện đầu tiên. Cùng file luôn
+        cho cùng kết quả nên mở rộng job vẫn khớp các mã đề cũ.
+    existing_variants + previous_zip: mở rộng job đã xong. num_variants là TỔNG số mã đề; chỉ các mã đề
+        từ existing_variants trở đi được render, các mã đề cũ copy thô từ previous_zip (hoán vị ổn định
+        theo job_id nên mã đề cũ và bảng đáp án tính lại luôn khớp nhau).
+    parse_cache: dùng lại kết quả parse của cùng file (vd: đã parse lúc /api/preview hoặc lần chạy trước).
+    """
     logger.info(f"[{job_id}] Parsing template structure...")
-    structure = parse_exam_template(source_bytes)
+    structure = parse_cache.get_or_parse(source_bytes) if parse_cache else parse_exam_template(source_bytes)
+    result = BatchResult()
+
+    # Đáp án từ Editor: phân tích và áp MỘT lần cho cả job (không lặp lại theo từng mã đề)
+    if external_answer_map:
+        result.answer_key = apply_answer_key(structure, resolve_answer_key(external_answer_map))
+
+    if dedupe_questions:
+        result.removed_duplicates = drop_near_duplicates(structure, find_near_duplicates(structure))
+        logger.info(f"[{job_id}] Removed {result.removed_duplicates} near-duplicate questions.")
 
-    all_answers_data = {}
+    # Bốc thăm hoán vị cho MỌI mã đề một lần (PRNG ổn định theo job_id + PERMUTATION_VERSION).
+    # Khi mở rộng job vẫn bốc lại cả các mã đề cũ: rẻ, và cần cho bảng đáp án / kiểm tra trùng mã đề.
+    batch = plan_batch(
+        structure, job_id, num_variants,
+        balance_answers=balance_answers, diverse=diverse_variants, draw_counts=draw_counts
+    )
+    exam_codes = [str(101 + i) for i in range(num_variants)]
+    excel_name = f"Bang_Dap_An_{job_id}.xlsx"
+    distribution = dict(zip(exam_codes, batch.answer_distribution()))
+    sources = _question_sources(structure, batch, exam_codes) if draw_counts else None
+    result.answer_distribution = {
+        label: int(count) for label, count in zip(MCQ_LABELS, batch.answer_counts.sum(axis=0).tolist()) if count
+    }
+
+    if answers_only:
+        # Fast path: đáp án lấy thẳng từ ma trận hoán vị, không dựng XML / DOCX
+        logger.info(f"[{job_id}] Computing answer key for {num_variants} variants (no rendering)...")
+        all_answers_data = dict(zip(exam_codes, batch.answer_rows()))
+        excel_bytes = _generate_excel_answers(all_answers_data, job_id, distribution, sources)
+        with zipfile.ZipFile(output_zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            if previous_zip:
+                copy_entries(zf, previous_zip, skip=(excel_name,))
+            zf.writestr(excel_name, excel_bytes)
+        logger.info(f"[{job_id}] Completed answer key only.")
+        return result
+
+    # Biên dịch template MỘT lần cho cả job, mọi mã đề dùng chung
+    template = compile_template(source_bytes, structure)
+    tasks = [
+        (exam_code, batch.plan(v, structure))
+        for v, exam_code in enumerate(exam_codes) if v >= existing_variants
+    ]
+
+    all_answers_data = dict(zip(exam_codes, batch.answer_rows()))
     last_heartbeat_time = time.time()
     HEARTBEAT_INTERVAL = 30  # Giây (nên nhỏ hơn VisibilityTimeout của SQS)
 
     with zipfile.ZipFile(output_zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        logger.info(f"[{job_id}] Generating {num_variants} variants...")
-
-        for i in range(num_variants):
-            # 1. Logic xử lý chính
-            exam_code = str(101 + i)
-            current_seed = hash(f"{job_id}_{exam_code}")
-
-            docx_bytes, answers_list = generate_variant_from_structure(
-                source_bytes=source_bytes,
-                structure=structure,
-                seed=current_seed,
-                exam_code=exam_code,
-                external_answer_map=external_answer_map
-            )
-
-            all_answers_data[exam_code] = answers_list
-            zf.writestr(f"Ma_De_{exam_code}.docx", docx_bytes)
-            del docx_bytes
-
-            # 2. ACTIVE HEARTBEAT CHECK
-            # Kiểm tra xem đã đến lúc cần gia hạn SQS chưa
-            if progress_callback and (time.time() - last_heartbeat_time > HEARTBEAT_INTERVAL):
-                try:
-                    logger.info(f"[{job_id}] Sending heartbeat signal from processor...")
-                    progress_callback()  # Gọi ngược về worker để gia hạn
-                    last_heartbeat_time = time.time()  # Reset đồng hồ
-                except Exception as e:
-                    # Không để lỗi network làm chết job đang chạy tốt
-                    logger.warning(f"[{job_id}] Heartbeat callback failed: {e}")
-
-        # Tạo Excel
-        excel_bytes = _generate_excel_answers(all_answers_data, job_id)
-        zf.writestr(f"Bang_Dap_An_{job_id}.xlsx", excel_bytes)
-
-    file_size_mb = os.path.getsize(output_zip_path) / (1024 * 1024)
+        if previous_zip:
+            # Mã đề cũ: copy nguyên bytes từ ZIP trước, không render lại
+            copied = copy_entries(zf, previous_zip, skip=(excel_name,))
+            logger.info(f"[{job_id}] Reused {len(copied)} entries from previous result.")
+        logger.info(f"[{job_id}] Generating {len(tasks)} variants...")
+
+        options = dict(render_mode=render_mode)
+
+        # Tạo pool (fork) TRƯỚC rồi mới khởi động thread ghi ZIP
+        with _variant_source(template, tasks, options, workers, job_id) as variants:
+            writer = _ZipWriterStage(zf, queue_depth)
+            writer.start()
+            try:
+                for exam_code, docx_bytes, answers_list in variants:
+                    # 1. Đẩy kết quả sang stage ghi ZIP (theo đúng thứ tự mã đề)
+                    all_answers_data[exam_code] = answers_list
+                    # DOCX đã là file nén (media copy thô từ file gốc) -> STORED, không deflate lần 2
+                    writer.submit(f"Ma_De_{exam_code}.docx", docx_bytes, zipfile.ZIP_STORED)
+                    del docx_bytes
+
+                    # 2. ACTIVE HEARTBEAT CHECK
+                    # Kiểm tra xem đã đến lúc cần gia hạn SQS chưa
+                    if progress_callback and (time.time() - last_heartbeat_time > HEARTBEAT_INTERVAL):
+                        try:
+                            logger.info(f"[{job_id}] Sending heartbeat signal from processor...")
+                            progress_callback()  # Gọi ngược về worker để gia hạn
+                            last_heartbeat_time = time.time()  # Reset đồng hồ
+                        except Exception as e:
+                            # Không để lỗi network làm chết job đang chạy tốt
+                            logger.warning(f"[{job_id}] Heartbeat callback failed: {e}")
+
+                # Tạo Excel
+                excel_bytes = _generate_excel_answers(all_answers_data, job_id, distribution, sources)
+                writer.submit(excel_name, excel_bytes, zipfile.ZIP_DEFLATED)
+            finally:
+                # Luôn dừng stage ghi trước khi đóng ZIP (lỗi của stage ghi được raise tại đây)
+                writer.finish()
+
+    if isinstance(output_zip_path, str):
+        file_size_mb = os.path.getsize(output_zip_path) / (1024 * 1024)
+    else:
+        file_size_mb = output_zip_path.tell() / (1024 * 1024)
     logger.info(f"[{job_id}] Completed. Output size: {file_size_mb:.2f} MB")
+    return result
 
 
-def _generate_excel_answers(all_answers_data: dict, job_id: str) -> bytes:
+def _question_sources(structure, batch, exam_codes: List[str]) -> Dict[str, List[str]]:
+    """Câu gốc trong ngân hàng ứng với từng vị trí câu của mỗi mã đề."""
+    multi = len(structure.sections) > 1
+    bank_labels = [
+        f"Phần {sec_i + 1} - Câu {q.original_idx}" if multi else f"Câu {q.original_idx}"
+        for sec_i, sec in enumerate(structure.sections) for q in sec.questions
+    ]
+    return {
+        code: [bank_labels[i] for i in row]
+        for code, row in zip(exam_codes, batch.question_map.tolist())
+    }
+
+
+def _generate_excel_answers(
+        all_answers_data: dict, job_id: str,
+        distribution: Optional[dict] = None, sources: Optional[dict] = None
+) -> bytes:
     wb = openpyxl.Workbook()
     ws = wb.active
     ws.title = "Dap An Chi Tiet"
@@ -107,6 +333,24 @@ def _generate_excel_answers(all_answers_data: dict, job_id: str) -> bytes:
             row_data.append(ans)
         ws.append(row_data)
 
+    # Sheet phân bố đáp án MCQ theo từng mã đề (chỉ các nhãn có xuất hiện)
+    if distribution:
+        used = [lbl for lbl in MCQ_LABELS if any(counts.get(lbl) for counts in distribution.values())]
+        ws_dist = wb.create_sheet("Phan Bo Dap An")
+        ws_dist.append(["Mã đề"] + used)
+        for code in sorted(distribution.keys()):
+            ws_dist.append([code] + [distribution[code].get(lbl, 0) for lbl in used])
+
+    # Sheet nguồn câu hỏi khi bốc đề từ ngân hàng: vị trí câu trong mã đề -> câu gốc
+    if sources:
+        ws_src = wb.create_sheet("Nguon Cau Hoi")
+        src_codes = sorted(sources.keys())
+        ws_src.append(["Câu"] + [f"Mã {code}" for code in src_codes])
+        for q_idx in range(max(len(sources[code]) for code in src_codes)):
+            ws_src.append([q_idx + 1] + [
+                sources[code][q_idx] if q_idx < len(sources[code]) else "" for code in src_codes
+            ])
+
     buf = io.BytesIO()
     wb.save(buf)
     return buf.getvalue()
\ No newline at end of file
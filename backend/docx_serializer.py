@@ -303,12 +303,11 @@ class DocxSerializer:
         raw_lines = []
         
         # Import regex constants
-        from core.constants import END_NOTE_PATTERN, ANSWER_HEADER_PATTERN
+        from core.constants import END_NOTE_PATTERN, ANSWER_HEADER_PATTERN, ANSWER_LINE_PATTERN
         
         # Helper check for "Đáp án: ..." line (inline answer)
         # Note: ANSWER_HEADER_PATTERN matches global header, we need to detect "Đáp án: " content line.
-        # Reuse logic or simple regex:
-        inline_ans_pattern = re.compile(r"^(?:Đáp án|ĐÁP ÁN|Dap an)[:\.]", re.IGNORECASE)
+        inline_ans_pattern = ANSWER_LINE_PATTERN
 
         for child in self.doc.element.body.iterchildren():
             txt = ""
@@ -20,3 +20,15 @@ class FontError(ExamError):
 class EmptyQuestionError(ExamError):
     def __init__(self, message="Không tìm thấy câu hỏi nào trong đề thi. Vui lòng kiểm tra lại các từ khóa 'Câu', 'Bài'."):
         super().__init__(message, "NO_QUESTIONS")
+
+class VariantCapacityError(ExamError):
+    def __init__(self, message="Đề thi có quá ít câu hỏi để sinh đủ số mã đề khác nhau. Vui lòng giảm số mã đề."):
+        super().__init__(message, "TOO_MANY_VARIANTS")
+
+class InvalidDrawCountsError(ExamError):
+    def __init__(self, message="Số câu bốc từ mỗi phần không hợp lệ."):
+        super().__init__(message, "INVALID_DRAW_COUNTS")
+
+class ParseBudgetExceededError(ExamError):
+    def __init__(self, message="File đề thi quá lớn hoặc quá phức tạp để xử lý. Vui lòng chia nhỏ hoặc đơn giản hóa định dạng."):
+        super().__init__(message, "PARSE_BUDGET_EXCEEDED")
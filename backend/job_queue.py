@@ -0,0 +1,56 @@
+import json
+import logging
+import time
+from typing import Any, Dict
+
+logger = logging.getLogger("server")
+
+
+def queue_job_extension(table, sqs, queue_url: str, job_id: str, manifest: Dict[str, Any], additional: int) -> int:
+    """
+    Đưa job đã xong (Status = Done) vào hàng đợi để sinh thêm `additional` mã đề, trả về tổng số mã đề.
+    Job được chiếm bằng update có điều kiện #s = Done (hai request mở rộng cùng lúc chỉ một cái thắng).
+    Gửi SQS lỗi -> trả lại Status = Done và NumVariants cũ rồi ném lại lỗi, để job không kẹt ở Queued
+    (không có message nào sẽ xử lý nó) và có thể mở rộng lại.
+    """
+    existing = int(manifest['numVariants'])
+    total = existing + additional
+    table.update_item(
+        Key={'JobId': job_id},
+        UpdateExpression="SET #s = :status, NumVariants = :num, UpdatedAt = :ts",
+        ConditionExpression="#s = :done",
+        ExpressionAttributeNames={'#s': 'Status'},
+        ExpressionAttributeValues={
+            ':status': 'Queued',
+            ':done': 'Done',
+            ':num': total,
+            ':ts': int(time.time())
+        }
+    )
+
+    # Worker chỉ sinh các mã đề mới, mã đề cũ + đáp án được giữ nguyên
+    message_body = dict(manifest, numVariants=total, existingVariants=existing, status="Queued")
+    try:
+        sqs.send_message(
+            QueueUrl=queue_url,
+            MessageBody=json.dumps(message_body)
+        )
+    except Exception:
+        try:
+            table.update_item(
+                Key={'JobId': job_id},
+                UpdateExpression="SET #s = :done, NumVariants = :num, UpdatedAt = :ts",
+                ConditionExpression="#s = :queued AND NumVariants = :total",
+                ExpressionAttributeNames={'#s': 'Status'},
+                ExpressionAttributeValues={
+                    ':done': 'Done',
+                    ':queued': 'Queued',
+                    ':num': existing,
+                    ':total': total,
+                    ':ts': int(time.time())
+                }
+            )
+        except Exception as rollback_error:
+            logger.error(f"Không thể trả job {job_id} về trạng thái Done: {rollback_error}")
+        raise
+    return total
@@ -0,0 +1,74 @@
+import io
+import logging
+
+logger = logging.getLogger("worker")
+
+
+class S3MultipartUploadStream(io.RawIOBase):
+    """
+    File-like (chỉ ghi, không seek) đẩy dữ liệu lên S3 bằng Multipart Upload ngay trong lúc ghi.
+    Dùng làm output cho zipfile để vừa sinh đề vừa upload, không cần file ZIP tạm trên đĩa.
+    """
+
+    MIN_PART_SIZE = 5 * 1024 * 1024  # Giới hạn tối thiểu của S3 cho mọi part trừ part cuối
+
+    def __init__(self, s3_client, bucket: str, key: str,
+                 content_type: str = "application/octet-stream", part_size: int = 8 * 1024 * 1024):
+        super().__init__()
+        self._s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self._buffer = bytearray()
+        self._parts = []
+        self._written = 0
+        response = self._s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)
+        self._upload_id = response['UploadId']
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._written
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed stream")
+        self._buffer += data
+        self._written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, chunk: bytes) -> None:
+        part_number = len(self._parts) + 1
+        response = self._s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=chunk
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self) -> None:
+        """Đẩy phần còn lại (part cuối được phép < 5MB) và hoàn tất upload."""
+        if self.closed:
+            return
+        if self._buffer or not self._parts:
+            self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+        self._s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={'Parts': self._parts}
+        )
+        super().close()
+
+    def abort(self) -> None:
+        """Hủy upload dang dở (S3 sẽ xóa các part đã gửi)."""
+        if self.closed:
+            return
+        try:
+            self._s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+        except Exception as e:
+            logger.warning(f"Abort multipart upload s3://{self.bucket}/{self.key} failed: {e}")
+        self._buffer.clear()
+        super().close()
@@ -1,5 +1,5 @@
 from typing import List, Optional, Dict
-from pydantic import BaseModel
+from pydantic import BaseModel, NonNegativeInt
 
 
 # --- REQUEST MODELS ---
@@ -14,6 +14,21 @@ class SubmitJobRequest(BaseModel):
     fileKey: str
     numVariants: int = 10
     rawText: Optional[str] = None
+    # Chỉ tính bảng đáp án (Bang_Dap_An), không render file DOCX
+    answersOnly: bool = False
+    # Dàn đều đáp án đúng MCQ qua A/B/C/D trong từng mã đề
+    balanceAnswers: bool = False
+    # Thứ tự câu hỏi khác nhau tối đa giữa các mã đề, không có hai mã đề trùng nhau
+    diverseVariants: bool = False
+    # Số câu bốc ngẫu nhiên từ mỗi phần (ngân hàng câu hỏi), mỗi phần một số; 0 = lấy cả phần
+    drawCounts: Optional[List[NonNegativeInt]] = None
+    # Bỏ câu gần trùng (giữ câu xuất hiện đầu tiên của mỗi cụm) trước khi sinh đề
+    dedupeQuestions: bool = False
+
+
+class ExtendJobRequest(BaseModel):
+    # Số mã đề sinh thêm (tiếp nối mã đề cuối cùng của job)
+    additionalVariants: int = 5
 
 
 # --- RESPONSE MODELS ---
@@ -29,18 +44,41 @@ class SubmitJobResponse(BaseModel):
     jobId: str
 
 
+class AnswerKeyMatchReport(BaseModel):
+    TotalKeys: int = 0
+    MatchedByHash: int = 0
+    MatchedByIndex: int = 0
+    UnmatchedKeys: List[str] = []
+
+
 class JobStatusResponse(BaseModel):
     JobId: str
     Status: str
     OutputUrl: Optional[str] = None
     CreatedAt: int
     UpdatedAt: int
+    AnswerKeyReport: Optional[AnswerKeyMatchReport] = None
+    AnswerDistribution: Optional[Dict[str, int]] = None
+    RemovedDuplicates: Optional[int] = None
+
+
+class DuplicateQuestionInfo(BaseModel):
+    id: Optional[str] = None  # content_hash, trùng với thẻ [ID:...] trong raw_text
+    section: int = 1
+    number: int = 0
+
+
+class DuplicateClusterInfo(BaseModel):
+    # Câu đầu tiên là câu được giữ khi bật dedupeQuestions
+    questions: List[DuplicateQuestionInfo]
+    similarity: float
 
 
 class PreviewData(BaseModel):
     raw_text: str
     assets_map: Dict[str, Dict]
     question_count: int = 0
+    duplicate_clusters: List[DuplicateClusterInfo] = []
 
 
 class PreviewResponse(BaseModel):
@@ -48,5 +86,17 @@ class PreviewResponse(BaseModel):
     data: PreviewData
 
 
+class ParseCacheStatsResponse(BaseModel):
+    hits: int = 0
+    memory_hits: int = 0
+    disk_hits: int = 0
+    s3_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+    max_bytes: int = 0
+
+
 class ErrorResponse(BaseModel):
     error: str
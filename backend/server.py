@@ -18,15 +18,21 @@ from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 from docx_serializer import DocxSerializer
-from exceptions import ExamError, InvalidExamFormatException, AnswerKeyNotFoundError, FontError, EmptyQuestionError
+from exceptions import (
+    ExamError, InvalidExamFormatException, AnswerKeyNotFoundError, FontError, EmptyQuestionError, ParseBudgetExceededError
+)
 from config import settings
-from core import parse_exam_template
+from core.models import ParseLimits
+from core.dedupe import find_near_duplicates
+from core.parse_cache import ParseCache
 from core.utils import _get_text
 from docx_processor import _generate_excel_answers
+from job_queue import queue_job_extension
 from schemas import (
     UploadUrlRequest, UploadUrlResponse,
-    SubmitJobRequest, SubmitJobResponse,
-    JobStatusResponse, PreviewResponse, PreviewData
+    SubmitJobRequest, SubmitJobResponse, ExtendJobRequest,
+    JobStatusResponse, PreviewResponse, PreviewData, AnswerKeyMatchReport, ParseCacheStatsResponse,
+    DuplicateClusterInfo, DuplicateQuestionInfo
 )
 
 # Setup logging
@@ -63,6 +69,16 @@ sqs = session.client('sqs')
 dynamodb = session.resource('dynamodb')
 table = dynamodb.Table(settings.table_name)
 
+# Cache parse dùng chung cho mọi request preview (và với worker qua tầng disk/S3)
+parse_cache = ParseCache(
+    max_bytes=settings.parse_cache_mb * 1024 * 1024,
+    disk_dir=settings.parse_cache_dir or None,
+    s3_client=s3 if settings.parse_cache_s3 else None,
+    s3_bucket=settings.bucket_output,
+    parse_backend=settings.parse_backend,
+    parse_limits=ParseLimits(settings.parse_max_seconds, settings.parse_max_blocks, settings.parse_max_runs),
+)
+
 
 def _render_structure(structure, serializer: DocxSerializer) -> str:
     """
@@ -294,7 +310,12 @@ async def submit_job(request: SubmitJobRequest):
             "fileKey": request.fileKey,
             "numVariants": request.numVariants,
             "status": "Queued",
-            "answerMap": answer_map
+            "answerMap": answer_map,
+            "answersOnly": request.answersOnly,
+            "balanceAnswers": request.balanceAnswers,
+            "diverseVariants": request.diverseVariants,
+            "drawCounts": request.drawCounts,
+            "dedupeQuestions": request.dedupeQuestions
         }
         sqs.send_message(
             QueueUrl=settings.queue_url,
@@ -311,6 +332,36 @@ async def submit_job(request: SubmitJobRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# --- 2b. API MỞ RỘNG JOB (SINH THÊM MÃ ĐỀ) ---
+@app.post("/api/extend-job/{job_id}", response_model=SubmitJobResponse)
+async def extend_job(job_id: str, request: ExtendJobRequest):
+    if request.additionalVariants < 1:
+        raise HTTPException(status_code=400, detail="additionalVariants must be >= 1")
+
+    response = table.get_item(Key={'JobId': job_id})
+    item = response.get('Item')
+    if not item:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if item.get('Status') != 'Done' or not item.get('ManifestKey'):
+        raise HTTPException(status_code=409, detail="Job chưa hoàn tất hoặc không hỗ trợ mở rộng")
+
+    try:
+        manifest_obj = s3.get_object(Bucket=settings.bucket_output, Key=item['ManifestKey'])
+        manifest = json.loads(manifest_obj['Body'].read())
+
+        existing = int(manifest['numVariants'])
+        total = queue_job_extension(table, sqs, settings.queue_url, job_id, manifest, request.additionalVariants)
+
+        return SubmitJobResponse(
+            message=f"Job extended: {existing} -> {total} variants",
+            jobId=job_id
+        )
+
+    except Exception as e:
+        logger.error(f"Error extending job {job_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # --- 3. API POLLING TRẠNG THÁI ---
 @app.get("/api/status/{job_id}", response_model=JobStatusResponse)
 async def get_status(job_id: str):
@@ -326,12 +377,32 @@ async def get_status(job_id: str):
                 return int(obj) if obj % 1 == 0 else float(obj)
             return obj
 
+        answer_key_report = None
+        job_report = item.get('JobReport') or {}
+        key_report = job_report.get('AnswerKey')
+        if key_report:
+            answer_key_report = AnswerKeyMatchReport(
+                TotalKeys=decimal_convert(key_report.get('TotalKeys', 0)),
+                MatchedByHash=decimal_convert(key_report.get('MatchedByHash', 0)),
+                MatchedByIndex=decimal_convert(key_report.get('MatchedByIndex', 0)),
+                UnmatchedKeys=list(key_report.get('UnmatchedKeys', [])),
+            )
+
+        answer_distribution = None
+        if job_report.get('AnswerDistribution'):
+            answer_distribution = {
+                label: decimal_convert(count) for label, count in job_report['AnswerDistribution'].items()
+            }
+
         return JobStatusResponse(
             JobId=item.get('JobId'),
             Status=item.get('Status'),
             OutputUrl=item.get('OutputUrl'),
             CreatedAt=decimal_convert(item.get('CreatedAt', 0)),
-            UpdatedAt=decimal_convert(item.get('UpdatedAt', 0))
+            UpdatedAt=decimal_convert(item.get('UpdatedAt', 0)),
+            AnswerKeyReport=answer_key_report,
+            AnswerDistribution=answer_distribution,
+            RemovedDuplicates=decimal_convert(job_report.get('RemovedDuplicates'))
         )
 
     except HTTPException:
@@ -358,7 +429,9 @@ async def preview_exam(file: UploadFile = File(...)):
              
         # 1. Parse structure (REQUIRED for ID generation)
         try:
-            structure = await asyncio.to_thread(parse_exam_template, contents)
+            structure = await asyncio.to_thread(parse_cache.get_or_parse, contents)
+        except ParseBudgetExceededError:
+            raise
         except Exception as e:
             logger.error(f"Structure parsing failed: {e}")
             raise HTTPException(status_code=400, detail=f"Lỗi đọc cấu trúc đề thi: {str(e)}")
@@ -375,9 +448,33 @@ async def preview_exam(file: UploadFile = File(...)):
                         answer_map[q.original_idx] = corrects[0]
             
             logger.info(f"Auto-detected {len(answer_map)} answers for marking.")
+        except ParseBudgetExceededError:
+            raise
         except Exception as e:
             logger.warning(f"Auto-marking extraction failed (ignoring): {e}")
 
+        # 3. Cụm câu gần trùng (OPTIONAL) - MinHash/LSH, không so từng cặp
+        duplicate_clusters = []
+        try:
+            for cluster in await asyncio.to_thread(find_near_duplicates, structure):
+                duplicate_clusters.append(DuplicateClusterInfo(
+                    questions=[
+                        DuplicateQuestionInfo(
+                            id=structure.sections[sec_i].questions[q_i].content_hash,
+                            section=sec_i + 1,
+                            number=structure.sections[sec_i].questions[q_i].original_idx,
+                        )
+                        for sec_i, q_i in cluster.members
+                    ],
+                    similarity=cluster.similarity,
+                ))
+            if duplicate_clusters:
+                logger.info(f"Found {len(duplicate_clusters)} near-duplicate clusters.")
+        except ParseBudgetExceededError:
+            raise
+        except Exception as e:
+            logger.warning(f"Near-duplicate detection failed (ignoring): {e}")
+
         serializer = DocxSerializer(doc, answer_map=answer_map)
         
         # Run CPU-bound serialization (rendering)
@@ -396,10 +493,14 @@ async def preview_exam(file: UploadFile = File(...)):
             data=PreviewData(
                 raw_text=raw_text,
                 assets_map=serializer.assets,
-                question_count=total_questions
+                question_count=total_questions,
+                duplicate_clusters=duplicate_clusters
             )
         )
     
+    except ParseBudgetExceededError as e:
+        logger.warning(f"Preview parse budget exceeded: {e.message}")
+        raise HTTPException(status_code=422, detail=e.message)
     except ExamError as e:
         logger.warning(f"Preview Logic Error: {e.message}")
         raise HTTPException(status_code=400, detail=e.message)
@@ -414,11 +515,16 @@ async def preview_exam(file: UploadFile = File(...)):
              raise HTTPException(status_code=400, detail="File không đúng định dạng DOCX hoặc bị hỏng.")
         raise HTTPException(status_code=500, detail=f"Lỗi hệ thống khi xử lý file: {str(e)}")
 
+# --- 5. API THEO DÕI PARSE CACHE ---
+@app.get("/api/parse-cache/stats", response_model=ParseCacheStatsResponse)
+async def get_parse_cache_stats():
+    return ParseCacheStatsResponse(**parse_cache.stats())
+
 # --- EXCEPTION HANDLERS ---
 @app.exception_handler(ExamError)
 async def exam_error_handler(request, exc: ExamError): # type: ignore
     return JSONResponse(
-        status_code=400,
+        status_code=422 if isinstance(exc, ParseBudgetExceededError) else 400,
         content={"detail": exc.message, "code": exc.code}
     )
 
@@ -14,6 +14,11 @@ from botocore.exceptions import BotoCoreError, ClientError
 # Import các module đã tách
 from config import load_settings
 from docx_processor import process_exam_batch
+from core.models import ParseLimits
+from core.parse_cache import ParseCache
+from core.permutations import PERMUTATION_VERSION
+from s3_stream import S3MultipartUploadStream
+from exceptions import ExamError
 
 # 1. Setup & Cấu hình
 SETTINGS = load_settings()
@@ -29,11 +34,22 @@ sqs = None
 s3 = None
 dynamodb = None
 table = None
+parse_cache: Optional[ParseCache] = None
 WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
 
-def _parse_sqs_body(message: Dict[str, Any]) -> Tuple[str, str, Dict[str, str], Optional[List[int]], int, Optional[dict]]:
-    """Parse message body từ SQS, lấy thông tin job. Return thêm answerMap."""
+# Tùy chọn sinh đề: field trong message SQS / manifest -> tham số của process_exam_batch
+_JOB_OPTION_FIELDS = {
+    'answersOnly': 'answers_only',
+    'balanceAnswers': 'balance_answers',
+    'diverseVariants': 'diverse_variants',
+    'drawCounts': 'draw_counts',
+    'dedupeQuestions': 'dedupe_questions',
+}
+
+
+def _parse_sqs_body(message: Dict[str, Any]) -> Tuple[str, str, Optional[List[int]], int, Optional[dict], Dict[str, Any]]:
+    """Parse message body từ SQS, lấy thông tin job. Return thêm answerMap và các tùy chọn sinh đề."""
     raw_body = message.get('Body')
     if not raw_body:
         raise ValueError("Message không có Body")
@@ -59,7 +75,32 @@ def _parse_sqs_body(message: Dict[str, Any]) -> Tuple[str, str, Dict[str, str],
         if isinstance(permutation, list) and all(isinstance(x, int) for x in permutation):
             perm_list = [int(x) for x in permutation]
 
-    return job_id.strip(), file_key.strip(), perm_list, num_variants, answer_map
+    draw_counts = body.get('drawCounts') or None
+    if draw_counts is not None:
+        # Số câu so với từng phần được kiểm tra khi bốc đề (check_draw_counts -> InvalidDrawCountsError)
+        if not isinstance(draw_counts, list) or not all(
+                isinstance(x, int) and not isinstance(x, bool) and x >= 0 for x in draw_counts):
+            raise ValueError("drawCounts không hợp lệ")
+
+    # Tùy chọn sinh đề (truyền thẳng vào process_exam_batch)
+    options: Dict[str, Any] = {
+        'answers_only': bool(body.get('answersOnly', False)),
+        'balance_answers': bool(body.get('balanceAnswers', False)),
+        'diverse_variants': bool(body.get('diverseVariants', False)),
+        'draw_counts': draw_counts,
+        'dedupe_questions': bool(body.get('dedupeQuestions', False)),
+    }
+
+    # Mở rộng job đã xong: numVariants là tổng số mã đề, existingVariants mã đề đầu đã có trong ZIP cũ
+    existing_variants = body.get('existingVariants') or 0
+    if existing_variants:
+        if not isinstance(existing_variants, int) or not 0 < existing_variants < num_variants:
+            raise ValueError("existingVariants không hợp lệ")
+        if body.get('permutationVersion') != PERMUTATION_VERSION:
+            raise ValueError("Job được tạo với thuật toán hoán vị khác, không thể mở rộng")
+        options['existing_variants'] = existing_variants
+
+    return job_id.strip(), file_key.strip(), perm_list, num_variants, answer_map, options
 
 
 
@@ -70,6 +111,26 @@ def _safe_output_key(job_id: str, input_file_key: str) -> str:
     return f"result_{job_id}.zip"
 
 
+def _manifest_key(job_id: str) -> str:
+    """Manifest của job (tham số đã dùng để sinh đề), đọc lại khi mở rộng job."""
+    return f"result_{job_id}.manifest.json"
+
+
+def _build_manifest(job_id: str, file_key: str, num_variants: int, answer_map: Optional[dict],
+                    job_options: Dict[str, Any]) -> Dict[str, Any]:
+    """Manifest cùng format với message SQS để server gửi lại nguyên khi mở rộng job."""
+    manifest: Dict[str, Any] = {
+        'jobId': job_id,
+        'fileKey': file_key,
+        'numVariants': num_variants,
+        'answerMap': answer_map,
+        'permutationVersion': PERMUTATION_VERSION,
+    }
+    for field, option in _JOB_OPTION_FIELDS.items():
+        manifest[field] = job_options.get(option)
+    return manifest
+
+
 def _mark_processing(job_id: str) -> bool:
     """Đánh dấu job đang xử lý trong DynamoDB (Optimistic Locking)."""
     try:
@@ -94,12 +155,14 @@ def _mark_processing(job_id: str) -> bool:
         raise
 
 
-def _mark_done(job_id: str, output_url: str, output_key: str) -> None:
-    """Cập nhật trạng thái Done và lưu link tải."""
+def _mark_done(job_id: str, output_url: str, output_key: str, report: Optional[dict] = None,
+               manifest_key: Optional[str] = None) -> None:
+    """Cập nhật trạng thái Done, lưu link tải và báo cáo xử lý (vd: key đáp án không khớp)."""
     ttl_timestamp = int(time.time()) + 3600  # Link hết hạn sau 1 giờ
     table.update_item(
         Key={'JobId': job_id},
-        UpdateExpression="SET #s = :done, OutputUrl = :url, OutputKey = :okey, UpdatedAt = :ts, ExpiresAt = :ttl",
+        UpdateExpression="SET #s = :done, OutputUrl = :url, OutputKey = :okey, UpdatedAt = :ts, ExpiresAt = :ttl, "
+                         "JobReport = :report, ManifestKey = :mkey",
         ExpressionAttributeNames={'#s': 'Status'},
         ExpressionAttributeValues={
             ':done': 'Done',
@@ -107,6 +170,8 @@ def _mark_done(job_id: str, output_url: str, output_key: str) -> None:
             ':okey': output_key,
             ':ts': int(time.time()),
             ':ttl': ttl_timestamp,
+            ':report': report or {},
+            ':mkey': manifest_key,
         },
     )
 
@@ -133,6 +198,9 @@ def _should_retry(exc: Exception) -> bool:
     """Quyết định có retry message hay không dựa trên loại lỗi."""
     if isinstance(exc, (ValueError, json.JSONDecodeError)):
         return False
+    # Lỗi nội dung đề thi (sai định dạng, vượt ngân sách parse...) chạy lại vẫn lỗi y hệt
+    if isinstance(exc, ExamError):
+        return False
     if isinstance(exc, (BotoCoreError,)):
         return True
     if isinstance(exc, ClientError):
@@ -194,7 +262,7 @@ def process_message() -> None:
 
     try:
         # 1. Parse thông tin job
-        job_id, file_key, permutation, num_variants, answer_map = _parse_sqs_body(message)
+        job_id, file_key, permutation, num_variants, answer_map, job_options = _parse_sqs_body(message)
         logger.info(f"JOB: {job_id} | File: {file_key} | Variants: {num_variants} | Attempt: {receive_count}")
 
         # 2. Kiểm tra số lần retry
@@ -223,6 +291,7 @@ def process_message() -> None:
                 logger.warning(f"Heartbeat failed: {hb_err}")
 
         # 5. Xử lý file trong môi trường tạm (Disk I/O)
+        output_key = _safe_output_key(job_id, file_key)
         with tempfile.TemporaryDirectory(prefix=f"job_{job_id}_") as tmpdir:
             local_input_path = os.path.join(tmpdir, "input.docx")
             local_output_path = os.path.join(tmpdir, "result.zip")
@@ -234,28 +303,54 @@ def process_message() -> None:
             with open(local_input_path, "rb") as f:
                 source_bytes = f.read()
 
-            # --- GỌI MODULE XỬ LÝ ---
-            # Truyền đường dẫn file output và callback
-            process_exam_batch(
+            previous_zip = None
+            if job_options.get('existing_variants'):
+                # Mở rộng job: lấy ZIP cũ để copy thô các mã đề đã sinh
+                local_previous_path = os.path.join(tmpdir, "previous.zip")
+                logger.info(f"Download kết quả cũ s3://{SETTINGS.bucket_output}/{output_key}")
+                s3.download_file(SETTINGS.bucket_output, output_key, local_previous_path)
+                with open(local_previous_path, "rb") as f:
+                    previous_zip = f.read()
+
+            batch_kwargs = dict(
                 source_bytes=source_bytes,
                 job_id=job_id,
                 num_variants=num_variants,
-                output_zip_path=local_output_path,
                 progress_callback=heartbeat_callback,
-                external_answer_map=answer_map
+                external_answer_map=answer_map,
+                workers=SETTINGS.variant_workers,
+                previous_zip=previous_zip,
+                parse_cache=parse_cache,
+                **job_options
             )
 
-            # Upload ZIP lên S3 Output
-            # FIX: Thêm ExtraArgs ở đây để set ContentType metadata cho file trên S3
-            output_key = _safe_output_key(job_id, file_key)
-            logger.info(f"Upload ZIP lên S3: s3://{SETTINGS.bucket_output}/{output_key}")
-
-            s3.upload_file(
-                local_output_path,
-                SETTINGS.bucket_output,
-                output_key,
-                ExtraArgs={'ContentType': 'application/zip'}
-            )
+            if SETTINGS.stream_upload:
+                # --- GỌI MODULE XỬ LÝ: ZIP được upload dần lên S3 trong lúc sinh đề ---
+                logger.info(f"Stream ZIP lên S3: s3://{SETTINGS.bucket_output}/{output_key}")
+                upload_stream = S3MultipartUploadStream(
+                    s3, SETTINGS.bucket_output, output_key, content_type='application/zip'
+                )
+                try:
+                    batch_result = process_exam_batch(output_zip_path=upload_stream, **batch_kwargs)
+                    upload_stream.close()
+                except BaseException:
+                    upload_stream.abort()
+                    raise
+            else:
+                # --- GỌI MODULE XỬ LÝ ---
+                # Truyền đường dẫn file output và callback
+                batch_result = process_exam_batch(output_zip_path=local_output_path, **batch_kwargs)
+
+                # Upload ZIP lên S3 Output
+                # FIX: Thêm ExtraArgs ở đây để set ContentType metadata cho file trên S3
+                logger.info(f"Upload ZIP lên S3: s3://{SETTINGS.bucket_output}/{output_key}")
+
+                s3.upload_file(
+                    local_output_path,
+                    SETTINGS.bucket_output,
+                    output_key,
+                    ExtraArgs={'ContentType': 'application/zip'}
+                )
 
         # 6. Tạo link tải (Presigned URL)
         # FIX: Không cần ExtraArgs ở đây nữa vì file trên S3 đã có metadata đúng
@@ -265,12 +360,19 @@ def process_message() -> None:
             ExpiresIn=SETTINGS.presign_expires_in
         )
 
-        # 7. Hoàn tất
-        _mark_done(job_id, presigned_url, output_key)
+        # 7. Lưu manifest (để mở rộng job sau này) và hoàn tất
+        manifest_key = _manifest_key(job_id)
+        s3.put_object(
+            Bucket=SETTINGS.bucket_output,
+            Key=manifest_key,
+            Body=json.dumps(_build_manifest(job_id, file_key, num_variants, answer_map, job_options)).encode("utf-8"),
+            ContentType='application/json'
+        )
+        _mark_done(job_id, presigned_url, output_key, batch_result.to_report(), manifest_key)
         sqs.delete_message(QueueUrl=SETTINGS.queue_url, ReceiptHandle=receipt_handle)
 
         elapsed_ms = int((time.time() - started_at) * 1000)
-        logger.info(f"Hoàn tất job: {job_id} trong {elapsed_ms}ms")
+        logger.info(f"Hoàn tất job: {job_id} trong {elapsed_ms}ms | Parse cache: {parse_cache.stats()}")
 
     except Exception as e:
         logger.exception(f"Lỗi job {job_id}: {e}")
@@ -287,7 +389,7 @@ def process_message() -> None:
 
 def run_worker_process(worker_num: int) -> None:
     """Hàm khởi chạy cho mỗi process con."""
-    global sqs, s3, dynamodb, table
+    global sqs, s3, dynamodb, table, parse_cache
 
     # Khởi tạo client boto3 trong từng process (best practice cho multiprocessing)
     # Reload settings để đảm bảo biến môi trường cập nhật nếu cần
@@ -297,6 +399,14 @@ def run_worker_process(worker_num: int) -> None:
     s3 = boto3.client('s3', region_name=settings.region)
     dynamodb = boto3.resource('dynamodb', region_name=settings.region)
     table = dynamodb.Table(settings.table_name)
+    parse_cache = ParseCache(
+        max_bytes=settings.parse_cache_mb * 1024 * 1024,
+        disk_dir=settings.parse_cache_dir or None,
+        s3_client=s3 if settings.parse_cache_s3 else None,
+        s3_bucket=settings.bucket_output,
+        parse_backend=settings.parse_backend,
+        parse_limits=ParseLimits(settings.parse_max_seconds, settings.parse_max_blocks, settings.parse_max_runs),
+    )
 
     logger.info(f"Process-{worker_num} (PID: {os.getpid()}) khởi động.")
 
@@ -0,0 +1,63 @@
+import io
+import os
+import sys
+
+import pytest
+from docx import Document
+
+# Các module backend import theo kiểu "from core.x import ..." (chạy từ thư mục backend)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+
+def build_docx(blocks) -> bytes:
+    """
+    Dựng file DOCX từ danh sách block:
+    - str: một đoạn văn một run
+    - list[(text, fmt)]: một đoạn văn nhiều run, fmt là dict {"underline": True, "bold": True}
+    - dict {"table": [[ô, ...], ...]}: một bảng
+    """
+    doc = Document()
+    for block in blocks:
+        if isinstance(block, dict):
+            rows = block["table"]
+            table = doc.add_table(rows=len(rows), cols=max(len(r) for r in rows))
+            for r_i, row in enumerate(rows):
+                for c_i, value in enumerate(row):
+                    table.cell(r_i, c_i).text = value
+            continue
+        p = doc.add_paragraph()
+        runs = [(block, {})] if isinstance(block, str) else block
+        for text, fmt in runs:
+            run = p.add_run(text)
+            run.underline = fmt.get("underline")
+            run.bold = fmt.get("bold")
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def exam_blocks(mcq: int = 8, tf: int = 2, short: int = 2):
+    """Đề mẫu 3 phần; đáp án MCQ đánh dấu gạch chân, xoay vòng A-D."""
+    blocks = ["ĐỀ KIỂM TRA", "Mã đề: 000", "PHẦN I. Trắc nghiệm nhiều lựa chọn"]
+    for i in range(1, mcq + 1):
+        blocks.append(f"Câu {i}: Nội dung câu hỏi trắc nghiệm số {i} về chủ đề {i * 7 % 11}")
+        for j, letter in enumerate("ABCD"):
+            blocks.append([(f"{letter}.", {"underline": j == i % 4}), (f" lựa chọn {letter}{i}", {})])
+    if tf:
+        blocks.append("PHẦN II. Đúng sai")
+        for i in range(1, tf + 1):
+            blocks.append(f"Câu {i}. Mệnh đề đúng sai số {i}")
+            for j, letter in enumerate("abcd"):
+                blocks.append([(f"{letter}) ý {letter} của mệnh đề {i}", {"underline": (i + j) % 2 == 0})])
+    if short:
+        blocks.append("PHẦN III. Trả lời ngắn")
+        for i in range(1, short + 1):
+            blocks.append(f"Câu {i}: Tính giá trị biểu thức số {i}")
+            blocks.append(f"Đáp án: {i * 3}")
+    blocks.append("----- HẾT -----")
+    return blocks
+
+
+@pytest.fixture
+def exam_docx() -> bytes:
+    return build_docx(exam_blocks())
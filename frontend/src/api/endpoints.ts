@@ -5,6 +5,7 @@ import {
     UploadUrlResponse,
     SubmitJobRequest,
     SubmitJobResponse,
+    ExtendJobRequest,
     JobStatusResponse,
     PreviewResponse,
     UploadProgress,
@@ -54,6 +55,14 @@ export const examApi = {
         return response.data;
     },
 
+    /**
+     * Generate more exam codes for a finished job
+     */
+    extendJob: async (jobId: string, request: ExtendJobRequest): Promise<SubmitJobResponse> => {
+        const response = await apiClient.post<SubmitJobResponse>(`/api/extend-job/${jobId}`, request);
+        return response.data;
+    },
+
     /**
      * Get job status
      */
@@ -15,6 +15,16 @@ export interface SubmitJobRequest {
     fileKey: string;
     numVariants?: number;
     rawText?: string;
+    answersOnly?: boolean;
+    balanceAnswers?: boolean;
+    diverseVariants?: boolean;
+    // Mỗi phần một số nguyên 0..số câu của phần (0 = lấy cả phần)
+    drawCounts?: number[];
+    dedupeQuestions?: boolean;
+}
+
+export interface ExtendJobRequest {
+    additionalVariants: number;
 }
 
 // === RESPONSE TYPES ===
@@ -30,6 +40,13 @@ export interface SubmitJobResponse {
     jobId: string;
 }
 
+export interface AnswerKeyMatchReport {
+    TotalKeys: number;
+    MatchedByHash: number;
+    MatchedByIndex: number;
+    UnmatchedKeys: string[];
+}
+
 export interface JobStatusResponse {
     JobId: string;
     Status: 'PendingUpload' | 'Queued' | 'Processing' | 'Done' | 'Failed';
@@ -37,12 +54,27 @@ export interface JobStatusResponse {
     CreatedAt: number;
     UpdatedAt: number;
     LastError?: string;
+    AnswerKeyReport?: AnswerKeyMatchReport | null;
+    AnswerDistribution?: Record<string, number> | null;
+    RemovedDuplicates?: number | null;
+}
+
+export interface DuplicateQuestionInfo {
+    id: string | null;
+    section: number;
+    number: number;
+}
+
+export interface DuplicateClusterInfo {
+    questions: DuplicateQuestionInfo[];
+    similarity: number;
 }
 
 export interface PreviewData {
     raw_text: string;
     assets_map: Record<string, AssetItem>;
     question_count: number;
+    duplicate_clusters?: DuplicateClusterInfo[];
 }
 
 export interface PreviewResponse {
@@ -0,0 +1,37 @@
+from core.generators import apply_answer_key, resolve_answer_key
+from core.parsers import parse_exam_template
+
+
+def _correct(q):
+    return "".join(opt.label[0] for opt in q.options if opt.is_correct)
+
+
+def test_answer_map_matches_by_hash_then_index(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    mcq, tf, short = (sec.questions for sec in structure.sections)
+
+    key = resolve_answer_key({mcq[2].content_hash: "a", "4": "B, C", tf[0].content_hash: "b,d",
+                              short[1].content_hash: "12,5", "99": "A"})
+    stats = apply_answer_key(structure, key)
+
+    assert (stats.total_keys, stats.matched_by_hash, stats.matched_by_index) == (5, 3, 1)
+    assert stats.unmatched_keys == ["99"]
+    assert _correct(mcq[2]) == "A"
+    assert _correct(mcq[3]) == "BC"
+    assert _correct(tf[0]) == "bd"
+    assert short[1].correct_answer_text == "12,5"
+
+
+def test_index_key_applies_to_every_section_with_that_number(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    stats = apply_answer_key(structure, resolve_answer_key({"1": "D"}))
+    assert stats.matched_by_index == 3
+    assert [_correct(sec.questions[0]) for sec in structure.sections[:2]] == ["D", "d"]
+
+
+def test_empty_map_changes_nothing(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    before = [_correct(q) for sec in structure.sections for q in sec.questions]
+    stats = apply_answer_key(structure, resolve_answer_key(None))
+    assert stats.matched_questions == 0
+    assert [_correct(q) for sec in structure.sections for q in sec.questions] == before
@@ -0,0 +1,114 @@
+import io
+import multiprocessing
+import zipfile
+
+import openpyxl
+import pytest
+
+import docx_processor
+from conftest import build_docx, exam_blocks
+from core.parsers import parse_exam_template
+from core.permutations import plan_batch
+from docx_processor import process_exam_batch
+from exceptions import ExamError, InvalidDrawCountsError
+
+
+def _sheets(data: bytes) -> dict:
+    """Nội dung các sheet của file Excel (file xlsx có thời gian tạo nên không so sánh bytes)."""
+    wb = openpyxl.load_workbook(io.BytesIO(data))
+    return {ws.title: [list(row) for row in ws.iter_rows(values_only=True)] for ws in wb.worksheets}
+
+
+def _entries(data: bytes) -> dict:
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        return {name: _sheets(zf.read(name)) if name.endswith(".xlsx") else zf.read(name) for name in zf.namelist()}
+
+
+def _run_batch(source: bytes, **kwargs) -> dict:
+    out = io.BytesIO()
+    process_exam_batch(source, "job-pipeline", 4, out, **kwargs)
+    return _entries(out.getvalue())
+
+
+def test_pool_is_forked_before_writer_thread(exam_docx, monkeypatch):
+    children_at_start = []
+    original_start = docx_processor._ZipWriterStage.start
+
+    def start(self):
+        children_at_start.append(len(multiprocessing.active_children()))
+        original_start(self)
+
+    monkeypatch.setattr(docx_processor._ZipWriterStage, "start", start)
+    parallel = _run_batch(exam_docx, workers=2)
+
+    assert children_at_start == [2]
+    assert parallel == _run_batch(exam_docx, workers=1)
+    assert sorted(parallel) == ["Bang_Dap_An_job-pipeline.xlsx"] + [f"Ma_De_{c}.docx" for c in range(101, 105)]
+
+
+def test_parallel_matches_sequential(exam_docx):
+    for render_mode in ("tree", "fragments"):
+        assert _run_batch(exam_docx, workers=3, render_mode=render_mode) == \
+            _run_batch(exam_docx, workers=1, render_mode=render_mode)
+
+
+def test_without_fork_generates_sequentially(exam_docx, monkeypatch):
+    expected = _run_batch(exam_docx, workers=1)
+    monkeypatch.setattr(multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+    monkeypatch.setattr(multiprocessing, "get_context", None)  # Không được tạo pool
+    assert _run_batch(exam_docx, workers=4) == expected
+
+
+def test_answers_only_matches_rendered_answer_key(exam_docx):
+    full = _run_batch(exam_docx, balance_answers=True)
+    answers_only = _run_batch(exam_docx, balance_answers=True, answers_only=True)
+    assert list(answers_only) == ["Bang_Dap_An_job-pipeline.xlsx"]
+    assert answers_only["Bang_Dap_An_job-pipeline.xlsx"] == full["Bang_Dap_An_job-pipeline.xlsx"]
+
+
+def test_extending_a_job_keeps_existing_variants_byte_identical(exam_docx):
+    first = io.BytesIO()
+    process_exam_batch(exam_docx, "job-extend", 3, first, draw_counts=[6, 0, 0])
+    extended = io.BytesIO()
+    process_exam_batch(exam_docx, "job-extend", 5, extended, draw_counts=[6, 0, 0],
+                       existing_variants=3, previous_zip=first.getvalue())
+    fresh = io.BytesIO()
+    process_exam_batch(exam_docx, "job-extend", 5, fresh, draw_counts=[6, 0, 0])
+
+    before, after, full = (_entries(buf.getvalue()) for buf in (first, extended, fresh))
+    for code in (101, 102, 103):
+        assert after[f"Ma_De_{code}.docx"] == before[f"Ma_De_{code}.docx"]
+    assert after == full
+
+
+def test_oversized_draw_count_is_a_typed_exam_error(exam_docx):
+    # Phần I chỉ có 8 câu: lỗi nội dung job (ExamError) -> worker không retry
+    with pytest.raises(InvalidDrawCountsError) as info:
+        process_exam_batch(exam_docx, "job-draw", 2, io.BytesIO(), draw_counts=[9, 0, 0])
+    assert isinstance(info.value, ExamError)
+
+
+@pytest.mark.parametrize("options", [
+    {"render_mode": "fragments"},
+    {"render_mode": "tree"},
+    {"render_mode": "fragments", "workers": 2},
+    {"answers_only": True},
+    {"external_answer_map": {"3": "B", "15": "C"}},
+])
+def test_undrawn_bank_questions_stay_unparsed(monkeypatch, options):
+    source = build_docx(exam_blocks(mcq=20, tf=0, short=0))
+    parsed = []
+
+    def parse(data):
+        parsed.append(parse_exam_template(data))
+        return parsed[-1]
+
+    monkeypatch.setattr(docx_processor, "parse_exam_template", parse)
+    process_exam_batch(source, "job-bank", 2, io.BytesIO(), draw_counts=[4], **options)
+
+    drawn = set(plan_batch(parse_exam_template(source), "job-bank", 2, draw_counts=[4]).question_map.ravel().tolist())
+    resolved = {q_i for q_i, q in enumerate(parsed[0].sections[0].questions) if q.resolved}
+    # Câu đầu được resolve lúc parse (kiểm tra đáp án inline), còn lại chỉ các câu được bốc
+    assert resolved <= drawn | {0}
+    assert len(resolved) <= 9
@@ -0,0 +1,52 @@
+import re
+
+import pytest
+
+from core.classifier import BlockClassifier
+from core.constants import BLOCK_RULES
+
+LINES = [
+    ("Câu 12: Nội dung", "question", "12", False),
+    ("  câu 3. chữ thường", "question", "3", False),
+    ("[ID:ab12] Câu 4: có thẻ ID", "question", "4", False),
+    ("Bài 5) Bài toán", "question", "5", False),
+    ("PHẦN I. TRẮC NGHIỆM", "section", "", False),
+    ("Phần 2: Đúng sai", "section", "", False),
+    ("II. Tự luận", "section", "", False),
+    ("A. lựa chọn", "option", "A", False),
+    ("*C) lựa chọn đúng", "option", "C", True),
+    ("a) ý đúng sai", "sub_option", "a", False),
+    ("*d) ý đúng", "sub_option", "d", True),
+    ("e) không phải ý đúng sai", "text", "", False),
+    ("ĐÁP ÁN", "answer_header", "", False),
+    ("BẢNG ĐÁP ÁN TRẮC NGHIỆM", "answer_header", "", False),
+    ("Đáp án: B", "answer_line", "", False),
+    ("----- HẾT -----", "end_note", "", False),
+    ("GIÁM THỊ KHÔNG GIẢI THÍCH GÌ THÊM", "end_note", "", False),
+    ("Cho hàm số y = f(x)", "text", "", False),
+    ("", "text", "", False),
+]
+
+
+@pytest.mark.parametrize("text, role, label, starred", LINES)
+def test_classify(text, role, label, starred):
+    assert BlockClassifier().classify(text, text.strip())[:3] == (role, label, starred)
+
+
+@pytest.mark.parametrize("text", [line[0] for line in LINES])
+def test_matches_first_rule_in_table_order(text):
+    """Pattern gộp cho cùng kết quả với việc thử từng luật theo thứ tự BLOCK_RULES."""
+    expected = "text"
+    for rule in BLOCK_RULES:
+        if re.match(r"^\s*(?:" + rule.pattern + ")", text, re.IGNORECASE if rule.ignore_case else 0):
+            expected = rule.role
+            break
+    assert BlockClassifier().classify(text, text.strip())[0] == expected
+
+
+def test_label_end_and_inline_options():
+    classifier = BlockClassifier()
+    role, label, _, end, inline = classifier.classify("  A. một  B. hai", "A. một  B. hai")
+    assert (role, label, inline) == ("option", "A", True)
+    assert "  A. một  B. hai"[end:] == "một  B. hai"
+    assert not classifier.classify("A. chỉ một phương án", "A. chỉ một phương án")[4]
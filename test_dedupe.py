@@ -0,0 +1,37 @@
+from conftest import build_docx
+from core.dedupe import drop_near_duplicates, find_near_duplicates
+from core.parsers import parse_exam_template
+
+STEM = "Cho hàm số y bằng x mũ ba trừ ba x cộng hai có đồ thị là đường cong như hình bên, số điểm cực trị của hàm số là"
+
+
+def _bank():
+    blocks = ["PHẦN I. Trắc nghiệm"]
+    stems = [
+        STEM,
+        "Trong không gian tọa độ Oxyz cho mặt cầu tâm I bán kính R, tính diện tích mặt cầu đã cho",
+        STEM.replace("ba x", "bốn x"),                               # gần trùng câu 1
+        "Một hộp có năm viên bi đỏ và bốn viên bi xanh, lấy ngẫu nhiên hai viên, xác suất cùng màu là",
+    ]
+    for i, stem in enumerate(stems, 1):
+        blocks += [f"Câu {i}: {stem}", "*A. 0", "B. 1", "C. 2", "D. 3"]
+    blocks += ["PHẦN II. Tự luận", f"Câu 1: {STEM}", "*A. 0", "B. 1", "C. 2", "D. 3"]  # trùng khác phần
+    return parse_exam_template(build_docx(blocks))
+
+
+def test_clusters_near_duplicates_across_sections():
+    clusters = find_near_duplicates(_bank())
+    assert [c.members for c in clusters] == [((0, 0), (0, 2), (1, 0))]
+    assert 0.8 <= clusters[0].similarity < 1.0
+
+
+def test_drop_keeps_first_member_of_each_cluster():
+    structure = _bank()
+    removed = drop_near_duplicates(structure, find_near_duplicates(structure))
+    assert removed == 2
+    assert [[q.original_idx for q in sec.questions] for sec in structure.sections] == [[1, 2, 4], []]
+    assert find_near_duplicates(structure) == []
+
+
+def test_distinct_questions_are_not_clustered(exam_docx):
+    assert find_near_duplicates(parse_exam_template(exam_docx), threshold=0.95) == []
@@ -0,0 +1,56 @@
+import io
+import zipfile
+
+from lxml import etree
+
+from conftest import build_docx, exam_blocks
+from core.generators import RENDER_FRAGMENTS, RENDER_TREE, generate_variant_from_template
+from core.parsers import parse_exam_template
+from core.template import compile_template
+
+
+def _document_xml(docx_bytes: bytes) -> bytes:
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as zf:
+        return zf.read("word/document.xml")
+
+
+def _render(source: bytes, render_mode: str, exam_code: str = "101", seed: int = 7):
+    template = compile_template(source, parse_exam_template(source))
+    docx_bytes, answers = generate_variant_from_template(template, seed, exam_code, render_mode=render_mode)
+    return template, _document_xml(docx_bytes), answers
+
+
+def test_fragments_match_tree(exam_docx):
+    _, tree_xml, tree_answers = _render(exam_docx, RENDER_TREE)
+    _, frag_xml, frag_answers = _render(exam_docx, RENDER_FRAGMENTS)
+    assert etree.tostring(etree.fromstring(frag_xml), method="c14n") == \
+        etree.tostring(etree.fromstring(tree_xml), method="c14n")
+    assert frag_answers == tree_answers
+
+
+def test_slot_char_in_template_falls_back_to_tree():
+    blocks = exam_blocks(mcq=4, tf=0, short=0)
+    blocks[3] = "Câu 1: Ký tự riêng \ue000 nằm trong đề"
+    source = build_docx(blocks)
+
+    template, frag_xml, _ = _render(source, RENDER_FRAGMENTS)
+    _, tree_xml, _ = _render(source, RENDER_TREE)
+
+    # Chỉ câu chứa ký tự slot không có fragment -> mã đề có câu đó render bằng tree
+    assert template.fragments is not None and template.fragments.sections[0].questions[0] is None
+    assert frag_xml == tree_xml
+    assert "Ký tự riêng \ue000 nằm trong đề" in etree.fromstring(frag_xml).xpath("string()")
+
+
+def test_exam_code_is_escaped():
+    _, frag_xml, _ = _render(build_docx(exam_blocks(mcq=2, tf=0, short=0)), RENDER_FRAGMENTS, exam_code="A&B<1>")
+    root = etree.fromstring(frag_xml)
+    assert "Mã đề: A&B<1>" in root.xpath("string()")
+
+
+def test_slot_char_in_header_disables_fragments():
+    blocks = exam_blocks(mcq=2, tf=0, short=0)
+    blocks[0] = "ĐỀ KIỂM TRA \ue000"
+    template, frag_xml, _ = _render(build_docx(blocks), RENDER_FRAGMENTS)
+    assert template.fragments is None and not template.fragments_supported
+    assert "ĐỀ KIỂM TRA \ue000" in etree.fromstring(frag_xml).xpath("string()")
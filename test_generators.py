@@ -0,0 +1,65 @@
+import io
+import re
+
+import pytest
+from docx import Document
+from lxml import etree
+
+from core.generators import generate_variant_from_structure, generate_variant_from_template
+from core.parsers import parse_exam_template
+from core.template import compile_template
+
+
+def test_reused_template_matches_fresh_compile(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    template = compile_template(exam_docx, structure)
+    for seed, code in ((1, "101"), (2, "102"), (3, "103")):
+        reused = generate_variant_from_template(template, seed, code)
+        fresh = generate_variant_from_structure(exam_docx, parse_exam_template(exam_docx), seed, code)
+        assert reused == fresh
+        # Template sẵn sàng cho mã đề tiếp theo: body chỉ còn sectPr
+        assert [child.tag for child in template.body] == [etree.QName(template.sect_pr).text]
+
+
+def _serialized(structure) -> list:
+    elements = list(structure.header_elements) + list(structure.footer_elements)
+    for sec in structure.sections:
+        elements.extend(sec.info_elements)
+        for q in sec.questions:
+            elements.extend(q.stem_elements)
+            for opt in q.options:
+                elements.extend(opt.elements)
+    return [etree.tostring(el) for el in elements]
+
+
+def test_rendering_does_not_modify_template(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    template = compile_template(exam_docx, structure)
+    before = _serialized(structure)
+    labels = [[opt.label for opt in q.options] for sec in structure.sections for q in sec.questions]
+    for render_mode in ("tree", "fragments"):
+        for seed in range(3):
+            generate_variant_from_template(template, seed, f"10{seed}", render_mode=render_mode)
+    assert _serialized(structure) == before
+    assert [[opt.label for opt in q.options] for sec in structure.sections for q in sec.questions] == labels
+
+
+@pytest.mark.parametrize("render_mode", ["tree", "fragments"])
+def test_labels_are_rewritten_in_place(exam_docx, render_mode):
+    template = compile_template(exam_docx, parse_exam_template(exam_docx))
+    docx_bytes, answers = generate_variant_from_template(template, 11, "101", render_mode=render_mode)
+    lines = [p.text for p in Document(io.BytesIO(docx_bytes)).paragraphs]
+
+    numbers = [int(m.group(1)) for m in map(re.compile(r"^Câu (\d+): ").match, lines) if m]
+    assert numbers == list(range(1, len(numbers) + 1))
+
+    # Phương án MCQ được in lại nhãn A-D theo vị trí mới; đáp án trỏ đúng phương án gốc đã đánh dấu
+    for q_no in range(1, 9):
+        start = lines.index(next(line for line in lines if line.startswith(f"Câu {q_no}: ")))
+        options = lines[start + 1:start + 5]
+        assert [line[:3] for line in options] == ["A. ", "B. ", "C. ", "D. "]
+        # "X. lựa chọn Yi": X = nhãn mới, Y = nhãn gốc của câu gốc i (đáp án gốc là "ABCD"[i % 4])
+        picked = [re.search(r"lựa chọn ([A-D])(\d+)$", line).groups() for line in options]
+        original_no = int(picked[0][1])
+        new_label = {old: "ABCD"[pos] for pos, (old, _) in enumerate(picked)}
+        assert answers[q_no - 1] == new_label["ABCD"[original_no % 4]]
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from job_queue import queue_job_extension
+
+
+class FakeTable:
+    """Bảng DynamoDB một item; chỉ hiểu các điều kiện job_queue dùng (#s = :x [AND NumVariants = :y])."""
+
+    def __init__(self, item):
+        self.item = dict(item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ConditionExpression=None):
+        values = ExpressionAttributeValues
+        if ConditionExpression:
+            for clause in ConditionExpression.split(" AND "):
+                field, placeholder = (part.strip() for part in clause.split("="))
+                field = ExpressionAttributeNames.get(field, field)
+                if self.item.get(field) != values[placeholder]:
+                    raise RuntimeError("ConditionalCheckFailedException")
+        for assignment in UpdateExpression[len("SET "):].split(","):
+            field, placeholder = (part.strip() for part in assignment.split("="))
+            self.item[ExpressionAttributeNames.get(field, field)] = values[placeholder]
+
+
+class FakeQueue:
+    def __init__(self, error=None):
+        self.error = error
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        if self.error:
+            raise self.error
+        self.messages.append(json.loads(MessageBody))
+
+
+MANIFEST = {"jobId": "job-1", "fileKey": "uploads/a.docx", "numVariants": 4, "permutationVersion": 3}
+
+
+def test_extension_queues_the_new_variants():
+    table, queue = FakeTable({"JobId": "job-1", "Status": "Done", "NumVariants": 4}), FakeQueue()
+    assert queue_job_extension(table, queue, "queue", "job-1", MANIFEST, 3) == 7
+    assert table.item["Status"] == "Queued" and table.item["NumVariants"] == 7
+    assert queue.messages[0]["numVariants"] == 7 and queue.messages[0]["existingVariants"] == 4
+
+
+def test_sqs_failure_restores_the_job_so_it_can_be_extended_again():
+    table = FakeTable({"JobId": "job-1", "Status": "Done", "NumVariants": 4})
+    with pytest.raises(ConnectionError):
+        queue_job_extension(table, FakeQueue(ConnectionError("SQS down")), "queue", "job-1", MANIFEST, 3)
+    assert table.item["Status"] == "Done" and table.item["NumVariants"] == 4
+
+    queue = FakeQueue()
+    assert queue_job_extension(table, queue, "queue", "job-1", MANIFEST, 3) == 7
+    assert len(queue.messages) == 1
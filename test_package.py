@@ -0,0 +1,69 @@
+import io
+import zipfile
+
+import pytest
+
+from core import package
+from core.package import DocxPackage, copy_entries
+
+
+def _source_archive() -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("[Content_Types].xml", b"<Types/>", compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("word/document.xml", b"<w:document/>" * 50, compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr("word/media/image1.png", bytes(range(256)) * 8, compress_type=zipfile.ZIP_STORED)
+        zf.writestr("word/styles.xml", b"<w:styles>" + b"x" * 4000 + b"</w:styles>", compress_type=zipfile.ZIP_DEFLATED)
+    return buf.getvalue()
+
+
+def _contents(data: bytes) -> dict:
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        return {info.filename: zf.read(info) for info in zf.infolist()}
+
+
+@pytest.fixture(params=["fast", "fallback"])
+def raw_write_path(request, monkeypatch):
+    if request.param == "fallback":
+        monkeypatch.setattr(package, "_supports_raw_write", lambda out: False)
+    return request.param
+
+
+def test_copy_entries_round_trip(raw_write_path):
+    source = _source_archive()
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as out:
+        copied = copy_entries(out, source, skip=("word/styles.xml",))
+        out.writestr("answers.json", b"{}")
+    result = _contents(buf.getvalue())
+
+    expected = _contents(source)
+    del expected["word/styles.xml"]
+    expected["answers.json"] = b"{}"
+    assert copied == ["[Content_Types].xml", "word/document.xml", "word/media/image1.png"]
+    assert result == expected
+
+
+def test_docx_package_round_trip(raw_write_path):
+    source = _source_archive()
+    result = _contents(DocxPackage(source).write(b"<w:document>new</w:document>"))
+
+    expected = _contents(source)
+    expected["word/document.xml"] = b"<w:document>new</w:document>"
+    assert result == expected
+
+
+def test_fallback_rejects_corrupt_entry(monkeypatch):
+    monkeypatch.setattr(package, "_supports_raw_write", lambda out: False)
+    with zipfile.ZipFile(io.BytesIO(_source_archive())) as zf:
+        info = zf.getinfo("word/media/image1.png")
+    with zipfile.ZipFile(io.BytesIO(), "w") as out:
+        with pytest.raises(zipfile.BadZipFile):
+            package.write_raw_entry(out, info, b"\x00" * info.compress_size)
+
+
+def test_unsupported_python_uses_fallback(monkeypatch):
+    monkeypatch.setattr(package, "_RAW_WRITE_PYTHON", ((2, 0), (2, 7)))
+    with zipfile.ZipFile(io.BytesIO(), "w") as out:
+        assert not package._supports_raw_write(out)
@@ -0,0 +1,66 @@
+import pickle
+
+import pytest
+
+from conftest import build_docx, exam_blocks
+from core import parsers
+from core.models import ParseLimits
+from core.parse_cache import ParseCache
+from core.parsers import PARSE_BACKEND_DOCX, PARSE_BACKEND_STREAM, parse_exam_template
+from exceptions import ParseBudgetExceededError
+
+
+def _questions(structure):
+    return [q for sec in structure.sections for q in sec.questions]
+
+
+@pytest.mark.parametrize("backend", [PARSE_BACKEND_DOCX, PARSE_BACKEND_STREAM])
+def test_block_limit(exam_docx, backend):
+    with pytest.raises(ParseBudgetExceededError) as err:
+        parse_exam_template(exam_docx, backend, ParseLimits(max_blocks=10))
+    assert err.value.code == "PARSE_BUDGET_EXCEEDED"
+
+
+DEFAULT_LIMITS = ParseLimits(max_seconds=60, max_blocks=200_000, max_runs=2_000_000)
+
+
+def test_default_limits_keep_questions_lazy(exam_docx):
+    structure = parse_exam_template(exam_docx, limits=DEFAULT_LIMITS)
+    unresolved = [q for q in _questions(structure) if not q.resolved]
+    assert len(unresolved) == len(_questions(structure)) - 1   # chỉ câu đầu (kiểm tra đáp án inline)
+
+    for q in unresolved:
+        q.resolve()
+    assert all(q.resolved for q in _questions(structure))
+
+
+def test_overrun_while_resolving_a_question_is_raised_on_resolve(exam_docx, monkeypatch):
+    parse_question = parsers._parse_question
+
+    def expensive(q, raw_chunk, table_answer, budget):
+        if q.original_idx == 5:
+            budget.charge(runs=budget.limits.max_runs)
+        parse_question(q, raw_chunk, table_answer, budget)
+
+    monkeypatch.setattr(parsers, "_parse_question", expensive)
+    structure = parse_exam_template(exam_docx, limits=DEFAULT_LIMITS)
+    question = next(q for q in _questions(structure) if q.original_idx == 5)
+    assert not question.resolved
+    with pytest.raises(ParseBudgetExceededError):
+        question.resolve()
+
+
+def test_cache_does_not_store_failed_parse():
+    source = build_docx(exam_blocks(mcq=20))
+    cache = ParseCache(parse_limits=ParseLimits(max_blocks=20))
+    for _ in range(2):
+        with pytest.raises(ParseBudgetExceededError):
+            cache.get_or_parse(source)
+    assert cache.stats()["misses"] == 2 and cache.stats()["entries"] == 0
+
+
+def test_error_survives_pickling():
+    # Lỗi từ process con của pool được pickle về process cha
+    err = pickle.loads(pickle.dumps(ParseBudgetExceededError("quá giới hạn")))
+    assert isinstance(err, ParseBudgetExceededError)
+    assert (err.message, err.code) == ("quá giới hạn", "PARSE_BUDGET_EXCEEDED")
@@ -0,0 +1,61 @@
+from core.generators import apply_answer_key, resolve_answer_key
+from core.models import LazyQuestionBlock
+from core.parse_cache import ParseCache
+
+
+def _questions(structure):
+    return [q for sec in structure.sections for q in sec.questions]
+
+
+def test_miss_keeps_questions_lazy(exam_docx):
+    cache = ParseCache()
+    structure = cache.get_or_parse(exam_docx)
+
+    # Chỉ câu đầu được resolve lúc parse (kiểm tra có đáp án inline)
+    questions = _questions(structure)
+    assert all(isinstance(q, LazyQuestionBlock) for q in questions)
+    assert not any(q.resolved for q in questions[1:])
+    assert cache.stats()["entries"] == 0
+
+    # Entry được ghi khi câu hỏi cuối cùng được resolve
+    for q in questions[:-1]:
+        q.options
+    assert cache.stats()["entries"] == 0
+    questions[-1].options
+    assert cache.stats()["entries"] == 1
+
+
+def test_entry_keeps_parsed_answers_not_caller_edits(exam_docx):
+    cache = ParseCache()
+    structure = cache.get_or_parse(exam_docx)
+    first = structure.sections[0].questions[0]
+    parsed = [opt.is_correct for opt in first.options]
+
+    # Người gọi sửa structure (áp đáp án ngoài, bỏ câu) trước khi resolve hết các câu còn lại
+    apply_answer_key(structure, resolve_answer_key({"1": "D", "2": "A"}))
+    structure.sections[0].questions[1].options  # Lọc trùng đọc mọi câu trước khi bỏ câu
+    del structure.sections[0].questions[1]
+    assert cache.stats()["entries"] == 0
+    for q in _questions(structure):
+        q.options
+
+    cached = cache.get_or_parse(exam_docx)
+    assert cache.stats()["memory_hits"] == 1
+    assert [opt.is_correct for opt in cached.sections[0].questions[0].options] == parsed
+    assert [len(sec.questions) for sec in cached.sections] == [8, 2, 2]
+
+
+def test_disk_tier_is_shared_and_survives_bad_entries(exam_docx, tmp_path):
+    first = ParseCache(disk_dir=str(tmp_path))
+    for q in _questions(first.get_or_parse(exam_docx)):
+        q.options
+
+    second = ParseCache(disk_dir=str(tmp_path))
+    cached = second.get_or_parse(exam_docx)
+    assert second.stats()["disk_hits"] == 1
+    assert [q.content_hash for q in _questions(cached)] == [q.content_hash for q in _questions(first.get_or_parse(exam_docx))]
+
+    for path in tmp_path.iterdir():
+        path.write_bytes(b"corrupt")
+    third = ParseCache(disk_dir=str(tmp_path))
+    assert len(_questions(third.get_or_parse(exam_docx))) == 12
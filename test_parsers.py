@@ -0,0 +1,152 @@
+import hashlib
+import io
+
+import pytest
+from docx import Document
+from docx.enum.text import WD_COLOR_INDEX
+from docx.shared import RGBColor
+
+from conftest import build_docx
+from core.models import LazyQuestionBlock, MarkSpans
+from core.parsers import PARSE_BACKEND_DOCX, PARSE_BACKEND_STREAM, _build_block_index, parse_exam_template
+from core.structure_format import encode_structure
+from core.utils import _iter_block_items, _scan_paragraph
+
+
+def _index(blocks):
+    return _build_block_index(_iter_block_items(Document(io.BytesIO(build_docx(blocks)))))
+
+
+def _correct(q):
+    return "".join(opt.label[0] for opt in q.options if opt.is_correct)
+
+
+def test_block_index_roles_and_labels():
+    index = _index([
+        "Mã đề: 000", "PHẦN I. Trắc nghiệm", "Câu 12: Nội dung", "*B. lựa chọn", "A. một B. hai C. ba",
+        "a) ý một", "Đáp án: 3", "----- HẾT -----", {"table": [["Câu 3", "x"]]},
+    ])
+    assert [(ib.kind, ib.role, ib.label, ib.starred) for ib in index] == [
+        ("p", "text", "", False), ("p", "section", "", False), ("p", "question", "12", False),
+        ("p", "option", "B", True), ("p", "option", "A", False), ("p", "sub_option", "a", False),
+        ("p", "answer_line", "", False), ("p", "end_note", "", False),
+        # Bảng được làm phẳng thành các đoạn văn trong ô
+        ("p", "question", "3", False), ("p", "text", "", False),
+    ]
+    assert index[2].text[:index[2].label_end] == "Câu 12"
+    assert index[4].has_inline_options and not index[3].has_inline_options
+
+
+def test_parse_sections_modes_and_answers(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    assert [sec.title for sec in structure.sections] == [
+        "PHẦN I. Trắc nghiệm nhiều lựa chọn", "PHẦN II. Đúng sai", "PHẦN III. Trả lời ngắn"]
+    mcq, tf, short = (sec.questions for sec in structure.sections)
+    assert [q.mode for q in mcq + tf + short] == ["mcq"] * 8 + ["true_false"] * 2 + ["short"] * 2
+    assert [_correct(q) for q in mcq] == ["BCDA"[i % 4] for i in range(8)]
+    assert [_correct(q) for q in tf] == ["bd", "ac"]
+    assert [q.correct_answer_text for q in short] == ["3", "6"]
+    assert len(structure.header_elements) == 2 and len(structure.footer_elements) == 1
+
+
+def test_mark_spans_lookup():
+    marks = MarkSpans("0123456789", (2, 5, 8, 9))
+    assert [marks.covers(i) for i in range(10)] == [False, False, True, True, True, False, False, False, True, False]
+    assert marks.overlaps(4, 6) and marks.overlaps(0, 3) and marks.overlaps(6, 9)
+    assert not marks.overlaps(5, 8) and not marks.overlaps(9, 10)
+    assert not MarkSpans("abc")
+
+
+def test_scan_paragraph_merges_adjacent_marked_runs():
+    p = Document().add_paragraph()
+    p.add_run("A. x ")
+    p.add_run("B").underline = True
+    p.add_run(". y").font.highlight_color = WD_COLOR_INDEX.YELLOW
+    p.add_run(" C. ")
+    p.add_run("z").font.color.rgb = RGBColor(0xFF, 0, 0)
+    p.add_run(" D. none").underline = False
+    text, marks = _scan_paragraph(p._element)
+    assert text == "A. x B. y C. z D. none"
+    assert marks.bounds == (5, 9, 13, 14)
+
+
+def test_marked_inline_option_is_the_answer():
+    structure = parse_exam_template(build_docx([
+        "Câu 1: Chọn đáp án đúng",
+        [("A. một  B. hai  ", {}), ("C", {"underline": True}), (". ba  D. bốn", {})],
+    ]))
+    q = structure.sections[0].questions[0]
+    assert [opt.label[0] for opt in q.options] == ["A", "B", "C", "D"]
+    assert _correct(q) == "C"
+
+
+def test_stream_backend_matches_python_docx(exam_docx):
+    mixed = build_docx([
+        "Mã đề: 000", "PHẦN I. Trắc nghiệm",
+        "Câu 1: Câu hỏi có bảng", {"table": [["x", "y"], ["1", "2"]]},
+        [("A. một  ", {}), ("B", {"underline": True}), (". hai  C. ba  D. bốn", {})],
+        "Câu 2: Câu hỏi thứ hai", "A. một", "B. hai", "C. ba", "D. bốn",
+        "ĐÁP ÁN", {"table": [["Câu 1", "Câu 2"], ["A", "D"]]},
+    ])
+    for source in (exam_docx, mixed):
+        docx = parse_exam_template(source, PARSE_BACKEND_DOCX)
+        stream = parse_exam_template(source, PARSE_BACKEND_STREAM)
+        assert encode_structure(stream) == encode_structure(docx)
+
+
+def test_questions_resolve_on_first_access(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    questions = [q for sec in structure.sections for q in sec.questions]
+    rest = questions[1:]
+    assert not any(q.resolved for q in rest)
+
+    # Số câu, nhãn và vân tay có sẵn từ lần quét đầu
+    assert [q.original_idx for q in rest[:3]] == [2, 3, 4]
+    assert rest[0].raw_label == "Câu 2" and len(rest[0].content_hash) == 16
+    assert not any(q.resolved for q in rest)
+
+    assert rest[1].mode == "mcq"
+    assert [q.resolved for q in rest[:3]] == [False, True, False]
+
+
+def test_failed_resolution_can_be_retried():
+    calls = []
+
+    def resolve(q):
+        calls.append(q)
+        if len(calls) == 1:
+            raise RuntimeError("lỗi tạm thời")
+        q.stem_elements, q.options, q.mode, q.correct_answer_text, q.label_slot = [], [], "short", "7", None
+
+    q = LazyQuestionBlock(1, "Câu 1", "00", resolve)
+    with pytest.raises(RuntimeError):
+        q.options
+    assert not q.resolved
+    assert q.correct_answer_text == "7" and q.resolved and len(calls) == 2
+
+
+def _hashes(blocks):
+    return [q.content_hash for q in parse_exam_template(build_docx(blocks)).sections[0].questions]
+
+
+def test_fingerprints_cover_full_content_and_ignore_numbering():
+    long_stem = "Cho hàm số có đồ thị như hình vẽ bên dưới, " * 10
+    a, b, c, d = _hashes([
+        f"Câu 1: {long_stem}tìm m", "*A. 1", "B. 2",
+        f"Câu 2: {long_stem}tìm n", "*A. 1", "B. 2",       # khác ở cuối stem
+        f"Câu 3: {long_stem}tìm m", "*A. 1", "B. 3",       # khác ở phương án
+        f"Câu 7:   {long_stem.upper()}TÌM M", "*A.  1", "B. 2",  # chỉ khác số câu / hoa thường / khoảng trắng
+    ])
+    assert len({a, b, c}) == 3
+    assert len(a) == 16
+
+    # d trùng vân tay với a -> được băm lại, các ID luôn duy nhất và ổn định giữa các lần parse
+    assert d == hashlib.blake2b(f"{a}#1".encode("ascii"), digest_size=8).hexdigest()
+    again = _hashes([f"Câu 1: {long_stem}tìm m", "*A. 1", "B. 2"])
+    assert again == [a]
+
+
+def test_repeated_questions_get_stable_unique_ids():
+    blocks = ["Câu 1: Câu lặp lại", "*A. có", "B. không"] * 3
+    first, second = _hashes(blocks), _hashes(blocks)
+    assert len(set(first)) == 3 and first == second
@@ -0,0 +1,180 @@
+import numpy as np
+import pytest
+
+from core.generators import _answer_for_order
+from core.models import ExamStructure, OptionBlock, QuestionBlock, Section
+from core.permutations import plan_batch
+from exceptions import InvalidDrawCountsError, VariantCapacityError
+
+
+def make_structure(mcq: int = 20, tf: int = 4) -> ExamStructure:
+    """Đề chỉ có dữ liệu (không có element): MCQ đáp án xoay vòng A-D, TF đúng/sai xen kẽ."""
+    mcq_questions = [
+        QuestionBlock(i + 1, f"Câu {i + 1}", options=[
+            OptionBlock(letter, is_correct=j == i % 4) for j, letter in enumerate("ABCD")
+        ], content_hash=f"mcq{i}")
+        for i in range(mcq)
+    ]
+    tf_questions = [
+        QuestionBlock(i + 1, f"Câu {i + 1}", mode="true_false", options=[
+            OptionBlock(letter, is_correct=(i + j) % 2 == 0) for j, letter in enumerate("abcd")
+        ], content_hash=f"tf{i}")
+        for i in range(tf)
+    ]
+    return ExamStructure(sections=[Section("PHẦN I", questions=mcq_questions), Section("PHẦN II", questions=tf_questions)])
+
+
+def _assert_same_batch(a, b, rows=slice(None)):
+    for sa, sb in zip(a.sections, b.sections):
+        assert np.array_equal(sa.question_order[rows], sb.question_order)
+        assert np.array_equal(sa.option_order[rows], sb.option_order)
+    assert a.answer_rows()[rows] == b.answer_rows()
+
+
+def test_same_job_gives_identical_plans():
+    structure = make_structure()
+    _assert_same_batch(plan_batch(structure, "job-a", 12), plan_batch(structure, "job-a", 12))
+    other = plan_batch(structure, "job-b", 12)
+    assert not np.array_equal(plan_batch(structure, "job-a", 12).sections[0].question_order,
+                              other.sections[0].question_order)
+
+
+def test_variant_plan_does_not_depend_on_batch_size_or_start():
+    structure = make_structure()
+    full = plan_batch(structure, "job-a", 12)
+    _assert_same_batch(full, plan_batch(structure, "job-a", 7), slice(0, 7))
+    _assert_same_batch(full, plan_batch(structure, "job-a", 5, start=7), slice(7, 12))
+
+
+def test_matrix_answers_match_per_question_answers():
+    structure = make_structure()
+    batch = plan_batch(structure, "job-a", 6)
+    for v in range(6):
+        plan = batch.plan(v, structure)
+        assert plan.answers == batch.answer_rows()[v]
+        for views, sec in zip(plan.sections, structure.sections):
+            for view in views:
+                assert view.answer == _answer_for_order(sec.questions[view.question_idx], list(view.option_order))
+
+
+def test_unsupported_version_is_rejected():
+    with pytest.raises(ValueError):
+        plan_batch(make_structure(), "job-a", 2, version=1)
+
+
+def _drawn_sets(batch, sec_i: int = 0):
+    return [frozenset(row) for row in batch.sections[sec_i].question_order.tolist()]
+
+
+@pytest.mark.parametrize("n, k", [(20, 8), (20, 10), (12, 5)])
+def test_draw_coverage_is_even(n, k):
+    batch = plan_batch(make_structure(mcq=n, tf=0), "job-draw", 50, draw_counts=[k, 0])
+    usage = np.bincount(batch.sections[0].question_order.ravel(), minlength=n)
+    assert usage.max() - usage.min() <= 1
+    assert all(len(s) == k for s in _drawn_sets(batch))
+
+
+def test_draw_sets_do_not_repeat_periodically():
+    # Cửa sổ trượt cũ lặp lại bộ câu sau mỗi n / gcd(n, k) = 2 mã đề
+    sets = _drawn_sets(plan_batch(make_structure(mcq=20, tf=0), "job-draw", 40, draw_counts=[10, 0]))
+    assert len(set(sets)) > 30
+
+
+def test_draw_is_deterministic_and_independent_of_start():
+    structure = make_structure()
+    full = plan_batch(structure, "job-draw", 30, draw_counts=[8, 2])
+    again = plan_batch(structure, "job-draw", 30, draw_counts=[8, 2])
+    tail = plan_batch(structure, "job-draw", 12, start=18, draw_counts=[8, 2])
+    for a, b, t in zip(full.sections, again.sections, tail.sections):
+        assert np.array_equal(a.question_order, b.question_order)
+        assert np.array_equal(a.question_order[18:], t.question_order)
+        assert np.array_equal(a.option_order[18:], t.option_order)
+    assert full.answer_rows()[18:] == tail.answer_rows()
+    assert not np.array_equal(
+        full.sections[0].question_order,
+        plan_batch(structure, "job-other", 30, draw_counts=[8, 2]).sections[0].question_order,
+    )
+
+
+def test_draw_without_shuffle_keeps_bank_order():
+    batch = plan_batch(make_structure(), "job-draw", 10, shuffle_questions=False, draw_counts=[6, 0])
+    order = batch.sections[0].question_order
+    assert np.array_equal(order, np.sort(order, axis=1))
+
+
+@pytest.mark.parametrize("draw", [[-1, 0], [21, 0], [5], [5, 0, 0], [2.5, 0], [True, 0]])
+def test_invalid_draw_counts_are_rejected(draw):
+    # make_structure(): 20 câu MCQ + 4 câu TF
+    with pytest.raises(InvalidDrawCountsError):
+        plan_batch(make_structure(), "job-draw", 3, draw_counts=draw)
+
+
+@pytest.mark.parametrize("draw", [None, [10, 0]])
+def test_balanced_answers_stay_balanced(draw):
+    structure = make_structure(mcq=22)
+    batch = plan_batch(structure, "job-balance", 40, balance_answers=True, draw_counts=draw)
+    counts = batch.answer_counts[:, :4]
+    assert (counts.max(axis=1) - counts.min(axis=1) <= 1).all()
+    assert (counts.sum(axis=1) == (10 if draw else 22)).all()
+    # Đáp án vẫn đúng sau khi đổi chỗ phương án
+    for v in range(0, 40, 7):
+        for views, sec in zip(batch.plan(v, structure).sections, structure.sections):
+            for view in views:
+                assert view.answer == _answer_for_order(sec.questions[view.question_idx], list(view.option_order))
+
+
+def test_balancing_keeps_variants_reproducible():
+    structure = make_structure(mcq=22)
+    full = plan_batch(structure, "job-balance", 20, balance_answers=True)
+    _assert_same_batch(full, plan_batch(structure, "job-balance", 8, start=12, balance_answers=True), slice(12, 20))
+
+
+def _shared_adjacent_pairs(orders: np.ndarray) -> list:
+    pairs = [{frozenset(pair) for pair in zip(row[:-1], row[1:])} for row in orders.tolist()]
+    return [len(pairs[a] & pairs[b]) for a in range(len(pairs)) for b in range(a + 1, len(pairs))]
+
+
+def test_diverse_variants_are_unique_and_spread():
+    batch = plan_batch(make_structure(mcq=13, tf=0), "job-diverse", 12, diverse=True)
+    orders = batch.sections[0].question_order
+    assert len({row.tobytes() for row in orders}) == 12
+
+
+def test_diverse_orders_share_fewer_adjacent_pairs_than_random():
+    # Nhiều mã đề hơn số câu: thứ tự sau không được là phép quay của thứ tự trước
+    structure = make_structure(mcq=40, tf=0)
+    diverse = _shared_adjacent_pairs(plan_batch(structure, "job-diverse", 200, diverse=True).sections[0].question_order)
+    shuffled = _shared_adjacent_pairs(plan_batch(structure, "job-diverse", 200).sections[0].question_order)
+    assert max(diverse) < max(shuffled)
+    assert max(diverse) <= 6
+    assert np.mean(diverse) <= np.mean(shuffled)
+
+
+def test_diverse_plan_does_not_depend_on_start():
+    structure = make_structure(mcq=10)
+    full = plan_batch(structure, "job-diverse", 30, diverse=True, balance_answers=True, draw_counts=[6, 0])
+    part = plan_batch(structure, "job-diverse", 10, start=20, diverse=True, balance_answers=True, draw_counts=[6, 0])
+    _assert_same_batch(full, part, slice(20, 30))
+
+
+def test_diverse_redraws_options_when_question_orders_run_out():
+    # 2 câu MCQ: chỉ 2 thứ tự câu nhưng 2! * 4! * 4! = 1152 mã đề khác nhau
+    structure = make_structure(mcq=2, tf=0)
+    for balance in (False, True):
+        batch = plan_batch(structure, "job-diverse", 100, diverse=True, balance_answers=balance)
+        keys = {
+            batch.sections[0].question_order[v].tobytes() + batch.sections[0].option_order[v].tobytes()
+            for v in range(100)
+        }
+        assert len(keys) == 100
+        for v in range(100):
+            for view in batch.plan(v, structure).sections[0]:
+                question = structure.sections[0].questions[view.question_idx]
+                assert view.answer == _answer_for_order(question, list(view.option_order))
+
+
+def test_diverse_raises_when_capacity_is_exceeded():
+    structure = make_structure(mcq=3, tf=0)
+    assert plan_batch(structure, "job-diverse", 6, shuffle_options=False, diverse=True).num_variants == 6
+    with pytest.raises(VariantCapacityError):
+        plan_batch(structure, "job-diverse", 7, shuffle_options=False, diverse=True)
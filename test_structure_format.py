@@ -0,0 +1,57 @@
+import struct
+
+import pytest
+from lxml import etree
+
+from core.generators import generate_variant_from_structure
+from core.parsers import parse_exam_template
+from core.structure_format import LazyElements, decode_structure, encode_structure
+
+
+def _dump(structure):
+    """Mọi trường của structure, phần tử XML ở dạng đã serialize."""
+    xml = lambda elements: [etree.tostring(el) for el in elements]
+    return {
+        "header": xml(structure.header_elements),
+        "footer": xml(structure.footer_elements),
+        "sections": [
+            (sec.title, xml(sec.info_elements), [
+                (q.original_idx, q.raw_label, q.mode, q.correct_answer_text, q.content_hash, q.label_slot,
+                 xml(q.stem_elements),
+                 [(opt.label, opt.is_correct, opt.label_slot, xml(opt.elements)) for opt in q.options])
+                for q in sec.questions
+            ])
+            for sec in structure.sections
+        ],
+    }
+
+
+@pytest.mark.parametrize("lazy", [True, False])
+def test_round_trip(exam_docx, lazy):
+    structure = parse_exam_template(exam_docx)
+    decoded = decode_structure(encode_structure(structure), lazy=lazy)
+    assert _dump(decoded) == _dump(structure)
+
+
+def test_elements_are_parsed_on_first_use(exam_docx):
+    decoded = decode_structure(encode_structure(parse_exam_template(exam_docx)))
+    stem = decoded.sections[0].questions[0].stem_elements
+    assert isinstance(stem, LazyElements) and not stem.materialized
+    assert len(stem) == 1 and not stem.materialized
+    stem[0]
+    assert stem.materialized
+
+
+def test_decoded_structure_renders_identically(exam_docx):
+    structure = parse_exam_template(exam_docx)
+    decoded = decode_structure(encode_structure(structure))
+    assert generate_variant_from_structure(exam_docx, decoded, 3, "101") == \
+        generate_variant_from_structure(exam_docx, structure, 3, "101")
+
+
+def test_rejects_unknown_data(exam_docx):
+    data = encode_structure(parse_exam_template(exam_docx))
+    with pytest.raises(ValueError):
+        decode_structure(b"XXXX" + data[4:])
+    with pytest.raises(ValueError):
+        decode_structure(data[:4] + struct.pack("<H", 99) + data[6:])
@@ -0,0 +1,72 @@
+import pytest
+from docx import Document
+from docx.oxml.table import CT_Tbl
+from docx.oxml.text.paragraph import CT_P
+from docx.table import Table
+
+from conftest import build_docx
+from core.parsers import parse_exam_template
+from core.utils import _iter_table_paragraphs
+from exceptions import AnswerKeyNotFoundError
+
+KEY = "BADCAB"
+
+
+def _exam(marked: bool = True):
+    blocks = ["ĐỀ KIỂM TRA", "Mã đề: 000", "PHẦN I. Trắc nghiệm nhiều lựa chọn"]
+    for i in range(1, 7):
+        blocks.append(f"Câu {i}: Câu hỏi trắc nghiệm số {i}")
+        for letter in "ABCD":
+            blocks.append([(f"{letter}.", {"underline": marked and letter == "C"}), (f" lựa chọn {letter}{i}", {})])
+    return blocks
+
+
+def _key_table():
+    return {"table": [[str(i) for i in range(1, 7)], list(KEY)]}
+
+
+def _correct(structure):
+    return ["".join(opt.label[0] for opt in q.options if opt.is_correct) for q in structure.sections[0].questions]
+
+
+def test_text_answer_key_overrides_marked_answers():
+    structure = parse_exam_template(build_docx(_exam() + ["ĐÁP ÁN", "1. B 2. A 3. D 4. C 5. A 6. B"]))
+    assert _correct(structure) == list(KEY)
+
+
+def test_answer_key_tables_are_not_read():
+    # Bảng bị làm phẳng thành từng ô -> không có cặp "số câu + đáp án" trong cùng đoạn văn
+    structure = parse_exam_template(build_docx(_exam() + ["ĐÁP ÁN", _key_table()]))
+    assert _correct(structure) == ["C"] * 6
+
+
+def test_footer_answer_table_is_kept_and_not_used_as_key():
+    source = build_docx(_exam(marked=False) + ["----- HẾT -----", _key_table()])
+    with pytest.raises(AnswerKeyNotFoundError):
+        parse_exam_template(source)
+
+
+def _python_docx_paragraphs(tbl):
+    """Cách làm phẳng bảng ban đầu: Table.rows / row.cells của python-docx."""
+    for row in Table(tbl, None).rows:
+        for cell in row.cells:
+            for child in cell._element.iterchildren():
+                if isinstance(child, CT_P):
+                    yield child
+                elif isinstance(child, CT_Tbl):
+                    yield from _python_docx_paragraphs(child)
+
+
+def test_table_flattening_matches_python_docx_with_merged_cells():
+    doc = Document()
+    table = doc.add_table(rows=4, cols=4)
+    for r in range(4):
+        for c in range(4):
+            table.cell(r, c).text = f"{r}{c}"
+    table.cell(0, 0).merge(table.cell(0, 1))    # gộp ngang
+    table.cell(1, 3).merge(table.cell(3, 3))    # gộp dọc
+    table.cell(2, 0).merge(table.cell(3, 1))    # gộp cả hai chiều
+    table.cell(1, 1).add_table(rows=1, cols=1).cell(0, 0).text = "lồng"
+
+    expected = list(_python_docx_paragraphs(table._tbl))
+    assert [p._element for _, p in _iter_table_paragraphs(table._tbl)] == expected